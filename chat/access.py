@@ -0,0 +1,177 @@
+# chat/access.py
+"""Индекс участников личных чатов и групп для проверки доступа без запросов.
+
+На процесс держится LRU-кэш с TTL: ``(тип, id разговора) -> {user_id: роль}``.
+Положительная проверка — поиск в словаре. Отрицательная перепроверяется
+по БД (вдруг пользователь только что вступил, а кэш устарел).
+
+Кэшем пользуются только проверки сокетов. Процесс, который его заполняет,
+подписан на группу ``ACCESS_GROUP``: изменения участников (chat/signals.py)
+сбрасывают запись в своём процессе и после коммита рассылают сброс во все
+процессы, а в комнату — событие ``access_changed``, по которому лишённый
+доступа сокет закрывается с кодом ``CLOSE_ACCESS_REVOKED``. HTTP-запросы
+проверяют доступ по БД: их процесс может и не слушать сбросы.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .db import db_sync_to_async
+from .history import HISTORY_GENERAL, HISTORY_GROUP, HISTORY_PRIVATE
+
+CLOSE_ACCESS_REVOKED = 4003
+
+# Группа, на которую подписан каждый процесс с заполненным индексом
+ACCESS_GROUP = 'chat_access'
+
+ROOM_GROUPS = {
+    HISTORY_GENERAL: 'chat_general',
+    HISTORY_PRIVATE: 'private_chat_{}',
+    HISTORY_GROUP: 'group_chat_{}',
+}
+
+
+def room_group(kind, conversation_id):
+    """Имя группы channel layer для комнаты разговора"""
+    return ROOM_GROUPS[kind].format(conversation_id)
+
+
+class MembershipIndex:
+    """Потокобезопасный LRU-кэш участников с TTL"""
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize or getattr(settings, 'CHAT_ACCESS_CACHE_SIZE', 10000)
+        self.ttl = ttl or getattr(settings, 'CHAT_ACCESS_CACHE_TTL', 300)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            members, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return members
+
+    def set(self, key, members):
+        with self._lock:
+            self._data[key] = (members, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, kind, conversation_id):
+        with self._lock:
+            self._data.pop((kind, int(conversation_id)), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+access_index = MembershipIndex()
+
+
+class InvalidationListener:
+    """Подписка процесса на ACCESS_GROUP: сбросы индекса из всех процессов"""
+
+    def __init__(self):
+        self._task = None
+
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._listen())
+
+    async def _listen(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(ACCESS_GROUP, channel)
+        # Записи, загруженные до подписки, могли пропустить свой сброс
+        access_index.clear()
+        rejoin = asyncio.get_running_loop().create_task(self._rejoin(layer, channel))
+        try:
+            while True:
+                event = await layer.receive(channel)
+                access_index.invalidate(event['kind'], event['conversation_id'])
+        finally:
+            rejoin.cancel()
+            await layer.group_discard(ACCESS_GROUP, channel)
+
+    async def _rejoin(self, layer, channel):
+        # Членство в группе истекает через group_expiry, а подписка живёт всё время процесса
+        while True:
+            await asyncio.sleep(getattr(layer, 'group_expiry', 86400) / 2)
+            await layer.group_add(ACCESS_GROUP, channel)
+
+
+invalidation_listener = InvalidationListener()
+
+
+def load_members(kind, conversation_id, user_id=None):
+    """Участники разговора из БД: {user_id: роль} (только user_id, если он задан)"""
+    from .models import GroupMembership, PrivateChat
+
+    if kind == HISTORY_PRIVATE:
+        rows = PrivateChat.participants.through.objects.filter(privatechat_id=conversation_id)
+        if user_id is not None:
+            rows = rows.filter(user_id=user_id)
+        return {member_id: 'member' for member_id in rows.values_list('user_id', flat=True)}
+    if kind == HISTORY_GROUP:
+        rows = GroupMembership.objects.filter(group_id=conversation_id)
+        if user_id is not None:
+            rows = rows.filter(user_id=user_id)
+        return dict(rows.values_list('user_id', 'role'))
+    raise ValueError(f'Неизвестный тип разговора: {kind}')
+
+
+def _refresh(key):
+    members = load_members(*key)
+    access_index.set(key, members)
+    return members
+
+
+def member_role(kind, conversation_id, user_id):
+    """Роль пользователя в разговоре или None, если он не участник (по БД, без кэша)"""
+    return load_members(kind, int(conversation_id), user_id).get(user_id)
+
+
+def has_access(kind, conversation_id, user_id):
+    return member_role(kind, conversation_id, user_id) is not None
+
+
+async def ahas_access(kind, conversation_id, user_id):
+    """Проверка сокета: при попадании в кэш обходится без похода в поток БД"""
+    invalidation_listener.ensure_started()
+    key = (kind, int(conversation_id))
+    members = access_index.get(key)
+    if members is None or user_id not in members:
+        members = await db_sync_to_async(_refresh)(key)
+    return user_id in members
+
+
+def access_changed(kind, conversation_id, revoked=()):
+    """Сбросить индекс разговора во всех процессах и после коммита оповестить комнату"""
+    access_index.invalidate(kind, conversation_id)
+    group = room_group(kind, conversation_id)
+    event = {'type': 'access_changed', 'room': group, 'revoked': list(revoked)}
+    reset = {'type': 'access.invalidate', 'kind': kind, 'conversation_id': int(conversation_id)}
+
+    def notify():
+        # Повторный сброс: запись могла загрузиться заново до коммита
+        access_index.invalidate(kind, conversation_id)
+        layer = get_channel_layer()
+        async_to_sync(layer.group_send)(ACCESS_GROUP, reset)
+        async_to_sync(layer.group_send)(group, event)
+
+    transaction.on_commit(notify)
@@ -0,0 +1,143 @@
+# chat/admission.py
+"""Допуск WebSocket-подключений: защита процесса от лавины переподключений.
+
+После перезапуска процесса все клиенты переподключаются разом. Middleware
+ASGI пропускает подключения до проверки сессии и до консьюмера:
+
+    не больше ``CHAT_WS_MAX_CONNECTIONS`` сокетов на процесс;
+    ведро токенов ``CHAT_WS_CONNECT_RATE``/с (запас ``CHAT_WS_CONNECT_BURST``):
+    подключение без токена ждёт своей очереди, если ждать не дольше
+    ``CHAT_WS_CONNECT_QUEUE_WAIT``, иначе получает отказ;
+    не больше ``CHAT_WS_MAX_PER_USER`` сокетов одного пользователя
+    (проверяется после AuthMiddleware, в том же процессе).
+
+Отказ — принять и сразу закрыть сокет с кодом CLOSE_* (до accept браузер
+видит только 1006). Перед закрытием клиенту уходит кадр
+``{"type": "retry", "code": ..., "retry_after": секунды}``: задержка со
+случайным разбросом, чтобы отказанные клиенты не вернулись разом. Та же
+задержка — в reason закрытия для серверов, которые его передают (daphne —
+нет).
+"""
+import asyncio
+import random
+import time
+
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+
+from .metrics import ws_admission, ws_admission_wait
+from .wire import encode_frame
+
+CLOSE_USER_LIMIT = 4008      # слишком много сокетов пользователя (как 1008)
+CLOSE_OVERLOADED = 4013      # процесс заполнен (как 1013 Try Again Later)
+CLOSE_RATE_LIMITED = 4029    # слишком частые подключения (как HTTP 429)
+
+# Лишние вкладки не закроются сами за секунды — повтор не скоро
+USER_LIMIT_RETRY = 30.0
+
+
+def retry_delay(base):
+    """Предложенная задержка повтора: от base до 2*base, не меньше CHAT_WS_RETRY_MIN"""
+    base = max(base, getattr(settings, 'CHAT_WS_RETRY_MIN', 1.0))
+    return round(base * random.uniform(1.0, 2.0), 3)
+
+
+async def reject(receive, send, code, retry_after):
+    """Принять рукопожатие и закрыть сокет с кодом и задержкой повтора"""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+    await send({'type': 'websocket.send', 'text': encode_frame({'type': 'retry', 'code': code, 'retry_after': retry_after})})
+    await send({'type': 'websocket.close', 'code': code, 'reason': f'retry_after={retry_after}'})
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: подключение ждёт свой токен, а не получает отказ"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait):
+        """Занять токен: (ожидание, занят ли). Если ждать дольше max_wait, токен не занимается"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Токены уходят в минус: каждый следующий ждёт дольше предыдущего
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return wait, False
+        self.tokens -= 1
+        return wait, True
+
+
+class ConnectionAdmission:
+    """Ограничение числа и частоты подключений процесса (до проверки сессии)"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.max_connections = getattr(settings, 'CHAT_WS_MAX_CONNECTIONS', 10000)
+        self.queue_wait = getattr(settings, 'CHAT_WS_CONNECT_QUEUE_WAIT', 5.0)
+        self.overload_retry = getattr(settings, 'CHAT_WS_OVERLOAD_RETRY', 5.0)
+        self.bucket = TokenBucket(
+            getattr(settings, 'CHAT_WS_CONNECT_RATE', 200),
+            getattr(settings, 'CHAT_WS_CONNECT_BURST', 100),
+        )
+        self.connections = 0     # принятые и ожидающие токена
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.inner(scope, receive, send)
+        if self.connections >= self.max_connections:
+            ws_admission.inc('overloaded')
+            return await reject(receive, send, CLOSE_OVERLOADED, retry_delay(self.overload_retry))
+        wait, reserved = self.bucket.reserve(self.queue_wait)
+        if not reserved:
+            ws_admission.inc('rate_limited')
+            # Очередь заполнена на wait секунд вперёд: раньше повторять бесполезно
+            return await reject(receive, send, CLOSE_RATE_LIMITED, retry_delay(wait))
+
+        self.connections += 1
+        try:
+            if wait:
+                ws_admission.inc('queued')
+                await asyncio.sleep(wait)
+            ws_admission_wait.observe(wait)
+            ws_admission.inc('admitted')
+            return await self.inner(scope, receive, send)
+        finally:
+            self.connections -= 1
+
+
+class UserConnectionLimit:
+    """Не больше CHAT_WS_MAX_PER_USER сокетов пользователя в процессе (после AuthMiddleware)"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.max_per_user = getattr(settings, 'CHAT_WS_MAX_PER_USER', 20)
+        self.connections = {}    # user_id -> число сокетов
+
+    async def __call__(self, scope, receive, send):
+        user = scope.get('user')
+        if scope['type'] != 'websocket' or user is None or not user.is_authenticated:
+            return await self.inner(scope, receive, send)
+        user_id = user.id
+        if self.connections.get(user_id, 0) >= self.max_per_user:
+            ws_admission.inc('user_limit')
+            return await reject(receive, send, CLOSE_USER_LIMIT, retry_delay(USER_LIMIT_RETRY))
+
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        try:
+            return await self.inner(scope, receive, send)
+        finally:
+            self.connections[user_id] -= 1
+            if not self.connections[user_id]:
+                del self.connections[user_id]
+
+
+def AdmissionStack(inner):
+    """AuthMiddlewareStack с допуском: лимиты процесса до сессии, лимит пользователя после"""
+    return ConnectionAdmission(AuthMiddlewareStack(UserConnectionLimit(inner)))
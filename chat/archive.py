@@ -0,0 +1,207 @@
+# chat/archive.py
+"""Холодный архив старых сообщений.
+
+Сообщения старше ``CHAT_ARCHIVE_AFTER_DAYS`` переносятся из горячих таблиц
+в сегменты ``<тип>/<ГГГГ-ММ>/<uuid>.seg`` хранилища Django
+``STORAGES[CHAT_ARCHIVE_STORAGE]``. Из БД сообщения удаляются, поэтому
+хранилище должно быть долговременным и общим для всех узлов (S3 и т.п.):
+локальный диск контейнера теряется при пересборке, а другие узлы его не
+видят. Сегмент неизменяем (хранилища объектов не умеют дописывать): это
+цепочка блоков, сжатых zlib, каждый блок — сообщения одного разговора за
+месяц. Разреженный индекс по разговорам — модель ArchivedBlock (одна строка
+на блок): сегмент, смещение, длина и диапазон ``(timestamp, id)``.
+
+Архивация идёт порциями (archive_chunk): сегменты порции сохраняются до
+транзакции, а транзакция только вставляет строки индекса, удаляет порцию из
+горячей таблицы и поискового индекса и уменьшает счётчики профилей одним
+запросом — блокировка записи короткая. Если порцию уже перенёс другой
+запуск, транзакция откатывается. Если процесс упадёт между сохранением
+сегмента и коммитом, сегмент останется без ссылок, а сообщения — в горячей
+таблице.
+
+Порции берутся в порядке ``(timestamp, id)``, поэтому любое архивное
+сообщение разговора старше любого горячего — history дочитывает архив,
+когда горячие страницы закончились.
+"""
+import json
+import uuid
+import zlib
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import InvalidStorageError, storages
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .counters import uncount
+from .history import HISTORY_GENERAL, HISTORY_GROUP, HISTORY_PRIVATE
+from .models import ArchivedBlock, GroupMessage, Message, PrivateMessage
+from .search import unindex_messages
+
+# Тип разговора -> (модель сообщения, поле разговора, поле отправителя)
+ARCHIVE_KINDS = {
+    HISTORY_GENERAL: (Message, None, 'user'),
+    HISTORY_PRIVATE: (PrivateMessage, 'chat_id', 'sender'),
+    HISTORY_GROUP: (GroupMessage, 'group_id', 'sender'),
+}
+
+# Сколько блоков читать из индекса за один запрос при дочитывании истории
+BLOCKS_PER_QUERY = 8
+
+
+class ArchiveConflict(Exception):
+    """Порцию уже перенёс в архив другой запуск"""
+
+
+def archive_storage():
+    """Хранилище сегментов из STORAGES; без него архив не работает"""
+    alias = getattr(settings, 'CHAT_ARCHIVE_STORAGE', 'chat_archive')
+    try:
+        return storages[alias]
+    except InvalidStorageError:
+        raise ImproperlyConfigured(
+            f"Хранилище архива '{alias}' не настроено в STORAGES: нужно долговременное и общее для всех узлов"
+        )
+
+
+def segment_prefix(kind, timestamp):
+    return f'{kind}/{timestamp:%Y-%m}/'
+
+
+def encode_block(rows):
+    """Сжать строки блока: [id, id отправителя, timestamp ISO, текст]"""
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode(), 6)
+
+
+def save_segment(prefix, blocks):
+    """Сохранить блоки одним новым сегментом; вернуть его имя в хранилище"""
+    # Хранилище может сменить имя при совпадении — в индекс идёт фактическое
+    return archive_storage().save(f'{prefix}{uuid.uuid4().hex}.seg', ContentFile(b''.join(blocks)))
+
+
+@lru_cache(maxsize=128)
+def read_block(segment, offset, length):
+    """Строки блока от старых к новым: (id, id отправителя, timestamp, текст).
+
+    Блоки неизменяемы, поэтому кэшируются без сброса.
+    """
+    with archive_storage().open(segment, 'rb') as fh:
+        fh.seek(offset)
+        data = fh.read(length)
+    return tuple(
+        (message_id, sender_id, parse_datetime(timestamp), content)
+        for message_id, sender_id, timestamp, content in json.loads(zlib.decompress(data))
+    )
+
+
+def archive_chunk(kind, cutoff, limit):
+    """Перенести в архив до limit самых старых сообщений до cutoff; вернуть их число"""
+    model, field, sender = ARCHIVE_KINDS[kind]
+    columns = ['id', f'{sender}_id', 'timestamp', 'content'] + ([field] if field else [])
+    messages = list(
+        model.objects.filter(timestamp__lt=cutoff).order_by('timestamp', 'id').values_list(*columns)[:limit]
+    )
+    if not messages:
+        return 0
+
+    # Блок — сообщения одного разговора за один месяц, сегмент — блоки порции за месяц
+    by_block = defaultdict(list)
+    for message in messages:
+        conversation_id = message[4] if field else 0
+        by_block[(segment_prefix(kind, message[2]), conversation_id)].append(message)
+
+    by_segment = defaultdict(list)
+    for (prefix, conversation_id), rows in by_block.items():
+        data = encode_block([
+            [message_id, sender_id, timestamp.isoformat(), content]
+            for message_id, sender_id, timestamp, content, *_ in rows
+        ])
+        by_segment[prefix].append((conversation_id, rows, data))
+
+    blocks = []
+    for prefix, segment_blocks in by_segment.items():
+        segment = save_segment(prefix, [data for _, _, data in segment_blocks])
+        offset = 0
+        for conversation_id, rows, data in segment_blocks:
+            blocks.append(ArchivedBlock(
+                kind=kind,
+                conversation_id=conversation_id,
+                segment=segment,
+                offset=offset,
+                length=len(data),
+                message_count=len(rows),
+                first_timestamp=rows[0][2],
+                first_id=rows[0][0],
+                last_timestamp=rows[-1][2],
+                last_id=rows[-1][0],
+            ))
+            offset += len(data)
+
+    ids = [message[0] for message in messages]
+    with transaction.atomic():
+        ArchivedBlock.objects.bulk_create(blocks)
+        # Без сигналов по каждой строке: поиск и счётчики ниже — одним запросом каждый
+        queryset = model.objects.filter(id__in=ids)
+        if queryset._raw_delete(queryset.db) != len(ids):
+            raise ArchiveConflict(kind)
+        unindex_messages(model, ids)
+        if model is Message:
+            uncount('messages_sent', Counter(message[1] for message in messages))
+    return len(messages)
+
+
+def archived_rows(kind, conversation_id, position, count):
+    """До count архивных строк строго до позиции (timestamp, id), от новых к старым.
+
+    Возвращает (строки, есть ли ещё); count=0 только проверяет наличие.
+    """
+    blocks = ArchivedBlock.objects.filter(kind=kind, conversation_id=conversation_id or 0)
+    if position is not None:
+        timestamp, message_id = position
+        blocks = blocks.filter(Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_id__lt=message_id))
+    blocks = blocks.order_by('-last_timestamp', '-last_id')
+
+    rows = []
+    start = 0
+    while len(rows) <= count:
+        batch = list(blocks[start:start + BLOCKS_PER_QUERY])
+        for block in batch:
+            for row in reversed(read_block(block.segment, block.offset, block.length)):
+                if position is None or (row[2], row[0]) < position:
+                    rows.append(row)
+            if len(rows) > count:
+                break
+        if len(batch) < BLOCKS_PER_QUERY:
+            break
+        start += BLOCKS_PER_QUERY
+    return rows[:count], len(rows) > count
+
+
+def hydrate(kind, conversation_id, rows):
+    """Несохраняемые экземпляры моделей из архивных строк (с отправителем и профилем)"""
+    model, field, sender = ARCHIVE_KINDS[kind]
+    users = User.objects.select_related('userprofile').in_bulk({row[1] for row in rows})
+    messages = []
+    for message_id, sender_id, timestamp, content in rows:
+        user = users.get(sender_id)
+        if user is None:
+            continue
+        message = model(id=message_id, content=content, timestamp=timestamp)
+        if field:
+            setattr(message, field, conversation_id)
+        setattr(message, sender, user)
+        messages.append(message)
+    return messages
+
+
+def archived_page(kind, conversation_id, position, count):
+    """Архивная часть страницы истории: (сообщения от старых к новым, есть ли ещё)"""
+    rows, has_more = archived_rows(kind, conversation_id, position, count)
+    messages = hydrate(kind, conversation_id, rows)
+    messages.reverse()
+    return messages, has_more
@@ -0,0 +1,127 @@
+# chat/avatars.py
+"""Варианты аватарок фиксированных размеров (WebP и PNG).
+
+После сохранения UserProfile/Group с новой аватаркой оригинал уходит в
+пул процессов: уменьшение и кодирование не занимают ни поток запроса, ни
+цикл событий. Готовые файлы сохраняются под именами из хэша содержимого
+(``variants/<хэш>.<формат>``) и отдаются с ``Cache-Control: immutable``
+(views.avatar_variant); имена записываются в поле ``avatar_variants``.
+"""
+import hashlib
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+AVATAR_SIZES = (32, 64, 128)
+AVATAR_FORMATS = ('webp', 'png')
+VARIANTS_DIR = 'variants'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(reset=False):
+    global _executor
+    with _executor_lock:
+        if reset and _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        if _executor is None:
+            # spawn: дочерние процессы не наследуют потоки daphne и соединения с БД
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'CHAT_AVATAR_WORKERS', 2),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+
+def submit_render(data):
+    """Поставить обработку в пул; упавший пул (убит рабочий процесс) пересоздаётся"""
+    try:
+        return get_executor().submit(render_variants, data)
+    except BrokenProcessPool:
+        return get_executor(reset=True).submit(render_variants, data)
+
+
+def render_variants(data, sizes=AVATAR_SIZES, formats=AVATAR_FORMATS):
+    """Квадратные миниатюры всех размеров и форматов: {(размер, формат): байты}.
+
+    Выполняется в дочернем процессе, поэтому использует только Pillow.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert('RGBA')
+    result = {}
+    for size in sizes:
+        thumb = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        for fmt in formats:
+            buffer = io.BytesIO()
+            if fmt == 'webp':
+                thumb.save(buffer, format='WEBP', quality=85, method=6)
+            else:
+                thumb.save(buffer, format='PNG', optimize=True)
+            result[(size, fmt)] = buffer.getvalue()
+    return result
+
+
+def store_variants(rendered, source):
+    """Сохранить файлы под именами из хэша содержимого (одинаковые не дублируются)"""
+    variants = {'source': source}
+    for (size, fmt), content in rendered.items():
+        name = f'{VARIANTS_DIR}/{hashlib.sha256(content).hexdigest()[:24]}.{fmt}'
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(content))
+        variants.setdefault(str(size), {})[fmt] = name
+    return variants
+
+
+def _save_variants(model, pk, source, on_saved, future):
+    try:
+        variants = store_variants(future.result(), source)
+        # Аватарку могли сменить, пока шла обработка — тогда результат уже не нужен
+        if model.objects.filter(pk=pk, avatar=source).update(avatar_variants=variants) and on_saved:
+            on_saved()
+    except Exception:
+        logger.exception("Ошибка обработки аватарки %s %s", model.__name__, pk)
+    finally:
+        connections.close_all()
+
+
+def schedule_variants(instance, on_saved=None):
+    """После коммита отправить аватарку экземпляра в пул процессов"""
+    model, pk, source = type(instance), instance.pk, instance.avatar.name
+
+    def submit():
+        try:
+            with default_storage.open(source, 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            logger.warning("Не удалось прочитать аватарку %s", source)
+            return
+        future = submit_render(data)
+        # Сохранение — в отдельном потоке: колбэк может выполниться и в потоке запроса
+        future.add_done_callback(lambda f: threading.Thread(
+            target=_save_variants, args=(model, pk, source, on_saved, f), daemon=True,
+        ).start())
+
+    transaction.on_commit(submit)
+
+
+def build_variants_now(instance):
+    """Обработать аватарку синхронно (для команды пересборки): вернуть варианты"""
+    with default_storage.open(instance.avatar.name, 'rb') as fh:
+        rendered = submit_render(fh.read()).result()
+    variants = store_variants(rendered, instance.avatar.name)
+    type(instance).objects.filter(pk=instance.pk).update(avatar_variants=variants)
+    return variants
@@ -1,328 +1,140 @@
-import json
 import logging
-from channels.generic.websocket import AsyncWebsocketConsumer
-from django.contrib.auth.models import User
-from asgiref.sync import sync_to_async
-from .models import Message, OnlineUser
+from django.conf import settings
+from .access import CLOSE_ACCESS_REVOKED
+from .streams import STREAM_KINDS, GeneralStream, GroupStream, PrivateStream, StreamConsumer
+from .wire import encode_frame
 
 logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        logger.info(f"WebSocket подключение от пользователя: {self.scope['user']}")
-        
-        # Временно разрешим анонимным пользователям для тестирования
-        if self.scope["user"].is_anonymous:
-            logger.warning("Анонимный пользователь подключается (тестовый режим)")
-            self.user = None
-        else:
-            self.user = self.scope["user"]
-
-        self.room_group_name = 'chat_general'
-
-        # Добавить пользователя в онлайн (только если авторизован)
-        if self.user:
-            await self.add_online_user(self.user)
-
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
-        username = self.user.username if self.user else "Анонимный"
-        logger.info(f"WebSocket соединение принято для пользователя: {username}")
-
-        # Отправить обновление списка онлайн-пользователей всем
-        if self.user:
-            await self.send_online_users()
-
-    async def disconnect(self, close_code):
-        # Удалить пользователя из онлайн (только если авторизован)
-        if self.user:
-            await self.remove_online_user(self.user)
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-        # Обновить список онлайн для остальных
-        if self.user:
-            await self.send_online_users()
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        username = data['username']
-
-        await self.save_message(username, message)
-        
-        # Получить аватарку пользователя
-        avatar_url = await self.get_user_avatar(username)
+class RoomConsumer(StreamConsumer):
+    """Сокет одной комнаты: один поток из URL, кадры без id потока"""
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'username': username,
-                'avatar_url': avatar_url,
-            }
-        )
+    stream_class = None
+    url_kwarg = None
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'username': event['username'],
-            'avatar_url': event.get('avatar_url'),
-        }))
-
-    async def send_online_users(self):
-        online_users = await self.get_online_users()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'online_users',
-                'users': online_users,
-            }
-        )
-
-    async def online_users(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'online_users',
-            'users': event['users'],
-        }))
-
-    @sync_to_async
-    def add_online_user(self, user):
-        OnlineUser.objects.get_or_create(user=user)
-
-    @sync_to_async
-    def remove_online_user(self, user):
-        OnlineUser.objects.filter(user=user).delete()
-
-    @sync_to_async
-    def get_online_users(self):
-        return list(OnlineUser.objects.select_related('user').values_list('user__username', flat=True))
-
-    @sync_to_async
-    def save_message(self, username, content):
-        user = User.objects.get(username=username)
-        Message.objects.create(user=user, content=content)
-    
-    @sync_to_async
-    def get_user_avatar(self, username):
-        try:
-            from .models import UserProfile
-            user = User.objects.get(username=username)
-            profile = UserProfile.objects.get(user=user)
-            if profile.avatar:
-                return profile.avatar.url
-        except (User.DoesNotExist, UserProfile.DoesNotExist):
-            pass
-        return None
-
-class PrivateChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.room_group_name = f'private_chat_{self.chat_id}'
-        
-        logger.info(f"Подключение к приватному чату {self.chat_id} от пользователя: {self.scope['user']}")
-        
-        # Проверить, что пользователь имеет доступ к этому чату
-        if self.scope["user"].is_anonymous:
-            logger.warning("Анонимный пользователь пытается подключиться к приватному чату")
-            await self.close()
-            return
-            
-        # Проверить доступ к чату
-        has_access = await self.check_chat_access(self.scope["user"], self.chat_id)
-        if not has_access:
-            logger.warning(f"Пользователь {self.scope['user'].username} не имеет доступа к чату {self.chat_id}")
+        user = self.scope["user"]
+        self.user = None if user.is_anonymous else user
+
+        conversation_id = self.scope['url_route']['kwargs'][self.url_kwarg] if self.url_kwarg else None
+        self.stream = self.stream_class(self, conversation_id=conversation_id)
+        # Проверить доступ к разговору до принятия соединения
+        if not await self.stream.authorize():
+            logger.warning("Пользователь %s не имеет доступа к %s", user, self.stream.group)
             await self.close()
             return
-        
-        self.user = self.scope["user"]
-        
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+
         await self.accept()
-        logger.info(f"Приватный чат {self.chat_id} подключен для пользователя: {self.user.username}")
+        await self.open_stream(self.stream)
+        # Подключения считаются в метриках (chat.metrics); строка лога форматируется только при DEBUG
+        logger.debug("WebSocket соединение %s принято для пользователя: %s", self.stream.group, user)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.receive_frame(text_data, bytes_data)
+        if data is None:
+            await self.stream.reject('bad_frame')
+            return
+        await self.stream.handle(data)
 
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+    def stream_for(self, event):
+        # Сокет подписан только на свою комнату: ``room`` в событии не обязателен
+        return self.streams.get(None)
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        username = data['username']
-        chat_id = data['chat_id']
+    async def revoke_stream(self, stream):
+        await self.close(code=CLOSE_ACCESS_REVOKED)
 
-        # Сохранить сообщение
-        await self.save_private_message(username, message, chat_id)
-        
-        # Получить аватарку пользователя
-        avatar_url = await self.get_user_avatar(username)
+class ChatConsumer(RoomConsumer):
+    stream_class = GeneralStream
+    # Сокет общего чата доставляет и уведомления о личных чатах и группах
+    notifications = True
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'private_message',
-                'message': message,
-                'username': username,
-                'avatar_url': avatar_url,
-                'timestamp': await self.get_current_timestamp(),
-            }
-        )
+class PrivateChatConsumer(RoomConsumer):
+    stream_class = PrivateStream
+    url_kwarg = 'chat_id'
 
-    async def private_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'private_message',
-            'message': event['message'],
-            'username': event['username'],
-            'avatar_url': event.get('avatar_url'),
-            'timestamp': event['timestamp'],
-        }))
+class GroupChatConsumer(RoomConsumer):
+    stream_class = GroupStream
+    url_kwarg = 'group_id'
 
-    @sync_to_async
-    def check_chat_access(self, user, chat_id):
-        try:
-            from .models import PrivateChat
-            chat = PrivateChat.objects.get(id=chat_id, participants=user)
-            return True
-        except PrivateChat.DoesNotExist:
-            return False
+class MultiplexConsumer(StreamConsumer):
+    """Один сокет на пользователя для любого числа разговоров.
 
-    @sync_to_async
-    def save_private_message(self, username, content, chat_id):
-        try:
-            from .models import PrivateChat, PrivateMessage
-            user = User.objects.get(username=username)
-            chat = PrivateChat.objects.get(id=chat_id)
-            PrivateMessage.objects.create(chat=chat, sender=user, content=content)
-        except (User.DoesNotExist, PrivateChat.DoesNotExist):
-            logger.error(f"Ошибка сохранения приватного сообщения: пользователь {username}, чат {chat_id}")
+    Клиент открывает поток кадром
+    ``{"type": "subscribe", "stream": <id>, "kind": "general"|"private"|"group", "id": <id разговора>}``
+    и закрывает кадром ``{"type": "unsubscribe", "stream": <id>}``; id потока
+    выбирает клиент (число или строка). Остальные кадры клиента — те же, что
+    в комнатных сокетах, с полем ``stream``; каждый кадр сервера тоже несёт
+    ``stream``; уведомления пользователя (``notifications``) приходят без
+    ``stream``. ``seq`` в subscribe — последний полученный номер комнаты:
+    пропущенное повторяется сразу (chat/recent.py). Лишённый доступа поток
+    закрывается кадром ``closed`` с кодом CLOSE_ACCESS_REVOKED, сокет
+    остаётся открытым.
+    """
 
-    @sync_to_async
-    def get_current_timestamp(self):
-        from django.utils import timezone
-        return timezone.now().isoformat()
-    
-    @sync_to_async
-    def get_user_avatar(self, username):
-        try:
-            from .models import UserProfile
-            user = User.objects.get(username=username)
-            profile = UserProfile.objects.get(user=user)
-            if profile.avatar:
-                return profile.avatar.url
-        except (User.DoesNotExist, UserProfile.DoesNotExist):
-            pass
-        return None
+    notifications = True
 
-class GroupChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_id = self.scope['url_route']['kwargs']['group_id']
-        self.room_group_name = f'group_chat_{self.group_id}'
-        
-        logger.info(f"Подключение к групповому чату {self.group_id} от пользователя: {self.scope['user']}")
-        
-        # Проверить, что пользователь имеет доступ к этой группе
         if self.scope["user"].is_anonymous:
-            logger.warning("Анонимный пользователь пытается подключиться к групповому чату")
+            logger.warning("Анонимный пользователь пытается открыть мультиплексный сокет")
             await self.close()
             return
-            
-        # Проверить членство в группе
-        is_member = await self.check_group_membership(self.scope["user"], self.group_id)
-        if not is_member:
-            logger.warning(f"Пользователь {self.scope['user'].username} не является участником группы {self.group_id}")
-            await self.close()
-            return
-        
         self.user = self.scope["user"]
-        
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        self.max_streams = getattr(settings, 'CHAT_MUX_MAX_STREAMS', 200)
         await self.accept()
-        logger.info(f"Групповой чат {self.group_id} подключен для пользователя: {self.user.username}")
-
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        username = data['username']
-        group_id = data['group_id']
-
-        # Сохранить сообщение
-        await self.save_group_message(username, message, group_id)
-        
-        # Получить аватарку пользователя
-        avatar_url = await self.get_user_avatar_group(username)
+        logger.debug("Мультиплексный сокет подключен для пользователя: %s", self.user.username)
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'group_message',
-                'message': message,
-                'username': username,
-                'avatar_url': avatar_url,
-                'timestamp': await self.get_current_timestamp_group(),
-            }
-        )
-
-    async def group_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'group_message',
-            'message': event['message'],
-            'username': event['username'],
-            'avatar_url': event.get('avatar_url'),
-            'timestamp': event['timestamp'],
-        }))
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.receive_frame(text_data, bytes_data)
+        if data is None:
+            await self.send_control('error', None, error='bad_frame')
+            return
+        stream_id = data.get('stream')
+        if data.get('type') == 'subscribe':
+            await self.subscribe(stream_id, data.get('kind'), data.get('id'), data.get('seq'))
+        elif data.get('type') == 'unsubscribe':
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                await self.close_stream(stream)
+            await self.send_control('unsubscribed', stream_id)
+        elif stream_id in self.streams:
+            await self.streams[stream_id].handle(data)
+        else:
+            await self.send_control('error', stream_id, error='unknown_stream')
 
-    @sync_to_async
-    def check_group_membership(self, user, group_id):
+    async def subscribe(self, stream_id, kind, conversation_id, seq=None):
+        if isinstance(stream_id, bool) or not isinstance(stream_id, (int, str)) or len(str(stream_id)) > 64:
+            await self.send_control('error', None, error='bad_stream_id')
+            return
+        if stream_id in self.streams:
+            await self.send_control('error', stream_id, error='stream_exists')
+            return
+        if len(self.streams) >= self.max_streams:
+            await self.send_control('error', stream_id, error='too_many_streams')
+            return
         try:
-            from .models import Group
-            group = Group.objects.get(id=group_id, members=user)
-            return True
-        except Group.DoesNotExist:
-            return False
+            stream = STREAM_KINDS[kind](self, stream_id, conversation_id)
+        except (KeyError, TypeError, ValueError):
+            await self.send_control('error', stream_id, error='bad_conversation')
+            return
+        if stream.group in self.rooms:
+            # На одну комнату — один поток, иначе события пришлось бы дублировать
+            await self.send_control('error', stream_id, error='already_subscribed', existing=self.rooms[stream.group].stream_id)
+            return
+        if not await stream.authorize():
+            await self.send_control('error', stream_id, error='forbidden', code=CLOSE_ACCESS_REVOKED)
+            return
+        await self.send_control('subscribed', stream_id)
+        await self.open_stream(stream)
+        if seq is not None:
+            await stream.resume(seq)
 
-    @sync_to_async
-    def save_group_message(self, username, content, group_id):
-        try:
-            from .models import Group, GroupMessage
-            user = User.objects.get(username=username)
-            group = Group.objects.get(id=group_id)
-            GroupMessage.objects.create(group=group, sender=user, content=content)
-        except (User.DoesNotExist, Group.DoesNotExist):
-            logger.error(f"Ошибка сохранения группового сообщения: пользователь {username}, группа {group_id}")
+    async def send_control(self, frame_type, stream_id, **fields):
+        await self.send(text_data=encode_frame({'type': frame_type, 'stream': stream_id, **fields}))
 
-    @sync_to_async
-    def get_current_timestamp_group(self):
-        from django.utils import timezone
-        return timezone.now().isoformat()
+    async def send_stream(self, stream, text):
+        # Готовый кадр комнаты общий для всех получателей: id потока вписывается в начало
+        await self.send(text_data='{"stream":' + encode_frame(stream.stream_id) + ',' + text[1:])
 
-    @sync_to_async
-    def get_user_avatar_group(self, username):
-        try:
-            from .models import UserProfile
-            user = User.objects.get(username=username)
-            profile = UserProfile.objects.get(user=user)
-            if profile.avatar:
-                return profile.avatar.url
-        except (User.DoesNotExist, UserProfile.DoesNotExist):
-            pass
-        return None
\ No newline at end of file
+    async def revoke_stream(self, stream):
+        await self.close_stream(stream)
+        await self.send_control('closed', stream.stream_id, code=CLOSE_ACCESS_REVOKED)
@@ -0,0 +1,56 @@
+# chat/counters.py
+"""Денормализованные счётчики профиля: лайки и сообщения пользователя.
+
+Счётчики меняются через F() в той же транзакции, что и запись лайка или
+сообщения, поэтому страницы профиля и лайки не считают строки. Если
+счётчик всё же разошёлся (запись в обход ORM, гонка удалений), его
+пересчитывает команда reconcile_counters.
+"""
+from collections import Counter
+
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Message, UserLike, UserProfile
+
+# Поле счётчика -> (модель, поле пользователя в ней)
+USER_COUNTERS = {
+    'likes_received': (UserLike, 'to_user_id'),
+    'likes_given': (UserLike, 'from_user_id'),
+    'messages_sent': (Message, 'user_id'),
+}
+
+
+def bump(user_id, field, amount):
+    """Изменить счётчик профиля на amount (ниже нуля не опускается)"""
+    profiles = UserProfile.objects.filter(user_id=user_id)
+    if amount < 0:
+        profiles = profiles.filter(**{f'{field}__gte': -amount})
+    profiles.update(**{field: F(field) + amount})
+
+
+def uncount(field, amounts):
+    """Уменьшить счётчик у многих пользователей одним UPDATE: amounts — {user_id: на сколько}"""
+    if not amounts:
+        return
+    amount = Case(
+        *(When(user_id=user_id, then=Value(value)) for user_id, value in amounts.items()),
+        default=Value(0), output_field=IntegerField(),
+    )
+    UserProfile.objects.filter(user_id__in=list(amounts)).update(**{field: Greatest(F(field) - amount, 0)})
+
+
+def count_messages_sent(messages):
+    """Учесть сохранённые сообщения общего чата (по одному UPDATE на автора)"""
+    for user_id, sent in Counter(message.user_id for message in messages).items():
+        bump(user_id, 'messages_sent', sent)
+
+
+def actual_count(field):
+    """Выражение с фактическим значением счётчика для запроса к UserProfile"""
+    model, user_field = USER_COUNTERS[field]
+    counted = (
+        model.objects.filter(**{user_field: OuterRef('user_id')}).order_by()
+        .values(user_field).annotate(n=Count('id')).values('n')
+    )
+    return Coalesce(Subquery(counted), 0)
@@ -0,0 +1,54 @@
+# chat/db.py
+"""Пул потоков для запросов к БД из асинхронного кода.
+
+``sync_to_async`` по умолчанию (thread_sensitive=True) выполняет всё в
+одном общем потоке, и асинхронный ORM Django (``aget``, ``acreate``,
+``async for``) делает то же самое: запросы всех сокетов процесса идут
+строго по очереди. db_sync_to_async выполняет функцию в отдельном пуле из
+``CHAT_DB_WORKERS`` потоков, у каждого своё соединение с БД, — столько
+запросов процесса идут одновременно, а пул ограничивает число соединений.
+
+Функция, переданная в пул, должна работать с БД целиком внутри себя
+(транзакции не переживают переход между потоками). Соединения закрываются
+по CONN_MAX_AGE, как в channels.db.database_sync_to_async.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def db_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'CHAT_DB_WORKERS', 8),
+                    thread_name_prefix='chat-db',
+                )
+    return _executor
+
+
+def db_sync_to_async(func):
+    """Как sync_to_async, но в пуле потоков БД (можно использовать декоратором)"""
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False, executor=db_executor())(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,68 @@
+# chat/directory.py
+"""Поиск пользователей по началу имени (для начала личного чата).
+
+Поиск без учёта регистра: префикс превращается в диапазон
+``LOWER(prefix) <= LOWER(username) < LOWER(prefix) + U+10FFFF`` по
+функциональному индексу ``LOWER(username)`` (миграция 0015). СУБД читает
+из индекса только совпадения, а не всю таблицу, как ``istartswith``
+(UPPER(...) LIKE индекс не использует). Обе стороны приводит к нижнему
+регистру сама СУБД, чтобы они совпадали с индексом (LOWER в SQLite меняет
+только ASCII). Страницы — по ключу (последнее имя предыдущей страницы) в
+порядке ``(LOWER(username), username)``, без OFFSET.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q, Value
+from django.db.models.functions import Lower
+
+# Больше любого символа, который может стоять в имени после префикса
+PREFIX_END = '\U0010ffff'
+MAX_PREFIX = 150
+
+
+def page_size():
+    return getattr(settings, 'CHAT_USER_SEARCH_PAGE_SIZE', 20)
+
+
+def serialize_user(user):
+    profile = getattr(user, 'userprofile', None)
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar_url': profile.get_avatar_url() if profile else None,
+        'likes': profile.likes_received if profile else 0,
+    }
+
+
+def search_users(prefix, exclude_id=None, after=None, limit=None):
+    """Страница пользователей с именем на prefix после имени after.
+
+    Возвращает ``{'users': [...], 'next': ключ следующей страницы или None}``.
+    """
+    limit = limit or page_size()
+    prefix = prefix[:MAX_PREFIX]
+    users = User.objects.filter(is_active=True).annotate(username_lower=Lower('username'))
+    if prefix:
+        lowered = Lower(Value(prefix))
+        # startswith — для collation, где диапазон шире префикса; отбор всё равно идёт по индексу
+        users = users.filter(
+            username_lower__gte=lowered,
+            username_lower__lt=Lower(Value(prefix + PREFIX_END)),
+            username_lower__startswith=lowered,
+        )
+    if after:
+        after_lower = Lower(Value(after))
+        users = users.filter(Q(username_lower__gt=after_lower) | Q(username_lower=after_lower, username__gt=after))
+    if exclude_id is not None:
+        users = users.exclude(id=exclude_id)
+    page = list(
+        users.select_related('userprofile')
+        .only('id', 'username', 'userprofile__avatar', 'userprofile__avatar_variants', 'userprofile__likes_received')
+        .order_by('username_lower', 'username')[:limit + 1]
+    )
+    more = len(page) > limit
+    page = page[:limit]
+    return {
+        'users': [serialize_user(user) for user in page],
+        'next': page[-1].username if more else None,
+    }
@@ -0,0 +1,130 @@
+# chat/history.py
+"""История сообщений с keyset-пагинацией.
+
+Страница — последние N сообщений до курсора; курсор кодирует пару
+``(timestamp, id)`` последнего (самого раннего) сообщения страницы, поэтому
+переход на следующую страницу не зависит от глубины истории (без OFFSET).
+Тот же курсор продолжает историю в холодном архиве (history_page).
+"""
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .db import db_sync_to_async
+from .models import GroupMessage, Message, PrivateMessage
+from .wire import encode_frame
+
+HISTORY_GENERAL = 'general'
+HISTORY_PRIVATE = 'private'
+HISTORY_GROUP = 'group'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size():
+    return getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+
+
+def encode_cursor(message):
+    return encode_position(message.timestamp, message.id)
+
+
+def encode_position(timestamp, message_id):
+    raw = f'{timestamp.isoformat()}|{message_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        timestamp = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    if timestamp is None:
+        raise InvalidCursor(cursor)
+    return timestamp, message_id
+
+
+def history_queryset(kind, conversation_id=None):
+    """Сообщения разговора с отправителем и профилем (для аватарки)"""
+    if kind == HISTORY_GENERAL:
+        return Message.objects.select_related('user', 'user__userprofile')
+    if kind == HISTORY_PRIVATE:
+        return PrivateMessage.objects.filter(chat_id=conversation_id).select_related('sender', 'sender__userprofile')
+    if kind == HISTORY_GROUP:
+        return GroupMessage.objects.filter(group_id=conversation_id).select_related('sender', 'sender__userprofile')
+    raise ValueError(f'Неизвестный тип истории: {kind}')
+
+
+def message_page(queryset, cursor=None, limit=None):
+    """Вернуть (сообщения от старых к новым, курсор следующей страницы или None)"""
+    limit = limit or page_size()
+    queryset = queryset.order_by('-timestamp', '-id')
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+    rows = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, next_cursor
+
+
+def serialize_message(message):
+    sender = message.user if isinstance(message, Message) else message.sender
+    profile = getattr(sender, 'userprofile', None)
+    return {
+        'id': message.id,
+        'message': message.content,
+        'user_id': sender.id,
+        'username': sender.username,
+        'avatar_url': profile.get_avatar_url() if profile else None,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def history_page(kind, conversation_id=None, cursor=None, limit=None):
+    """Страница истории с дочитыванием из холодного архива (chat.archive).
+
+    Архивные сообщения старше всех горячих, поэтому архив читается, только
+    когда горячие сообщения до курсора закончились.
+    """
+    from .archive import archived_page
+
+    limit = limit or page_size()
+    rows, next_cursor = message_page(history_queryset(kind, conversation_id), cursor, limit)
+    if next_cursor is None:
+        if rows:
+            position = (rows[0].timestamp, rows[0].id)
+        else:
+            position = decode_cursor(cursor) if cursor else None
+        older, has_more = archived_page(kind, conversation_id, position, limit - len(rows))
+        rows = older + rows
+        if has_more:
+            next_cursor = encode_cursor(rows[0])
+    return rows, next_cursor
+
+
+def get_history(kind, conversation_id=None, cursor=None, limit=None):
+    """Страница истории в виде, пригодном для JSON"""
+    rows, next_cursor = history_page(kind, conversation_id, cursor, limit)
+    return {
+        'messages': [serialize_message(message) for message in rows],
+        'next_cursor': next_cursor,
+    }
+
+
+async def history_frame(kind, conversation_id=None, cursor=None):
+    """Кадр WebSocket с ответом на запрос ``history``"""
+    try:
+        history = await db_sync_to_async(get_history)(kind, conversation_id, cursor)
+    except InvalidCursor:
+        return encode_frame({'type': 'error', 'error': 'Некорректный курсор истории'})
+    return encode_frame(dict(history, type='history'))
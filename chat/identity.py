@@ -0,0 +1,86 @@
+# chat/identity.py
+"""Кэш «кто говорит» для консьюмеров: имя, URL аватарки и id профиля.
+
+Ключ — id пользователя. Записи вытесняются по LRU и устаревают по TTL,
+а при сохранении/удалении UserProfile сбрасываются сигналами (chat/signals.py).
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .db import db_sync_to_async
+
+Identity = namedtuple('Identity', ['user_id', 'username', 'avatar_url', 'profile_id'])
+
+
+class IdentityCache:
+    """Потокобезопасный LRU-кэш с TTL"""
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize or getattr(settings, 'CHAT_IDENTITY_CACHE_SIZE', 10000)
+        self.ttl = ttl or getattr(settings, 'CHAT_IDENTITY_CACHE_TTL', 300)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+            identity, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return identity
+
+    def set(self, identity):
+        with self._lock:
+            self._data[identity.user_id] = (identity, time.monotonic() + self.ttl)
+            self._data.move_to_end(identity.user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+identity_cache = IdentityCache()
+
+
+def load_identity(user):
+    """Прочитать данные пользователя из БД (один запрос к профилю)"""
+    from .models import UserProfile
+
+    avatar_url = None
+    profile_id = None
+    profile = UserProfile.objects.filter(user_id=user.id).only('id', 'avatar', 'avatar_variants').first()
+    if profile is not None:
+        profile_id = profile.id
+        avatar_url = profile.get_avatar_url()
+    return Identity(user.id, user.username, avatar_url, profile_id)
+
+
+def get_identity_sync(user):
+    """Получить данные пользователя из кэша или из БД"""
+    identity = identity_cache.get(user.id)
+    if identity is None:
+        identity = load_identity(user)
+        identity_cache.set(identity)
+    return identity
+
+
+async def get_identity(user):
+    """Асинхронный вариант: при попадании в кэш обходится без похода в поток БД"""
+    identity = identity_cache.get(user.id)
+    if identity is None:
+        identity = await db_sync_to_async(load_identity)(user)
+        identity_cache.set(identity)
+    return identity
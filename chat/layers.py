@@ -0,0 +1,508 @@
+# chat/layers.py
+"""Channel layer на основе pub/sub для нескольких процессов daphne.
+
+Каждый процесс держит одну подписку брокера на комнату (группу) и сам
+раздаёт сообщение своим локальным сокетам. Поэтому ``group_send`` в
+``chat_general`` стоит одну публикацию, которую брокер доставляет по
+разу в каждый процесс, — O(процессов), а не O(подключённых клиентов).
+
+Брокеры:
+    ``local`` — внутри процесса; заменитель Redis для разработки и тестов.
+        Несколько экземпляров слоя в одном процессе ведут себя как
+        отдельные процессы, подписанные на общий брокер.
+    ``redis`` — Redis PUBLISH/SUBSCRIBE (нужен пакет ``redis``).
+
+Расширение ``recent``: брокер хранит последние сообщения группы с
+монотонными номерами (seq) — общий для всех процессов кольцевой буфер
+(chat/recent.py). Буферов не больше ``recent_rooms`` (local, вытесняются
+давно не использованные), в Redis их ключи живут ``recent_ttl`` секунд
+после последнего сообщения.
+
+Расширение ``presence``: брокер хранит число сокетов каждого пользователя
+в каждом процессе и возвращает сумму по живым процессам и список
+участников с сокетами хотя бы в одном из них (chat/presence.py).
+Процесс, который не подтверждал себя дольше ttl (упал), не учитывается.
+
+Очередь есть только у открытого канала: ``new_channel`` или ``receive``.
+Канал, который дольше expiry никто не читает (сокет закрыт), удаляется
+вместе с членством в группах; членство старше ``group_expiry`` истекает,
+как в стандартных слоях.
+"""
+import asyncio
+import logging
+import random
+import string
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker:
+    """Брокер внутри процесса"""
+
+    # Общий для всех экземпляров реестр: топик -> подписчики
+    _subscribers = defaultdict(set)
+    # Кольцевые буферы групп: ключ -> [последний seq, deque((seq, текст))], от давно не использованных
+    _recent = OrderedDict()
+    # Счётчики присутствия: ключ -> {процесс: {участник: число сокетов}}
+    _presence = {}
+
+    def __init__(self, recent_rooms=10000, **kwargs):
+        self._own = set()
+        self.recent_rooms = recent_rooms
+
+    async def subscribe(self, topic, callback):
+        self._subscribers[topic].add(callback)
+        self._own.add((topic, callback))
+
+    async def unsubscribe(self, topic, callback):
+        self._subscribers[topic].discard(callback)
+        self._own.discard((topic, callback))
+        if not self._subscribers[topic]:
+            self._subscribers.pop(topic, None)
+
+    async def publish(self, topic, payload):
+        for callback in list(self._subscribers.get(topic, ())):
+            callback(payload)
+
+    async def append_recent(self, key, text, size):
+        entry = self._recent.get(key)
+        if entry is None:
+            entry = self._recent[key] = [0, deque(maxlen=size)]
+            # Комнат за жизнь процесса сколько угодно: буферы давно молчащих вытесняются
+            while len(self._recent) > self.recent_rooms:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(key)
+        entry[0] += 1
+        entry[1].append((entry[0], text))
+        return entry[0]
+
+    async def recent(self, key):
+        entry = self._recent.get(key)
+        if entry is None:
+            return 0, []
+        self._recent.move_to_end(key)
+        return entry[0], list(entry[1])
+
+    async def presence_change(self, key, process, member, delta, ttl):
+        processes = self._presence.setdefault(key, {})
+        counts = processes.setdefault(process, {})
+        counts[member] = counts.get(member, 0) + delta
+        if counts[member] <= 0:
+            del counts[member]
+        return sum(counts.get(member, 0) for counts in processes.values())
+
+    async def presence_refresh(self, key, process, ttl):
+        # Процессы одного брокера живут и падают вместе — истекать нечему
+        pass
+
+    async def presence_members(self, key, ttl):
+        members = set()
+        for counts in self._presence.get(key, {}).values():
+            members.update(member for member, count in counts.items() if count > 0)
+        return members
+
+    async def close(self):
+        for topic, callback in list(self._own):
+            await self.unsubscribe(topic, callback)
+
+
+# Номер и запись в буфер — одна атомарная операция, поэтому порядок в списке совпадает с seq.
+# Ключи молчащей комнаты истекают; seq начнётся заново, и клиенты со старыми номерами получат resync
+APPEND_RECENT_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[2], seq .. ':' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+
+# KEYS[1] — ZSET процессов по времени подтверждения, KEYS[2] — префикс хешей процессов
+PRESENCE_CHANGE_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+local ttl = tonumber(ARGV[4])
+local own = KEYS[2] .. ARGV[1]
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+if redis.call('HINCRBY', own, ARGV[2], ARGV[3]) <= 0 then
+    redis.call('HDEL', own, ARGV[2])
+end
+redis.call('EXPIRE', own, ttl)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+local total = 0
+for _, process in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    total = total + tonumber(redis.call('HGET', KEYS[2] .. process, ARGV[2]) or 0)
+end
+return total
+"""
+
+PRESENCE_REFRESH_SCRIPT = """
+redis.call('ZADD', KEYS[1], tonumber(redis.call('TIME')[1]), ARGV[1])
+redis.call('EXPIRE', KEYS[2] .. ARGV[1], tonumber(ARGV[2]))
+"""
+
+# Участники с сокетами хотя бы в одном живом процессе
+PRESENCE_MEMBERS_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[1]))
+local seen, members = {}, {}
+for _, process in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local counts = redis.call('HGETALL', KEYS[2] .. process)
+    for i = 1, #counts, 2 do
+        if tonumber(counts[i + 1]) > 0 and not seen[counts[i]] then
+            seen[counts[i]] = true
+            members[#members + 1] = counts[i]
+        end
+    end
+end
+return members
+"""
+
+
+class RedisBroker:
+    """Брокер на Redis pub/sub: одно соединение на публикацию и одно на подписки"""
+
+    reconnect_delay = 1.0
+
+    def __init__(self, url=None, recent_ttl=86400, **kwargs):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImproperlyConfigured("Для брокера 'redis' установите пакет redis")
+        self._redis = redis.from_url(url or 'redis://localhost:6379/0')
+        self.recent_ttl = recent_ttl
+        self._append_recent = self._redis.register_script(APPEND_RECENT_SCRIPT)
+        self._presence_change = self._redis.register_script(PRESENCE_CHANGE_SCRIPT)
+        self._presence_refresh = self._redis.register_script(PRESENCE_REFRESH_SCRIPT)
+        self._presence_members = self._redis.register_script(PRESENCE_MEMBERS_SCRIPT)
+        self._pubsub = None
+        self._reader = None
+        self._callbacks = {}
+
+    async def subscribe(self, topic, callback):
+        self._callbacks[topic] = callback
+        await self._ensure_reader()
+        await self._pubsub.subscribe(topic)
+
+    async def unsubscribe(self, topic, callback):
+        if self._callbacks.pop(topic, None) is not None and self._pubsub is not None:
+            await self._pubsub.unsubscribe(topic)
+
+    async def publish(self, topic, payload):
+        await self._redis.publish(topic, payload)
+
+    async def append_recent(self, key, text, size):
+        return int(await self._append_recent(keys=[f'{key}:seq', key], args=[text, size, self.recent_ttl]))
+
+    async def recent(self, key):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            seq, items = await pipe.get(f'{key}:seq').lrange(key, 0, -1).execute()
+        entries = []
+        for item in items:
+            number, text = item.decode().split(':', 1)
+            entries.append((int(number), text))
+        return int(seq or 0), entries
+
+    async def presence_change(self, key, process, member, delta, ttl):
+        keys = [f'{key}:processes', f'{key}:process:']
+        return int(await self._presence_change(keys=keys, args=[process, member, delta, ttl]))
+
+    async def presence_refresh(self, key, process, ttl):
+        await self._presence_refresh(keys=[f'{key}:processes', f'{key}:process:'], args=[process, ttl])
+
+    async def presence_members(self, key, ttl):
+        members = await self._presence_members(keys=[f'{key}:processes', f'{key}:process:'], args=[ttl])
+        return {member.decode() for member in members}
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        await self._redis.aclose()
+
+    async def _ensure_reader(self):
+        if self._pubsub is None:
+            self._pubsub = self._redis.pubsub()
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.05)
+                    continue
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                topic = message['channel']
+                if isinstance(topic, bytes):
+                    topic = topic.decode()
+                callback = self._callbacks.get(topic)
+                if callback is not None:
+                    callback(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка чтения из Redis pub/sub, переподключаемся")
+                await asyncio.sleep(self.reconnect_delay)
+                await self._resubscribe()
+
+    async def _resubscribe(self):
+        try:
+            await self._pubsub.aclose()
+        except Exception:
+            pass
+        self._pubsub = self._redis.pubsub()
+        if self._callbacks:
+            try:
+                await self._pubsub.subscribe(*self._callbacks)
+            except Exception:
+                logger.exception("Не удалось восстановить подписки Redis")
+
+
+BROKERS = {
+    'local': LocalBroker,
+    'redis': RedisBroker,
+}
+
+
+class PubSubChannelLayer(BaseChannelLayer):
+    """Channel layer с одной подпиской на группу в процессе и локальной раздачей"""
+
+    extensions = ['groups', 'flush', 'recent', 'presence']
+
+    # Не чаще раза в столько секунд ищем закрытые каналы и истёкшие группы
+    clean_interval = 1.0
+
+    def __init__(self, broker='local', url=None, prefix='chat', expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        if broker not in BROKERS:
+            raise ImproperlyConfigured(f"Неизвестный брокер channel layer: {broker}")
+        self.broker = BROKERS[broker](url=url, **kwargs)
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        # Уникальный id процесса: в него адресуются сообщения конкретным каналам
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self.channels = {}      # канал -> очередь
+        self.groups = {}        # группа -> {канал: время добавления}
+        self._receivers = {}    # канал -> число ожидающих receive()
+        self._seen = {}         # канал -> когда его последний раз читали (monotonic)
+        self._next_clean = 0
+        self._subscriptions = {}
+        self.dropped = 0    # сообщений пропущено из-за переполненных очередей
+
+    # Топики брокера
+
+    def _group_topic(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    def _process_topic(self, client_prefix):
+        return f'{self.prefix}:process:{client_prefix}'
+
+    def _channel_topic(self, channel):
+        return f'{self.prefix}:channel:{channel}'
+
+    async def _subscribe(self, topic, callback):
+        if topic in self._subscriptions:
+            return
+        self._subscriptions[topic] = callback
+        await self.broker.subscribe(topic, callback)
+
+    async def _unsubscribe(self, topic):
+        callback = self._subscriptions.pop(topic, None)
+        if callback is not None:
+            await self.broker.unsubscribe(topic, callback)
+
+    # Локальная доставка
+
+    def _open(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        self._seen[channel] = time.monotonic()
+        return queue
+
+    def _deliver(self, channel, message):
+        # Только в открытые каналы: для закрытого сокета очередь не создаётся
+        queue = self.channels.get(channel)
+        if queue is None:
+            logger.debug("Канал %s не открыт в этом процессе, сообщение пропущено", channel)
+            return
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    async def _clean_expired(self):
+        """Удалить каналы, которые дольше expiry никто не читает, и членство старше group_expiry"""
+        now = time.monotonic()
+        if now < self._next_clean:
+            return
+        self._next_clean = now + self.clean_interval
+        for channel in list(self.channels):
+            if channel not in self._receivers and now - self._seen.get(channel, 0) > self.expiry:
+                del self.channels[channel]
+                self._seen.pop(channel, None)
+                if '!' not in channel:
+                    await self._unsubscribe(self._channel_topic(channel))
+        joined_before = time.time() - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined in list(members.items()):
+                if channel not in self.channels or joined < joined_before:
+                    del members[channel]
+            if not members and self.groups.get(group) is members:
+                del self.groups[group]
+                await self._unsubscribe(self._group_topic(group))
+
+    def _deliver_group(self, group, message):
+        # Все локальные сокеты получают один и тот же объект события — консьюмеры его не изменяют
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self._deliver(channel, message)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                logger.debug("Канал %s переполнен, сообщение группы %s пропущено", channel, group)
+
+    def _on_group_payload(self, group):
+        def callback(payload):
+            data = msgpack.unpackb(payload, raw=False)
+            if data['origin'] != self.client_prefix:
+                self._deliver_group(group, data['message'])
+        return callback
+
+    def _on_channel_payload(self, payload):
+        data = msgpack.unpackb(payload, raw=False)
+        try:
+            self._deliver(data['channel'], data['message'])
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.debug("Канал %s переполнен, сообщение пропущено", data['channel'])
+
+    def _is_local(self, channel):
+        return '!' in channel and self.non_local_name(channel)[:-1].endswith(self.client_prefix)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        await self._clean_expired()
+        await self._subscribe(self._process_topic(self.client_prefix), self._on_channel_payload)
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        channel = f'{prefix}.{self.client_prefix}!{suffix}'
+        self._open(channel)
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if self._is_local(channel):
+            try:
+                self._deliver(channel, message)
+            except asyncio.QueueFull:
+                raise ChannelFull(channel)
+            return
+        if '!' in channel:
+            client_prefix = self.non_local_name(channel)[:-1].rsplit('.', 1)[-1]
+            topic = self._process_topic(client_prefix)
+        else:
+            topic = self._channel_topic(channel)
+        await self.broker.publish(topic, msgpack.packb({'channel': channel, 'message': message}, use_bin_type=True))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self._clean_expired()
+        if '!' not in channel:
+            await self._subscribe(self._channel_topic(channel), self._on_channel_payload)
+        queue = self._open(channel)
+        self._receivers[channel] = self._receivers.get(channel, 0) + 1
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            # Канал жив, пока его читают; после последнего чтения у него есть expiry
+            waiting = self._receivers.pop(channel, 1) - 1
+            if waiting:
+                self._receivers[channel] = waiting
+            if self.channels.get(channel) is queue:
+                self._seen[channel] = time.monotonic()
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._clean_expired()
+        self.groups.setdefault(group, {})[channel] = time.time()
+        await self._subscribe(self._group_topic(group), self._on_group_payload(group))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.groups[group]
+            await self._unsubscribe(self._group_topic(group))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._clean_expired()
+        # Свои сокеты получают сообщение сразу, остальные процессы — через брокер
+        self._deliver_group(group, message)
+        payload = msgpack.packb({'origin': self.client_prefix, 'message': message}, use_bin_type=True)
+        await self.broker.publish(self._group_topic(group), payload)
+
+    # Расширение recent
+
+    async def append_recent(self, group, text, size):
+        """Дописать кадр в буфер группы (хранятся последние size) и вернуть его seq"""
+        self.require_valid_group_name(group)
+        return await self.broker.append_recent(f'{self.prefix}:recent:{group}', text, size)
+
+    async def recent(self, group):
+        """(последний seq группы, [(seq, кадр)] от старых к новым)"""
+        self.require_valid_group_name(group)
+        return await self.broker.recent(f'{self.prefix}:recent:{group}')
+
+    # Расширение presence
+
+    async def presence_change(self, group, member, delta, ttl):
+        """Изменить число сокетов member в этом процессе и вернуть сумму по живым процессам"""
+        self.require_valid_group_name(group)
+        return await self.broker.presence_change(
+            f'{self.prefix}:presence:{group}', self.client_prefix, str(member), delta, ttl,
+        )
+
+    async def presence_refresh(self, group, ttl):
+        """Подтвердить, что процесс жив: без подтверждения его счётчики через ttl не учитываются"""
+        self.require_valid_group_name(group)
+        await self.broker.presence_refresh(f'{self.prefix}:presence:{group}', self.client_prefix, ttl)
+
+    async def presence_members(self, group, ttl):
+        """Участники, у которых есть сокеты хотя бы в одном живом процессе"""
+        self.require_valid_group_name(group)
+        return await self.broker.presence_members(f'{self.prefix}:presence:{group}', ttl)
+
+    async def flush(self):
+        for topic in list(self._subscriptions):
+            await self._unsubscribe(topic)
+        self.channels = {}
+        self.groups = {}
+        self._seen = {}
+
+    async def close(self):
+        await self.flush()
+        await self.broker.close()
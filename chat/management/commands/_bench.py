@@ -0,0 +1,103 @@
+# chat/management/commands/_bench.py
+"""Общие помощники для команд bench_*"""
+import json
+import os
+import resource
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) по отсортированной копии значений"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    """p50/p99/среднее в миллисекундах для списка длительностей в секундах"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(values) * 1000, 3),
+    }
+
+
+def timed(fn, repeat):
+    """Выполнить fn repeat раз и вернуть список длительностей"""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def rss_bytes(pid=None):
+    """Текущий RSS процесса (Linux), иначе пиковый из getrusage (только для своего процесса)"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if pid is not None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_json(result, path, stdout):
+    """Вывести результат в JSON: в файл, если он задан, иначе в stdout"""
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write(text)
+    else:
+        stdout.write(text)
+
+
+def _same_database(first, second):
+    keys = ('ENGINE', 'HOST', 'PORT', 'NAME')
+    return all(str(first.get(key) or '') == str(second.get(key) or '') for key in keys)
+
+
+def require_scratch_database(alias, prefix):
+    """Проверить, что alias — отдельная БД для бенчмарка: не default и без чужих данных.
+
+    Бенчмарки заполняют таблицы миллионами строк, меняют индексы и в конце
+    очищают БД целиком, поэтому рабочая БД им не подходит. Годится пустая
+    БД после migrate или оставшаяся от прошлого запуска с ``--keep``.
+    """
+    if alias not in connections.settings:
+        raise CommandError(f'БД {alias} не настроена: задайте CHAT_BENCH_DB и выполните migrate --database {alias}')
+    if alias == DEFAULT_DB_ALIAS or _same_database(
+        connections.settings[alias], connections.settings[DEFAULT_DB_ALIAS],
+    ):
+        raise CommandError('Бенчмарк не запускается на рабочей БД: укажите отдельную через --database')
+    if User.objects.using(alias).exclude(username__startswith=prefix).exists():
+        raise CommandError(f'В БД {alias} есть данные не от бенчмарка: нужна пустая БД')
+
+
+def serve_from(alias):
+    """Направить default на alias в этом процессе (после require_scratch_database).
+
+    Для кода, который пишет через ORM без using(): консьюмеров, сессий,
+    очереди записи. Соединения других потоков открываются позже и берут
+    уже подменённые настройки.
+    """
+    connections[DEFAULT_DB_ALIAS].close()
+    connections.settings[DEFAULT_DB_ALIAS] = connections.settings[alias]
+    del connections[DEFAULT_DB_ALIAS]
+
+
+def clear_database(alias):
+    """Удалить все строки БД, проверенной require_scratch_database"""
+    call_command('flush', database=alias, interactive=False, verbosity=0)
@@ -0,0 +1,147 @@
+# chat/management/commands/_loadclient.py
+"""Клиенты WebSocket для команды loadtest.
+
+``InProcessClient`` — консьюмер в этом же процессе через WebsocketCommunicator.
+``SocketClient`` — настоящий сокет к daphne: минимальный клиент RFC 6455
+на asyncio (только текстовые кадры), без сторонних зависимостей.
+
+Общий интерфейс: ``connect() -> bool``, ``send_text(text)``,
+``next_text() -> str | None`` (None — соединение закрыто), ``close()``.
+"""
+import asyncio
+import base64
+import os
+import struct
+from urllib.parse import urlsplit
+
+from channels.testing import WebsocketCommunicator
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class InProcessClient:
+    def __init__(self, application, path, user):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.communicator.scope['user'] = user
+
+    async def connect(self, timeout=30):
+        connected, _ = await self.communicator.connect(timeout)
+        return connected
+
+    async def send_text(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def next_text(self):
+        # Читаем очередь напрямую: отмена receive_output() убила бы приложение
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] == 'websocket.send' and message.get('text') is not None:
+                return message['text']
+            if message['type'] == 'websocket.close':
+                return None
+
+    async def close(self):
+        try:
+            await self.communicator.disconnect()
+        except Exception:
+            pass
+
+
+def _mask(data, key):
+    length = len(data)
+    repeated = (key * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+
+
+class SocketClient:
+    def __init__(self, url, path, cookie=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 80
+        self.path = path
+        self.cookie = cookie
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, timeout=30):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        headers = [
+            f'GET {self.path} HTTP/1.1',
+            f'Host: {self.host}:{self.port}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key}',
+            'Sec-WebSocket-Version: 13',
+            f'Origin: http://{self.host}:{self.port}',
+        ]
+        if self.cookie:
+            headers.append(f'Cookie: {self.cookie}')
+        self.writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+        response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        status = response.split(b'\r\n', 1)[0]
+        if b' 101 ' not in status:
+            await self.close()
+            return False
+        return True
+
+    async def send_text(self, text):
+        self._write_frame(OP_TEXT, text.encode())
+        await self.writer.drain()
+
+    async def next_text(self):
+        fragments = []
+        while True:
+            try:
+                opcode, payload, fin = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+            if opcode == OP_PING:
+                self._write_frame(OP_PONG, payload)
+            elif opcode == OP_CLOSE:
+                return None
+            elif opcode in (OP_TEXT, OP_CONTINUATION):
+                fragments.append(payload)
+                if fin:
+                    return b''.join(fragments).decode()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self._write_frame(OP_CLOSE, struct.pack('!H', 1000))
+            await self.writer.drain()
+            self.writer.close()
+        except (ConnectionError, RuntimeError):
+            pass
+        self.writer = None
+
+    def _write_frame(self, opcode, payload):
+        # Кадры клиента обязаны быть замаскированы
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        key = os.urandom(4)
+        self.writer.write(header + key + _mask(payload, key))
+
+    async def _read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self.reader.readexactly(8))
+        key = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if key:
+            payload = _mask(payload, key)
+        return first & 0x0F, payload, bool(first & 0x80)
@@ -0,0 +1,80 @@
+# chat/management/commands/archive_messages.py
+"""Перенести старые сообщения в холодный архив (chat/archive.py).
+
+Работает порциями: каждая порция — короткая транзакция, между порциями
+пауза, чтобы чат продолжал писать сообщения. Сегменты пишутся в хранилище
+STORAGES[CHAT_ARCHIVE_STORAGE]; на локальный диск (FileSystemStorage) —
+только с ``--local-storage``, если диск долговременный и узел один.
+
+    python manage.py archive_messages                     # старше CHAT_ARCHIVE_AFTER_DAYS
+    python manage.py archive_messages --older-than 90 --chunk 500 --max-chunks 100
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.archive import ARCHIVE_KINDS, ArchiveConflict, archive_chunk, archive_storage
+
+
+class Command(BaseCommand):
+    help = 'Перенести сообщения старше заданного возраста в сжатые месячные сегменты архива'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='дней (по умолчанию CHAT_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--kind', choices=list(ARCHIVE_KINDS), action='append', help='только этот тип чата')
+        parser.add_argument('--chunk', type=int, default=1000, help='сообщений в одной транзакции')
+        parser.add_argument('--pause', type=float, default=0.05, help='секунды между порциями')
+        parser.add_argument('--max-chunks', type=int, help='остановиться после стольких порций')
+        parser.add_argument('--dry-run', action='store_true', help='только посчитать сообщения')
+        parser.add_argument('--local-storage', action='store_true',
+                            help='разрешить хранилище на локальном диске (долговременном, один узел)')
+
+    def handle(self, *args, **options):
+        days = options['older_than']
+        if days is None:
+            days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+        cutoff = timezone.now() - timedelta(days=days)
+        kinds = options['kind'] or list(ARCHIVE_KINDS)
+
+        if options['dry_run']:
+            for kind in kinds:
+                model = ARCHIVE_KINDS[kind][0]
+                self.stdout.write(f"{kind}: {model.objects.filter(timestamp__lt=cutoff).count()} сообщений до {cutoff:%Y-%m-%d}")
+            return
+
+        try:
+            storage = archive_storage()
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        if isinstance(storage, FileSystemStorage) and not options['local_storage']:
+            raise CommandError(
+                f'Хранилище архива — локальный диск ({storage.location}): сообщения из БД удаляются, '
+                'а диск контейнера теряется и не виден другим узлам. Если он долговременный и узел один, '
+                'добавьте --local-storage'
+            )
+        try:
+            self.archive(kinds, cutoff, options)
+        except ArchiveConflict:
+            raise CommandError('Архивация уже идёт в другом процессе')
+
+    def archive(self, kinds, cutoff, options):
+        verbose = options['verbosity'] >= 2
+        chunks = 0
+        for kind in kinds:
+            archived = 0
+            started = time.perf_counter()
+            while options['max_chunks'] is None or chunks < options['max_chunks']:
+                count = archive_chunk(kind, cutoff, options['chunk'])
+                if not count:
+                    break
+                archived += count
+                chunks += 1
+                if verbose:
+                    self.stdout.write(f"  {kind}: +{count}")
+                time.sleep(options['pause'])
+            self.stdout.write(f"{kind}: в архив {archived} сообщений за {time.perf_counter() - started:.1f} с")
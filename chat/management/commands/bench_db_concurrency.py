@@ -0,0 +1,123 @@
+# chat/management/commands/bench_db_concurrency.py
+"""Бенчмарк параллельных запросов к БД из асинхронного кода.
+
+Моделирует обработчики ``receive`` многих сокетов одного процесса: каждый
+делает запрос к БД (как загрузка имени отправителя или проверка доступа).
+Сравниваются три способа выйти из цикла событий:
+
+    thread_sensitive — sync_to_async по умолчанию (один общий поток);
+    async_orm        — асинхронный ORM Django (afirst), внутри тот же поток;
+    db_pool          — db_sync_to_async, пул из CHAT_DB_WORKERS потоков.
+
+``--query-delay`` добавляет к каждому запросу задержку (мс) — сетевое время
+до сервера БД, которого нет у SQLite на локальном диске.
+
+    python manage.py bench_db_concurrency --levels 1,8,32,64 --query-delay 2 --json db.json
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from chat.db import db_sync_to_async
+
+from ._bench import summarize, write_json
+
+MODES = ('thread_sensitive', 'async_orm', 'db_pool')
+
+
+def user_query(user_id):
+    return User.objects.filter(pk=user_id).values_list('username', flat=True)
+
+
+def load_username(user_id):
+    return user_query(user_id).first()
+
+
+def delay_queries(seconds):
+    """Обработчик connection_created: задержка перед каждым запросом нового соединения"""
+
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        # Объект соединения потока переживает переподключения — обёртка ставится один раз
+        if delay not in connection.execute_wrappers:
+            connection.execute_wrappers.append(delay)
+
+    return install
+
+
+class Command(BaseCommand):
+    help = 'Замерить пропускную способность параллельных запросов к БД из асинхронного кода'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--levels', default='1,4,16,64', help='число одновременных обработчиков через запятую')
+        parser.add_argument('--requests', type=int, default=2000, help='запросов на каждый уровень')
+        parser.add_argument('--query-delay', type=float, default=0.0, help='задержка запроса, мс')
+        parser.add_argument('--modes', default=','.join(MODES))
+        parser.add_argument('--json', dest='json_path', help='записать результат в файл')
+
+    def handle(self, *args, **options):
+        modes = options['modes'].split(',')
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f"Неизвестные режимы: {', '.join(sorted(unknown))}")
+        levels = [int(level) for level in options['levels'].split(',')]
+        user_id = User.objects.values_list('pk', flat=True).first()
+        if user_id is None:
+            raise CommandError('Нужен хотя бы один пользователь в БД')
+
+        if options['query_delay']:
+            install = delay_queries(options['query_delay'] / 1000)
+            connection_created.connect(install, weak=False)
+            # Соединения, уже открытые в этом потоке, сигнала не получат
+            connection.close()
+
+        result = {
+            'database': connection.vendor,
+            'db_workers': getattr(settings, 'CHAT_DB_WORKERS', 8),
+            'query_delay_ms': options['query_delay'],
+            'requests': options['requests'],
+            'modes': {},
+        }
+        self.stdout.write(f"{'режим':>16} {'обработчиков':>13} {'запросов/с':>11} {'p50, мс':>9} {'p99, мс':>9}")
+        for mode in modes:
+            result['modes'][mode] = {}
+            for level in levels:
+                data = asyncio.run(self.run_level(mode, level, options['requests'], user_id))
+                result['modes'][mode][level] = data
+                self.stdout.write(
+                    f"{mode:>16} {level:>13} {data['per_second']:>11} "
+                    f"{data['latency']['p50_ms']:>9} {data['latency']['p99_ms']:>9}"
+                )
+        write_json(result, options['json_path'], self.stdout)
+
+    async def run_level(self, mode, concurrency, requests, user_id):
+        if mode == 'thread_sensitive':
+            query = sync_to_async(load_username)
+        elif mode == 'db_pool':
+            query = db_sync_to_async(load_username)
+        else:
+            async def query(user_id):
+                return await user_query(user_id).afirst()
+
+        durations = []
+        remaining = iter(range(requests))
+
+        async def handler():
+            for _ in remaining:
+                started = time.perf_counter()
+                await query(user_id)
+                durations.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(handler() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        return {'per_second': round(requests / elapsed), 'latency': summarize(durations)}
@@ -0,0 +1,64 @@
+# chat/management/commands/bench_fanout.py
+"""Микробенчмарк стоимости рассылки одного сообщения в зависимости от числа сокетов.
+
+Сравнивает прежнюю схему (json.dumps в каждом получателе) с кадром,
+закодированным один раз у отправителя.
+
+    python manage.py bench_fanout --sockets 1 100 1000 5000
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.wire import encode_frame, ujson
+
+
+class Command(BaseCommand):
+    help = 'Стоимость рассылки сообщения по числу сокетов: кодирование в каждом получателе против одного раза'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, nargs='+', default=[1, 10, 100, 1000, 5000])
+        parser.add_argument('--messages', type=int, default=50, help='сообщений на замер')
+
+    def handle(self, *args, **options):
+        event = {
+            'type': 'group_message',
+            'message': 'Привет всем! Это сообщение средней длины для замера рассылки.',
+            'username': 'testuser',
+            'avatar_url': '/media/avatars/ggg.png',
+            'timestamp': '2025-12-16T08:44:00.000000+00:00',
+        }
+        sent = []
+        send = sent.append  # заменяет self.send: важна только стоимость подготовки кадра
+
+        self.stdout.write(f"ujson: {'да' if ujson is not None else 'нет (стандартный json)'}")
+        self.stdout.write(f"{'сокетов':>8} {'dumps в получателе, мкс':>26} {'кадр один раз, мкс':>20} {'ускорение':>10}")
+        for sockets in options['sockets']:
+            receivers = range(sockets)
+            messages = options['messages']
+
+            started = time.perf_counter()
+            for _ in range(messages):
+                for _ in receivers:
+                    send(json.dumps({
+                        'type': event['type'],
+                        'message': event['message'],
+                        'username': event['username'],
+                        'avatar_url': event.get('avatar_url'),
+                        'timestamp': event['timestamp'],
+                    }))
+                sent.clear()
+            per_receiver = (time.perf_counter() - started) / messages
+
+            started = time.perf_counter()
+            for _ in range(messages):
+                frame = {'type': event['type'], 'text': encode_frame(event)}
+                for _ in receivers:
+                    send(frame['text'])
+                sent.clear()
+            once = (time.perf_counter() - started) / messages
+
+            self.stdout.write(
+                f"{sockets:>8} {per_receiver * 1e6:>26.1f} {once * 1e6:>20.1f} {per_receiver / once:>9.1f}x"
+            )
@@ -0,0 +1,209 @@
+# chat/management/commands/bench_queries.py
+"""Бенчмарк горячих запросов к сообщениям: планы и задержки до/после индексов.
+
+Заполняет отдельную БД (``--database``, по умолчанию ``bench``; на рабочей
+команда не запускается) миллионами сообщений и замеряет запросы истории,
+непрочитанных и профиля. С ``--compare`` сначала временно удаляет индексы
+из Meta моделей (состояние до миграции 0006), замеряет, возвращает индексы
+и замеряет снова. В конце БД очищается, если не задан ``--keep``.
+
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py migrate --database bench
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py bench_queries --rows 1000000 --compare --json bench.json
+"""
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from chat.models import Group, GroupMembership, GroupMessage, Message, PrivateChat, PrivateMessage
+
+from ._bench import clear_database, require_scratch_database, summarize, timed, write_json
+
+MESSAGE_MODELS = (Message, PrivateMessage, GroupMessage)
+BENCH_PREFIX = 'bench_'
+
+
+class Command(BaseCommand):
+    help = 'Заполнить БД сообщениями и замерить планы и задержки горячих запросов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='bench', help='отдельная БД из DATABASES (не default)')
+        parser.add_argument('--rows', type=int, default=1000000, help='сообщений каждого типа')
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--chats', type=int, default=5000)
+        parser.add_argument('--groups', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=30, help='повторов каждого запроса')
+        parser.add_argument('--no-seed', action='store_true', help='использовать уже заполненные данные')
+        parser.add_argument('--compare', action='store_true', help='замерить без индексов и с индексами')
+        parser.add_argument('--json', dest='json_path', help='записать результат в файл')
+        parser.add_argument('--keep', action='store_true', help='не очищать БД (для повторного запуска с --no-seed)')
+
+    def handle(self, *args, **options):
+        self.db = options['database']
+        require_scratch_database(self.db, BENCH_PREFIX)
+        try:
+            self.benchmark(options)
+        finally:
+            if not options['keep']:
+                clear_database(self.db)
+
+    def benchmark(self, options):
+        if not options['no_seed']:
+            self.seed(options)
+        elif not User.objects.using(self.db).filter(username__startswith=BENCH_PREFIX).exists():
+            raise CommandError('Нет тестовых данных: запустите без --no-seed')
+
+        targets = self.pick_targets()
+        result = {'database': connections[self.db].vendor, 'targets': targets}
+        if options['compare']:
+            with self.without_indexes():
+                result['before'] = self.run_queries(targets, options['repeat'])
+        result['after' if options['compare'] else 'current'] = self.run_queries(targets, options['repeat'])
+
+        for phase in ('before', 'after', 'current'):
+            if phase not in result:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(phase))
+            for name, data in result[phase].items():
+                self.stdout.write(f"  {name}: p50={data['latency']['p50_ms']} мс p99={data['latency']['p99_ms']} мс")
+                for line in data['plan'].splitlines():
+                    self.stdout.write(f"      {line}")
+        write_json(result, options['json_path'], self.stdout)
+
+    # Заполнение
+
+    def seed(self, options):
+        rng = random.Random(42)
+        now = timezone.now()
+        span = timedelta(days=365).total_seconds()
+
+        self.stdout.write(f"Пользователи: {options['users']}")
+        User.objects.using(self.db).bulk_create(
+            [User(username=f'{BENCH_PREFIX}{i}', password='!') for i in range(options['users'])],
+            batch_size=1000, ignore_conflicts=True,
+        )
+        user_ids = list(User.objects.using(self.db).filter(username__startswith=BENCH_PREFIX).values_list('id', flat=True))
+
+        self.stdout.write(f"Личные чаты: {options['chats']}")
+        # Пара участников уникальна (ключ user_low/user_high)
+        pairs = set()
+        while len(pairs) < options['chats']:
+            pairs.add(tuple(sorted(rng.sample(user_ids, 2))))
+        chats = PrivateChat.objects.using(self.db).bulk_create(
+            [PrivateChat(user_low_id=low, user_high_id=high) for low, high in sorted(pairs)]
+        )
+        through = PrivateChat.participants.through
+        chat_pairs = {}
+        links = []
+        for chat in chats:
+            pair = (chat.user_low_id, chat.user_high_id)
+            chat_pairs[chat.id] = pair
+            links += [through(privatechat_id=chat.id, user_id=user_id) for user_id in pair]
+        through.objects.using(self.db).bulk_create(links, batch_size=5000)
+
+        self.stdout.write(f"Группы: {options['groups']}")
+        groups = Group.objects.using(self.db).bulk_create([
+            Group(name=f'{BENCH_PREFIX}group_{i}', creator_id=rng.choice(user_ids)) for i in range(options['groups'])
+        ])
+        group_members = {}
+        memberships = []
+        for group in groups:
+            members = rng.sample(user_ids, min(len(user_ids), 50))
+            group_members[group.id] = members
+            memberships += [GroupMembership(group_id=group.id, user_id=user_id) for user_id in members]
+        GroupMembership.objects.using(self.db).bulk_create(memberships, batch_size=5000)
+
+        def general(i):
+            return Message(user_id=rng.choice(user_ids), content=f'bench message {i}')
+
+        def private(i):
+            chat_id = rng.choice(chats).id
+            return PrivateMessage(
+                chat_id=chat_id, sender_id=rng.choice(chat_pairs[chat_id]),
+                content=f'bench private {i}',
+            )
+
+        def group(i):
+            group_id = rng.choice(groups).id
+            return GroupMessage(group_id=group_id, sender_id=rng.choice(group_members[group_id]), content=f'bench group {i}')
+
+        for model, factory in ((Message, general), (PrivateMessage, private), (GroupMessage, group)):
+            self.stdout.write(f"{model.__name__}: {options['rows']}")
+            for start in range(0, options['rows'], 10000):
+                objs = []
+                for i in range(start, min(start + 10000, options['rows'])):
+                    obj = factory(i)
+                    # Возрастающее время с небольшим шумом: как в живом чате
+                    obj.timestamp = now - timedelta(seconds=span * (1 - i / options['rows']) + rng.random())
+                    objs.append(obj)
+                with transaction.atomic(using=self.db):
+                    model.objects.using(self.db).bulk_create(objs)
+        self.analyze()
+
+    def analyze(self):
+        if connections[self.db].vendor in ('sqlite', 'postgresql'):
+            with connections[self.db].cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    # Замеры
+
+    def pick_targets(self):
+        """Чат, группа и пользователь самых свежих сообщений — типичная «живая» комната"""
+        db = self.db
+        chat_id = PrivateMessage.objects.using(db).order_by('-id').values_list('chat_id', flat=True).first()
+        return {
+            'chat_id': chat_id,
+            'group_id': GroupMessage.objects.using(db).order_by('-id').values_list('group_id', flat=True).first(),
+            'user_id': Message.objects.using(db).order_by('-id').values_list('user_id', flat=True).first(),
+            # Метка прочтения в паре десятков сообщений от конца чата
+            'watermark': PrivateMessage.objects.using(db).filter(chat_id=chat_id)
+            .order_by('-id').values_list('id', flat=True)[20:21].first(),
+        }
+
+    def queries(self, targets):
+        db = self.db
+        chat_id, group_id, user_id = targets['chat_id'], targets['group_id'], targets['user_id']
+        return {
+            'general_latest_page': Message.objects.using(db).order_by('-timestamp', '-id')[:50],
+            'private_latest_page': PrivateMessage.objects.using(db).filter(chat_id=chat_id).order_by('-timestamp', '-id')[:50],
+            'group_latest_page': GroupMessage.objects.using(db).filter(group_id=group_id).order_by('-timestamp', '-id')[:50],
+            'private_unread_count': PrivateMessage.objects.using(db).filter(
+                chat_id=chat_id, id__gt=targets['watermark'] or 0,
+            ).exclude(sender_id=user_id).order_by(),
+            'profile_user_messages': Message.objects.using(db).filter(user_id=user_id).order_by('-timestamp')[:50],
+        }
+
+    def run_queries(self, targets, repeat):
+        results = {}
+        for name, queryset in self.queries(targets).items():
+            if name.endswith('_count'):
+                run = queryset.count
+            else:
+                def run(queryset=queryset):
+                    return list(queryset.all())
+            run()  # прогрев кэша страниц
+            results[name] = {
+                'plan': queryset.explain(),
+                'latency': summarize(timed(run, repeat)),
+            }
+        return results
+
+    @contextmanager
+    def without_indexes(self):
+        """Временно удалить индексы из Meta моделей сообщений"""
+        indexes = [(model, index) for model in MESSAGE_MODELS for index in model._meta.indexes]
+        with connections[self.db].schema_editor() as editor:
+            for model, index in indexes:
+                editor.remove_index(model, index)
+        self.analyze()
+        try:
+            yield
+        finally:
+            with connections[self.db].schema_editor() as editor:
+                for model, index in indexes:
+                    editor.add_index(model, index)
+            self.analyze()
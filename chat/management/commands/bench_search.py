@@ -0,0 +1,175 @@
+# chat/management/commands/bench_search.py
+"""Бенчмарк полнотекстового поиска против icontains по таблицам сообщений.
+
+Заполняет отдельную БД (``--database``, по умолчанию ``bench``; на рабочей
+команда не запускается) сообщениями из случайных слов, индексирует их и
+замеряет поиск частых, редких и нескольких слов от имени пользователя — в
+индексе и наивным ``icontains``. В конце БД очищается, если не задан ``--keep``.
+
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py migrate --database bench
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py bench_search --rows 300000 --json search.json
+"""
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Q
+
+from chat.models import (
+    Group, GroupMembership, GroupMessage, Message, PrivateChat, PrivateChatMembership, PrivateMessage,
+)
+from chat.search import SEARCH_TABLE, index_messages, search_messages
+
+from ._bench import clear_database, require_scratch_database, summarize, timed, write_json
+
+BENCH_PREFIX = 'search_bench_'
+VOCABULARY_SIZE = 20000
+
+
+def make_vocabulary(rng):
+    letters = 'абвгдежзиклмнопрстуфхцчшэюя'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(VOCABULARY_SIZE)]
+
+
+class Command(BaseCommand):
+    help = 'Заполнить БД сообщениями и замерить полнотекстовый поиск против icontains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='bench', help='отдельная БД из DATABASES (не default)')
+        parser.add_argument('--rows', type=int, default=300000, help='сообщений каждого типа')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--chats', type=int, default=3000)
+        parser.add_argument('--groups', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=20, help='повторов каждого запроса')
+        parser.add_argument('--no-seed', action='store_true', help='использовать уже заполненные данные')
+        parser.add_argument('--no-baseline', action='store_true', help='не замерять icontains')
+        parser.add_argument('--json', dest='json_path', help='записать результат в файл')
+        parser.add_argument('--keep', action='store_true', help='не очищать БД (для повторного запуска с --no-seed)')
+
+    def handle(self, *args, **options):
+        self.db = options['database']
+        require_scratch_database(self.db, BENCH_PREFIX)
+        vendor = connections[self.db].vendor
+        if vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f'Поиск не поддерживается на {vendor}')
+        try:
+            self.benchmark(options)
+        finally:
+            if not options['keep']:
+                # Таблица индекса — не модель, flush её не очищает
+                with connections[self.db].cursor() as cursor:
+                    cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+                clear_database(self.db)
+
+    def benchmark(self, options):
+        rng = random.Random(7)
+        vocabulary = make_vocabulary(rng)
+        if not options['no_seed']:
+            self.seed(options, rng, vocabulary)
+        user = User.objects.using(self.db).filter(username__startswith=BENCH_PREFIX).order_by('id').first()
+        if user is None:
+            raise CommandError('Нет тестовых данных: запустите без --no-seed')
+
+        # Слова выбираются по закону Ципфа: первые — частые, последние — редкие
+        queries = {
+            'common_word': vocabulary[0],
+            'rare_word': vocabulary[-1],
+            'two_words': f'{vocabulary[1]} {vocabulary[50]}',
+            'prefix': vocabulary[2][:3] + '*',
+        }
+        result = {'database': connections[self.db].vendor, 'user_id': user.id, 'queries': {}}
+        for name, text in queries.items():
+            def run(text=text):
+                return search_messages(user.id, text, using=self.db)
+            data = {'query': text, 'results': len(run()['results']), 'search': summarize(timed(run, options['repeat']))}
+            if not options['no_baseline']:
+                def baseline(text=text):
+                    return self.icontains(user, text)
+                baseline()
+                data['icontains'] = summarize(timed(baseline, max(1, options['repeat'] // 4)))
+            result['queries'][name] = data
+            line = f"{name}: поиск p50={data['search']['p50_ms']} мс"
+            if 'icontains' in data:
+                line += f", icontains p50={data['icontains']['p50_ms']} мс"
+            self.stdout.write(line)
+        write_json(result, options['json_path'], self.stdout)
+
+    def icontains(self, user, text):
+        """Наивный поиск: по всем трём таблицам, все слова через icontains"""
+        words = text.rstrip('*').split()
+        condition = Q()
+        for word in words:
+            condition &= Q(content__icontains=word)
+        db = self.db
+        found = list(Message.objects.using(db).filter(condition).order_by('-id')[:20])
+        found += PrivateMessage.objects.using(db).filter(condition, chat__memberships__user=user).order_by('-id')[:20]
+        found += GroupMessage.objects.using(db).filter(condition, group__groupmembership__user=user).order_by('-id')[:20]
+        return found
+
+    def seed(self, options, rng, vocabulary):
+        weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+        def text():
+            return ' '.join(rng.choices(vocabulary, weights, k=rng.randint(4, 16)))
+
+        db = self.db
+        self.stdout.write(f"Пользователи: {options['users']}")
+        User.objects.using(db).bulk_create(
+            [User(username=f'{BENCH_PREFIX}{i}', password='!') for i in range(options['users'])],
+            batch_size=1000, ignore_conflicts=True,
+        )
+        user_ids = list(User.objects.using(db).filter(username__startswith=BENCH_PREFIX).values_list('id', flat=True))
+
+        self.stdout.write(f"Личные чаты: {options['chats']}, группы: {options['groups']}")
+        # Пара участников уникальна (ключ user_low/user_high)
+        pairs = set()
+        while len(pairs) < options['chats']:
+            pairs.add(tuple(sorted(rng.sample(user_ids, 2))))
+        chats = PrivateChat.objects.using(db).bulk_create(
+            [PrivateChat(user_low_id=low, user_high_id=high) for low, high in sorted(pairs)]
+        )
+        chat_pairs = {chat.id: (chat.user_low_id, chat.user_high_id) for chat in chats}
+        # bulk_create не шлёт m2m_changed: участники и их строки PrivateChatMembership (область поиска) — явно
+        through = PrivateChat.participants.through
+        links = [(chat_id, user_id) for chat_id, pair in chat_pairs.items() for user_id in pair]
+        through.objects.using(db).bulk_create(
+            [through(privatechat_id=chat_id, user_id=user_id) for chat_id, user_id in links], batch_size=5000,
+        )
+        PrivateChatMembership.objects.using(db).bulk_create(
+            [PrivateChatMembership(chat_id=chat_id, user_id=user_id) for chat_id, user_id in links], batch_size=5000,
+        )
+        groups = Group.objects.using(db).bulk_create([
+            Group(name=f'{BENCH_PREFIX}group_{i}', creator_id=rng.choice(user_ids)) for i in range(options['groups'])
+        ])
+        group_members = {}
+        memberships = []
+        for group in groups:
+            members = rng.sample(user_ids, min(len(user_ids), 50))
+            group_members[group.id] = members
+            memberships += [GroupMembership(group_id=group.id, user_id=user_id) for user_id in members]
+        GroupMembership.objects.using(db).bulk_create(memberships, batch_size=5000)
+        chat_ids, group_ids = list(chat_pairs), list(group_members)
+
+        def general():
+            return Message(user_id=rng.choice(user_ids), content=text())
+
+        def private():
+            chat_id = rng.choice(chat_ids)
+            return PrivateMessage(chat_id=chat_id, sender_id=rng.choice(chat_pairs[chat_id]), content=text())
+
+        def group():
+            group_id = rng.choice(group_ids)
+            return GroupMessage(group_id=group_id, sender_id=rng.choice(group_members[group_id]), content=text())
+
+        for model, factory in ((Message, general), (PrivateMessage, private), (GroupMessage, group)):
+            self.stdout.write(f"{model.__name__}: {options['rows']}")
+            for start in range(0, options['rows'], 10000):
+                objs = [factory() for _ in range(min(10000, options['rows'] - start))]
+                with transaction.atomic(using=db):
+                    model.objects.using(db).bulk_create(objs)
+                    index_messages(model, objs, using=db)
+        with connections[db].cursor() as cursor:
+            if connections[db].vendor == 'sqlite':
+                cursor.execute("INSERT INTO chat_search (chat_search) VALUES ('optimize')")
+            cursor.execute('ANALYZE')
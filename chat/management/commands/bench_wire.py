@@ -0,0 +1,128 @@
+# chat/management/commands/bench_wire.py
+"""Бенчмарк форматов кадров WebSocket: байты на проводе и CPU на сообщение.
+
+Для каждого подпротокола (JSON, MessagePack, CBOR) кодирует типичные кадры —
+сообщение чата, дельту присутствия, страницу истории и список онлайн — и
+измеряет размер без сжатия и с permessage-deflate (отдельно по сообщениям
+и с общим контекстом на соединение), а также время кодирования на
+сервере и декодирования на клиенте. БД не нужна.
+
+    python manage.py bench_wire --online 500 --json wire.json
+"""
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.wire import BINARY_CODECS, PROTOCOL_JSON, binary_frame, decode_json, encode_frame
+
+from ._bench import write_json
+
+WORDS = (
+    'привет как дела сегодня завтра встреча проект задача готово спасибо отлично посмотрю '
+    'hello deploy review merge ticket release branch fix test build later ok'
+).split()
+
+
+def make_frames(rng, online):
+    """Типичные кадры протокола в каноническом JSON"""
+    now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def text():
+        return ' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))
+
+    def user(i):
+        return {
+            'username': f'user_{i}',
+            'avatar_url': f'/media/variants/{rng.getrandbits(96):024x}.webp' if rng.random() < 0.6 else None,
+        }
+
+    def message(i):
+        return dict(
+            user(rng.randrange(10000)), type='group_message', message=text(),
+            timestamp=(now + timedelta(seconds=i)).isoformat(),
+        )
+
+    history = [dict(message(i), id=100000 + i) for i in range(50)]
+    return {
+        'message': [encode_frame(message(i)) for i in range(200)],
+        'presence_delta': [
+            encode_frame({'type': 'presence_delta', 'joined': [user(rng.randrange(10000))], 'left': []})
+            for _ in range(200)
+        ],
+        'history_page': [encode_frame({'type': 'history', 'messages': history, 'next_cursor': 'MjAyNi0wMS0wMVQwMDowMDowMHwxMDAwMDA'})],
+        'online_users': [encode_frame({'type': 'online_users', 'users': [user(i) for i in range(online)]})],
+    }
+
+
+def per_call_us(fn, items, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(item)
+    return round((time.perf_counter() - started) / (repeat * len(items)) * 1e6, 2)
+
+
+def deflated_sizes(frames, wbits, mem_level):
+    """Средний размер с permessage-deflate: без общего контекста и с ним"""
+    separate = 0
+    for frame in frames:
+        compressor = zlib.compressobj(wbits=-wbits, memLevel=mem_level)
+        # Хвост 00 00 ff ff отбрасывается по RFC 7692
+        separate += len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    compressor = zlib.compressobj(wbits=-wbits, memLevel=mem_level)
+    takeover = sum(len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 for frame in frames)
+    return round(separate / len(frames), 1), round(takeover / len(frames), 1)
+
+
+class Command(BaseCommand):
+    help = 'Сравнить JSON, MessagePack и CBOR по размеру кадров и CPU, со сжатием и без'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--online', type=int, default=500, help='пользователей в списке онлайн')
+        parser.add_argument('--repeat', type=int, default=20, help='повторов замера CPU')
+        parser.add_argument('--json', dest='json_path', help='записать результат в файл')
+
+    def handle(self, *args, **options):
+        frames = make_frames(random.Random(16), options['online'])
+        wbits = getattr(settings, 'CHAT_WS_DEFLATE_WINDOW_BITS', 12)
+        mem_level = getattr(settings, 'CHAT_WS_DEFLATE_MEM_LEVEL', 5)
+        # JSON кодирует отправитель, двоичные форматы перекодируются из JSON —
+        # замеряем само перекодирование, без запоминания (оно раз на процесс)
+        transcode = binary_frame.__wrapped__
+
+        result = {'deflate': {'window_bits': wbits, 'mem_level': mem_level}, 'frames': {}}
+        for name, texts in frames.items():
+            rows = {}
+            encoded = {PROTOCOL_JSON: [text.encode() for text in texts]}
+            rows[PROTOCOL_JSON] = {
+                'encode_us': per_call_us(encode_frame, [decode_json(text) for text in texts], options['repeat']),
+                'decode_us': per_call_us(decode_json, texts, options['repeat']),
+            }
+            for protocol, (_, decode) in BINARY_CODECS.items():
+                encoded[protocol] = [transcode(text, protocol) for text in texts]
+                rows[protocol] = {
+                    'encode_us': per_call_us(lambda text: transcode(text, protocol), texts, options['repeat']),
+                    'decode_us': per_call_us(decode, encoded[protocol], options['repeat']),
+                }
+            for protocol, data in encoded.items():
+                separate, takeover = deflated_sizes(data, wbits, mem_level)
+                rows[protocol].update({
+                    'bytes': round(sum(map(len, data)) / len(data), 1),
+                    'deflate_bytes': separate,
+                    'deflate_takeover_bytes': takeover,
+                })
+            result['frames'][name] = rows
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name} ({len(texts)} кадров)'))
+            for protocol, row in rows.items():
+                self.stdout.write(
+                    f"  {protocol:13} {row['bytes']:>9} Б  deflate {row['deflate_bytes']:>8} Б"
+                    f"  с контекстом {row['deflate_takeover_bytes']:>8} Б"
+                    f"  кодирование {row['encode_us']:>8} мкс  декодирование {row['decode_us']:>8} мкс"
+                )
+        if options['json_path']:
+            write_json(result, options['json_path'], self.stdout)
@@ -0,0 +1,34 @@
+# chat/management/commands/build_avatar_variants.py
+"""Построить миниатюры для уже загруженных аватарок пользователей и групп.
+
+    python manage.py build_avatar_variants          # только отсутствующие
+    python manage.py build_avatar_variants --all    # пересобрать все
+"""
+from django.core.management.base import BaseCommand
+
+from chat.avatars import build_variants_now
+from chat.identity import identity_cache
+from chat.models import Group, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Построить WebP/PNG-миниатюры аватарок пользователей и групп'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='пересобрать и готовые')
+
+    def handle(self, *args, **options):
+        for model in (UserProfile, Group):
+            built = failed = 0
+            for instance in model.objects.exclude(avatar='').exclude(avatar__isnull=True).iterator():
+                if not options['all'] and instance.avatar_variants.get('source') == instance.avatar.name:
+                    continue
+                try:
+                    build_variants_now(instance)
+                except (OSError, ValueError) as exc:
+                    failed += 1
+                    self.stderr.write(f"{model.__name__} {instance.pk}: {exc}")
+                    continue
+                built += 1
+            self.stdout.write(f"{model.__name__}: построено {built}, ошибок {failed}")
+        identity_cache.clear()
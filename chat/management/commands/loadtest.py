@@ -0,0 +1,312 @@
+# chat/management/commands/loadtest.py
+"""Нагрузочный тест WebSocket-маршрутов chat/routing.py.
+
+Открывает тысячи подключений к ``ws/chat/``, ``ws/private/<id>/`` и
+``ws/group/<id>/``, шлёт сообщения с заданной частотой и измеряет задержку
+подключения, сквозную задержку доставки (p50/p99), сообщения в секунду,
+запросы к БД на сообщение и RSS на подключение. Результат — JSON, чтобы
+сравнивать релизы между собой.
+
+Драйверы:
+    ``inprocess`` — консьюмеры в этом же процессе (WebsocketCommunicator);
+        RSS и запросы к БД включают и сервер, и клиентов.
+    ``socket`` — настоящие сокеты к запущенному серверу (сессии создаются
+        в той же БД, поэтому сервер запускается с ``CHAT_BENCH_SERVE=1``).
+        Запросы к БД не видны, RSS сервера — через ``--server-pid``.
+
+Пользователи ``load_*``, чаты, сессии и сообщения пишутся в отдельную БД
+(``--database``, по умолчанию ``bench``; на рабочей команда не запускается),
+в конце БД очищается, если не задан ``--keep``.
+
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py migrate --database bench
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py loadtest --connections 2000 --rate 200 --duration 10 --json load.json
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 CHAT_BENCH_SERVE=1 python -m chat_site.server chat_site.asgi:application &
+    CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py loadtest --driver socket --url ws://127.0.0.1:8000 --server-pid $!
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from chat.models import Group, GroupMembership, PrivateChat, PrivateChatMembership
+
+from ._bench import clear_database, require_scratch_database, rss_bytes, serve_from, summarize, write_json
+from ._loadclient import InProcessClient, SocketClient
+
+LOAD_PREFIX = 'load_'
+ROUTES = ('general', 'private', 'group')
+MARKER = 'lt:'
+
+
+class QueryCounter:
+    """Счётчик SQL-запросов во всех потоках (через execute_wrapper)"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест WebSocket: задержки подключения и доставки, пропускная способность, запросы и память'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--driver', choices=['inprocess', 'socket'], default='inprocess')
+        parser.add_argument('--url', default='ws://127.0.0.1:8000', help='адрес сервера для драйвера socket')
+        parser.add_argument('--server-pid', type=int, help='pid сервера для замера RSS (драйвер socket)')
+        parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+        parser.add_argument('--connections', type=int, default=1000, help='подключений на маршрут')
+        parser.add_argument('--users', type=int, default=1000, help='тестовых пользователей')
+        parser.add_argument('--senders', type=int, default=10, help='подключений, которые пишут')
+        parser.add_argument('--rate', type=float, default=50, help='сообщений в секунду на маршрут')
+        parser.add_argument('--duration', type=float, default=10, help='длительность отправки, с')
+        parser.add_argument('--drain', type=float, default=5, help='сколько ждать недоставленное, с')
+        parser.add_argument('--connect-concurrency', type=int, default=100)
+        parser.add_argument('--json', dest='json_path', help='записать результат в файл')
+        parser.add_argument('--database', default='bench', help='отдельная БД из DATABASES (не default)')
+        parser.add_argument('--keep', action='store_true', help='не очищать БД (для повторного запуска)')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('Нужно минимум 2 пользователя')
+        require_scratch_database(options['database'], LOAD_PREFIX)
+        # Консьюмеры, сессии и очередь записи работают с ORM без using(): весь процесс — на отдельной БД
+        serve_from(options['database'])
+        try:
+            self.loadtest(options)
+        finally:
+            if not options['keep']:
+                clear_database(options['database'])
+
+    def loadtest(self, options):
+        self.options = options
+        if options['verbosity'] < 2:
+            # Консьюмеры логируют каждое подключение — на тысячах это шум и лишняя нагрузка
+            logging.getLogger('chat').setLevel(logging.WARNING)
+        self.users = self.seed(options['users'])
+        self.cookies = self.sessions() if options['driver'] == 'socket' else None
+        self.queries = QueryCounter()
+        if options['driver'] == 'inprocess':
+            connection_created.connect(self.queries.install)
+            for connection in connections.all():
+                if connection.connection is not None:
+                    self.queries.install(connection=connection)
+
+        result = {
+            'driver': options['driver'],
+            'persistence': getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', 'batched'),
+            'options': {k: options[k] for k in (
+                'connections', 'users', 'senders', 'rate', 'duration', 'connect_concurrency',
+            )},
+            'routes': {},
+        }
+        # Один цикл событий на все маршруты: channel layer и очередь записи привязаны к нему
+        asyncio.run(self.run_routes(result['routes']))
+        write_json(result, options['json_path'], self.stdout)
+
+    async def run_routes(self, results):
+        for route in self.options['routes']:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{route}: {self.options["connections"]} подключений'))
+            data = results[route] = await self.run_route(route)
+            self.stdout.write(
+                f"  подключение p50={data['connect_latency'].get('p50_ms')} мс, "
+                f"доставка p50={data['delivery_latency'].get('p50_ms')} мс "
+                f"p99={data['delivery_latency'].get('p99_ms')} мс, "
+                f"{data['messages_per_sec']} сообщ/с, доставлено {data['delivered']}/{data['expected']}"
+            )
+
+    # Подготовка данных
+
+    def seed(self, count):
+        User.objects.bulk_create(
+            [User(username=f'{LOAD_PREFIX}{i}', password='!') for i in range(count)],
+            batch_size=1000, ignore_conflicts=True,
+        )
+        users = {u.username: u for u in User.objects.filter(username__startswith=LOAD_PREFIX)}
+        users = [users[f'{LOAD_PREFIX}{i}'] for i in range(count)]
+
+        # Личные чаты по парам (0, 1), (2, 3), ...
+        self.private_chat = {}
+        existing = dict(
+            PrivateChatMembership.objects.filter(user__in=users).values_list('user_id', 'chat_id')
+        )
+        through = PrivateChat.participants.through
+        for i in range(0, count - 1, 2):
+            first, second = users[i], users[i + 1]
+            chat_id = existing.get(first.id)
+            if chat_id is None:
+                low, high = sorted((first.id, second.id))
+                chat_id = PrivateChat.objects.create(user_low_id=low, user_high_id=high).id
+                through.objects.bulk_create([
+                    through(privatechat_id=chat_id, user_id=first.id),
+                    through(privatechat_id=chat_id, user_id=second.id),
+                ])
+                PrivateChatMembership.objects.bulk_create([
+                    PrivateChatMembership(chat_id=chat_id, user_id=first.id),
+                    PrivateChatMembership(chat_id=chat_id, user_id=second.id),
+                ])
+            self.private_chat[first.id] = self.private_chat[second.id] = chat_id
+
+        group, _ = Group.objects.get_or_create(name=f'{LOAD_PREFIX}group', defaults={'creator': users[0]})
+        GroupMembership.objects.bulk_create(
+            [GroupMembership(group=group, user=user) for user in users], batch_size=1000, ignore_conflicts=True,
+        )
+        Group.objects.filter(id=group.id).update(member_count=GroupMembership.objects.filter(group=group).count())
+        self.group_id = group.id
+        return users
+
+    def sessions(self):
+        """Cookie сессии для каждого пользователя (драйвер socket)"""
+        backend = settings.AUTHENTICATION_BACKENDS[0]
+        cookies = {}
+        for user in self.users:
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = backend
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.save()
+            cookies[user.id] = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+        return cookies
+
+    # Прогон
+
+    def path_for(self, route, user):
+        if route == 'general':
+            return '/ws/chat/'
+        if route == 'private':
+            return f'/ws/private/{self.private_chat[user.id]}/'
+        return f'/ws/group/{self.group_id}/'
+
+    def client_for(self, route, index):
+        user = self.users[index % len(self.users)]
+        if route == 'private' and user.id not in self.private_chat:
+            # Нечётный последний пользователь без пары
+            user = self.users[0]
+        path = self.path_for(route, user)
+        if self.options['driver'] == 'socket':
+            return path, SocketClient(self.options['url'], path, self.cookies[user.id])
+        from chat.routing import websocket_urlpatterns
+        from channels.routing import URLRouter
+        return path, InProcessClient(URLRouter(websocket_urlpatterns), path, user)
+
+    async def run_route(self, route):
+        options = self.options
+        inprocess = options['driver'] == 'inprocess'
+        server_pid = options['server_pid']
+        rss_before = rss_bytes() if inprocess else rss_bytes(server_pid) if server_pid else None
+
+        clients = [self.client_for(route, i) for i in range(options['connections'])]
+        connect_latency = []
+        failed = 0
+        connected = []
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def open_client(path, client):
+            nonlocal failed
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    ok = await client.connect()
+                except (OSError, asyncio.TimeoutError):
+                    ok = False
+                if ok:
+                    connect_latency.append(time.perf_counter() - started)
+                    connected.append((path, client))
+                else:
+                    failed += 1
+
+        await asyncio.gather(*(open_client(path, client) for path, client in clients))
+        rss_after = rss_bytes() if inprocess else rss_bytes(server_pid) if server_pid else None
+
+        # Размер комнаты: сколько подключений получит сообщение, отправленное в путь
+        room_size = {}
+        for path, _ in connected:
+            room_size[path] = room_size.get(path, 0) + 1
+
+        delivery = []
+        delivered = 0
+
+        async def read(client):
+            nonlocal delivered
+            while True:
+                text = await client.next_text()
+                if text is None:
+                    return
+                try:
+                    message = json.loads(text).get('message')
+                except ValueError:
+                    continue
+                if isinstance(message, str) and message.startswith(MARKER):
+                    delivery.append(time.perf_counter() - float(message.split(':')[2]))
+                    delivered += 1
+
+        readers = [asyncio.ensure_future(read(client)) for _, client in connected]
+
+        senders = connected[:max(1, options['senders'])]
+        total = int(options['rate'] * options['duration'])
+        interval = 1 / options['rate'] if options['rate'] > 0 else 0
+        expected = 0
+        queries_before = self.queries.count
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i in range(total if senders else 0):
+            # Отправка по расписанию, а не «как можно быстрее»: задержка не копится
+            delay = started + i * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            path, client = senders[i % len(senders)]
+            await client.send_text(json.dumps({'message': f'{MARKER}{i}:{time.perf_counter()!r}'}))
+            expected += room_size[path]
+        send_elapsed = max(loop.time() - started, 1e-9)
+
+        deadline = loop.time() + options['drain']
+        while delivered < expected and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = max(loop.time() - started, 1e-9)
+
+        if inprocess:
+            from chat.persistence import message_writer
+            await message_writer.flush()
+        queries = self.queries.count - queries_before
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*(client.close() for _, client in connected), return_exceptions=True)
+
+        count = len(connected)
+        return {
+            'connections': len(clients),
+            'connected': count,
+            'failed': failed,
+            'connect_latency': summarize(connect_latency),
+            'sent': total if senders else 0,
+            'expected': expected,
+            'delivered': delivered,
+            'delivery_latency': summarize(delivery),
+            'messages_per_sec': round((total if senders else 0) / send_elapsed, 1),
+            'deliveries_per_sec': round(delivered / elapsed, 1),
+            'db_queries_per_message': round(queries / total, 2) if inprocess and total else None,
+            'rss_per_connection_bytes': (
+                round((rss_after - rss_before) / count) if rss_before is not None and rss_after is not None and count
+                else None
+            ),
+        }
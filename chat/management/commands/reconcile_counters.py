@@ -0,0 +1,49 @@
+# chat/management/commands/reconcile_counters.py
+"""Пересчитать счётчики профилей (лайки, сообщения) по фактическим строкам.
+
+Создаёт недостающие профили (пользователи, созданные через bulk_create или
+до миграции 0013) и исправляет только разошедшиеся счётчики.
+
+    python manage.py reconcile_counters --dry-run
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from chat.counters import USER_COUNTERS, actual_count
+from chat.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Исправить расхождения счётчиков лайков и сообщений в профилях'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='только показать расхождения')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        missing = User.objects.filter(userprofile__isnull=True).values_list('id', flat=True)
+        if options['dry_run']:
+            self.stdout.write(f"Пользователей без профиля: {missing.count()}")
+        else:
+            created = UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_id) for user_id in missing.iterator()],
+                batch_size=batch_size, ignore_conflicts=True,
+            )
+            self.stdout.write(f"Создано профилей: {len(created)}")
+
+        for field in USER_COUNTERS:
+            drifted = list(
+                UserProfile.objects.annotate(actual=actual_count(field))
+                .exclude(**{field: F('actual')}).values_list('id', field, 'actual')
+            )
+            for profile_id, stored, actual in drifted[:10]:
+                self.stdout.write(f"  {field}: профиль {profile_id} {stored} -> {actual}")
+            if not options['dry_run']:
+                # Счётчик пишется значением пересчёта: изменения за время работы команды исправит следующий запуск
+                UserProfile.objects.bulk_update(
+                    [UserProfile(id=profile_id, **{field: actual}) for profile_id, _, actual in drifted],
+                    [field], batch_size=batch_size,
+                )
+            self.stdout.write(f"{field}: расхождений {len(drifted)}")
@@ -0,0 +1,228 @@
+# chat/metrics.py
+"""Метрики процесса в текстовом формате Prometheus (эндпоинт ``/metrics``).
+
+Без внешних зависимостей: счётчики, датчики и гистограммы — словари под
+замком, запись — одно сложение (гистограмма — ещё bisect по границам),
+поэтому инструментирование можно держать включённым в продакшене. Значения,
+которые и так есть в памяти (очереди сокетов, очереди channel layer),
+не копируются, а читаются функцией при сборе.
+
+Метрики свои у каждого процесса: при нескольких процессах Prometheus
+собирает каждый отдельно и суммирует запросами.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.db import connection
+
+# Границы гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    """Метрика с метками; ``function`` — значения читаются при сборе"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def label_text(self, labels, extra=()):
+        pairs = [*zip(self.labelnames, labels), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def values(self):
+        if self.function is None:
+            with self._lock:
+                return dict(self._values)
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def samples(self):
+        for labels, value in sorted(self.values().items()):
+            yield '', self.label_text(labels), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Счётчики по корзинам (последняя — +Inf), сумма, количество
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def values(self):
+        with self._lock:
+            return {labels: (list(counts), total, count) for labels, (counts, total, count) in self._values.items()}
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float('inf')), counts):
+                cumulative += n
+                yield '_bucket', self.label_text(labels, [('le', _number(float(bound)))]), cumulative
+            yield '_sum', self.label_text(labels), total
+            yield '_count', self.label_text(labels), count
+
+
+# WebSocket
+
+ws_active = Gauge('chat_ws_active_sockets', 'Открытые сокеты по типу консьюмера', ['consumer'])
+ws_connects = Counter('chat_ws_connects_total', 'Принятые подключения по типу консьюмера', ['consumer'])
+ws_streams = Gauge('chat_ws_streams', 'Открытые потоки разговоров по типу', ['kind'])
+ws_messages = Counter('chat_ws_messages_total', 'Сообщения, отправленные клиентами, по типу комнаты', ['kind'])
+ws_stage = Histogram(
+    'chat_ws_stage_seconds',
+    'Этапы сообщения: receive (весь обработчик), persist, group_send, deliver (от group_send до получателя)',
+    ['kind', 'stage'],
+)
+ws_send = Histogram('chat_ws_send_seconds', 'От постановки кадра в очередь сокета до записи в сокет')
+ws_admission = Counter(
+    'chat_ws_admission_total',
+    'Допуск подключений (chat.admission): admitted, queued, rate_limited, overloaded, user_limit',
+    ['result'],
+)
+ws_admission_wait = Histogram('chat_ws_admission_wait_seconds', 'Ожидание токена подключения в очереди допуска')
+
+
+# HTTP
+
+http_requests = Counter('chat_http_requests_total', 'Запросы по представлению и коду ответа', ['view', 'status'])
+http_latency = Histogram('chat_http_request_seconds', 'Время обработки запроса', ['view'])
+http_queries = Histogram('chat_http_db_queries', 'Запросов к БД на один HTTP-запрос', ['view'], buckets=QUERY_BUCKETS)
+http_db_time = Counter('chat_http_db_seconds_total', 'Время в запросах к БД', ['view'])
+
+
+# Channel layer и исходящие очереди читаются при сборе
+
+def _layer_queues():
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    return layer, [queue.qsize() for queue in list(getattr(layer, 'channels', {}).values())]
+
+
+Gauge('chat_layer_queued_messages', 'Сообщения в очередях каналов channel layer этого процесса',
+      function=lambda: sum(_layer_queues()[1]))
+Gauge('chat_layer_max_queue_depth', 'Самая длинная очередь канала channel layer',
+      function=lambda: max(_layer_queues()[1], default=0))
+Gauge('chat_layer_groups', 'Группы channel layer с локальными участниками',
+      function=lambda: len(getattr(_layer_queues()[0], 'groups', {})))
+Counter('chat_layer_dropped_total', 'Сообщения, пропущенные из-за переполненной очереди канала',
+        function=lambda: getattr(_layer_queues()[0], 'dropped', 0))
+
+
+def _outbound(key):
+    from .outbound import outbound_metrics
+    return lambda: outbound_metrics.snapshot()[key]
+
+
+Gauge('chat_outbound_lagging_sockets', 'Сокеты с очередью не меньше CHAT_OUTBOUND_LAG_FRAMES', function=_outbound('lagging'))
+Gauge('chat_outbound_queued_frames', 'Кадры в исходящих очередях сокетов', function=_outbound('queued_frames'))
+Gauge('chat_outbound_max_depth', 'Самая длинная исходящая очередь', function=_outbound('max_depth'))
+Gauge('chat_outbound_max_lag_seconds', 'Возраст самого старого кадра в исходящих очередях', function=_outbound('max_lag_seconds'))
+Gauge('chat_outbound_write_buffer_bytes', 'Байты в буферах записи транспортов сокетов', function=_outbound('write_buffer_bytes'))
+Counter('chat_outbound_dropped_total', 'Кадры, сброшенные политикой исходящей очереди', function=_outbound('dropped_total'))
+Counter('chat_outbound_coalesced_total', 'Замены хвоста очереди кадром resync', function=_outbound('coalesced_total'))
+Counter('chat_outbound_disconnected_total', 'Отключения отставших клиентов', function=_outbound('disconnected_total'))
+
+
+class ViewMetricsMiddleware:
+    """Время, число запросов к БД и их время для каждого представления"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0, 0.0]
+
+        def count(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        match = request.resolver_match
+        view = match.view_name if match else '<unmatched>'
+        http_latency.observe(time.perf_counter() - started, view)
+        http_requests.inc(view, response.status_code)
+        http_queries.observe(queries[0], view)
+        if queries[0]:
+            http_db_time.inc(view, amount=queries[1])
+        return response
@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-18 05:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_userlike'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'timestamp', 'id'], name='chat_gmsg_group_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['timestamp', 'id'], name='chat_msg_ts_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', '-timestamp'], name='chat_msg_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['chat', 'timestamp', 'id'], name='chat_pmsg_chat_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['chat', 'sender'], name='chat_pmsg_unread_idx'),
+        ),
+    ]
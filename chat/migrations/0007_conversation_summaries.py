@@ -0,0 +1,130 @@
+# Generated by Django 6.0 on 2026-10-18 05:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_summaries(apps, schema_editor):
+    """Заполнить сводки, счётчики участников и непрочитанного по существующим данным"""
+    PrivateChat = apps.get_model('chat', 'PrivateChat')
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+    PrivateChatMembership = apps.get_model('chat', 'PrivateChatMembership')
+    Group = apps.get_model('chat', 'Group')
+    GroupMessage = apps.get_model('chat', 'GroupMessage')
+
+    def fill(conversation, messages):
+        last = messages.order_by('-timestamp', '-id').first()
+        if last is None:
+            return
+        content = ' '.join(last.content.split())
+        conversation.last_message_id = last.id
+        conversation.last_message_sender_id = last.sender_id
+        conversation.last_message_preview = content if len(content) <= 100 else content[:99] + '…'
+        conversation.last_message_at = last.timestamp
+        conversation.message_count = messages.count()
+        conversation.save(update_fields=[
+            'last_message_id', 'last_message_sender', 'last_message_preview', 'last_message_at', 'message_count',
+        ])
+
+    for chat in PrivateChat.objects.iterator():
+        messages = PrivateMessage.objects.filter(chat_id=chat.id)
+        fill(chat, messages)
+        unread = dict(
+            messages.filter(is_read=False).values_list('sender_id').annotate(n=Count('id')).order_by()
+        )
+        total_unread = sum(unread.values())
+        PrivateChatMembership.objects.bulk_create([
+            PrivateChatMembership(user_id=user.id, chat_id=chat.id, unread_count=total_unread - unread.get(user.id, 0))
+            for user in chat.participants.all()
+        ], ignore_conflicts=True)
+
+    for group in Group.objects.annotate(n=Count('groupmembership')).iterator():
+        fill(group, GroupMessage.objects.filter(group_id=group.id))
+        Group.objects.filter(id=group.id).update(member_count=group.n)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='last_message_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='PrivateChatMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chat.privatechat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='private_chat_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'chat')},
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 6.0 on 2026-10-18 05:43
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def backfill_watermarks(apps, schema_editor):
+    """Метка — сообщение перед первым непрочитанным (по is_read) или последнее сообщение"""
+    PrivateChatMembership = apps.get_model('chat', 'PrivateChatMembership')
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+    GroupMembership = apps.get_model('chat', 'GroupMembership')
+
+    for membership in PrivateChatMembership.objects.select_related('chat').iterator():
+        first_unread = (
+            PrivateMessage.objects.filter(chat_id=membership.chat_id, is_read=False)
+            .exclude(sender_id=membership.user_id).aggregate(first=Min('id'))['first']
+        )
+        watermark = first_unread - 1 if first_unread else membership.chat.last_message_id or 0
+        PrivateChatMembership.objects.filter(pk=membership.pk).update(last_read_message_id=watermark)
+
+    # В группах прочтения не было — считаем прочитанным всё, что уже есть
+    for membership in GroupMembership.objects.select_related('group').iterator():
+        GroupMembership.objects.filter(pk=membership.pk).update(
+            last_read_message_id=membership.group.last_message_id or 0,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_conversation_summaries'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='chat_pmsg_unread_idx',
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechatmembership',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='chat_gmsg_group_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['chat', 'id'], name='chat_pmsg_chat_id_idx'),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
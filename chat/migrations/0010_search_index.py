@@ -0,0 +1,55 @@
+# Generated by Django 6.0 on 2026-10-18 06:10
+
+from django.db import migrations
+
+# Ключ строки индекса: id сообщения * 4 + код типа (0 — общий чат, 1 — личный, 2 — группа)
+BACKFILL = [
+    ('chat_message', 0, 'NULL'),
+    ('chat_privatemessage', 1, 'chat_id'),
+    ('chat_groupmessage', 2, 'group_id'),
+]
+
+CREATE = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE chat_search USING fts5("
+        "body, conversation_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')",
+    ],
+    'postgresql': [
+        "CREATE TABLE chat_search ("
+        "id bigint PRIMARY KEY, conversation_id bigint, body text NOT NULL, "
+        "document tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED)",
+        "CREATE INDEX chat_search_document_idx ON chat_search USING GIN (document)",
+    ],
+}
+
+KEY_COLUMN = {'sqlite': 'rowid', 'postgresql': 'id'}
+
+
+def create_search_index(apps, schema_editor):
+    """Создать таблицу полнотекстового индекса и заполнить её существующими сообщениями"""
+    vendor = schema_editor.connection.vendor
+    if vendor not in CREATE:
+        return
+    for sql in CREATE[vendor]:
+        schema_editor.execute(sql)
+    for table, code, conversation in BACKFILL:
+        schema_editor.execute(
+            f"INSERT INTO chat_search ({KEY_COLUMN[vendor]}, body, conversation_id) "
+            f"SELECT id * 4 + {code}, content, {conversation} FROM {table}"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE:
+        schema_editor.execute("DROP TABLE chat_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
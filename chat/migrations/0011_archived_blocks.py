@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 06:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=10)),
+                ('conversation_id', models.PositiveBigIntegerField(default=0)),
+                ('segment', models.CharField(max_length=100)),
+                ('offset', models.PositiveBigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_id', models.PositiveBigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_id', models.PositiveBigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'conversation_id', '-last_timestamp', '-last_id'], name='chat_archive_conv_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 6.0 on 2026-10-18 06:19
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    """Создать недостающие профили и заполнить счётчики по существующим данным"""
+    User = apps.get_model('auth', 'User')
+    UserProfile = apps.get_model('chat', 'UserProfile')
+    UserLike = apps.get_model('chat', 'UserLike')
+    Message = apps.get_model('chat', 'Message')
+
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id) for user_id in User.objects.filter(userprofile__isnull=True).values_list('id', flat=True)],
+        batch_size=1000,
+    )
+
+    def counted(model, user_field):
+        rows = (
+            model.objects.filter(**{user_field: OuterRef('user_id')}).order_by()
+            .values(user_field).annotate(n=Count('id')).values('n')
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    UserProfile.objects.update(
+        likes_received=counted(UserLike, 'to_user_id'),
+        likes_given=counted(UserLike, 'from_user_id'),
+        messages_sent=counted(Message, 'user_id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='likes_given',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='likes_received',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='messages_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
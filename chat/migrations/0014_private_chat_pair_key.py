@@ -0,0 +1,99 @@
+# Generated by Django 6.0 on 2026-10-18 06:21
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+
+from django.db import migrations, models
+
+# Колонка ключа таблицы поиска (миграция 0010); код 1 — сообщения личных чатов
+SEARCH_KEY_COLUMN = {'sqlite': 'rowid', 'postgresql': 'id'}
+
+
+def merge_duplicate_chats(apps, schema_editor):
+    """Заполнить ключ пары и слить дубликаты личных чатов вместе с историей.
+
+    Остаётся самый старый чат пары; сообщения, блоки архива и строки поиска
+    дубликатов переносятся в него. Метка прочтения участника — наименьшая из
+    меток его чатов (ничего непрочитанного не скрывается), непрочитанное и
+    сводка пересчитываются. Чаты не из двух участников остаются без ключа.
+    """
+    PrivateChat = apps.get_model('chat', 'PrivateChat')
+    PrivateChatMembership = apps.get_model('chat', 'PrivateChatMembership')
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+    ArchivedBlock = apps.get_model('chat', 'ArchivedBlock')
+    through = PrivateChat.participants.through
+    connection = schema_editor.connection
+
+    participants = defaultdict(list)
+    links = through.objects.values_list('privatechat_id', 'user_id').order_by('privatechat_id', 'user_id')
+    for chat_id, user_id in links.iterator():
+        participants[chat_id].append(user_id)
+    by_pair = defaultdict(list)
+    for chat_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            by_pair[tuple(user_ids)].append(chat_id)
+
+    for (low, high), chat_ids in by_pair.items():
+        keep, *duplicates = sorted(chat_ids)
+        if duplicates:
+            PrivateMessage.objects.filter(chat_id__in=duplicates).update(chat_id=keep)
+            ArchivedBlock.objects.filter(kind='private', conversation_id__in=duplicates).update(conversation_id=keep)
+            if connection.vendor in SEARCH_KEY_COLUMN:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"UPDATE chat_search SET conversation_id = %s "
+                        f"WHERE {SEARCH_KEY_COLUMN[connection.vendor]} %% 4 = 1 "
+                        f"AND conversation_id IN ({', '.join(['%s'] * len(duplicates))})",
+                        [keep, *duplicates],
+                    )
+
+            messages = PrivateMessage.objects.filter(chat_id=keep)
+            for user_id in (low, high):
+                watermarks = PrivateChatMembership.objects.filter(user_id=user_id, chat_id__in=chat_ids)
+                last_read = min(watermarks.values_list('last_read_message_id', flat=True), default=0)
+                PrivateChatMembership.objects.update_or_create(user_id=user_id, chat_id=keep, defaults={
+                    'last_read_message_id': last_read,
+                    'unread_count': messages.filter(id__gt=last_read).exclude(sender_id=user_id).count(),
+                })
+
+            chat = PrivateChat.objects.get(id=keep)
+            last = messages.order_by('-timestamp', '-id').first()
+            if last is not None:
+                content = ' '.join(last.content.split())
+                chat.last_message_id = last.id
+                chat.last_message_sender_id = last.sender_id
+                chat.last_message_preview = content if len(content) <= 100 else content[:99] + '…'
+                chat.last_message_at = last.timestamp
+            # Ушедшие в архив сообщения тоже учтены в счётчиках дубликатов
+            chat.message_count = sum(PrivateChat.objects.filter(id__in=chat_ids).values_list('message_count', flat=True))
+            chat.save()
+            PrivateChat.objects.filter(id__in=duplicates).delete()
+
+        PrivateChat.objects.filter(id=keep).update(user_low_id=low, user_high_id=high)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_profile_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privatechat',
+            name='user_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='user_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(merge_duplicate_chats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='privatechat',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='chat_private_pair_uniq'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+# auth_user — не модель приложения chat, поэтому индекс создаётся через schema_editor
+USERNAME_LOWER_INDEX = models.Index(Lower('username'), name='chat_user_username_lower_idx')
+
+
+def add_index(apps, schema_editor):
+    schema_editor.add_index(apps.get_model('auth', 'User'), USERNAME_LOWER_INDEX)
+
+
+def remove_index(apps, schema_editor):
+    schema_editor.remove_index(apps.get_model('auth', 'User'), USERNAME_LOWER_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0014_private_chat_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
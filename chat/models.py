@@ -1,10 +1,74 @@
-from django.db import models
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+# Последнее сообщение разговора, собранное из сводки (без запроса к сообщениям)
+LastMessage = namedtuple('LastMessage', ['id', 'sender', 'content', 'timestamp'])
+
+PREVIEW_LENGTH = 100
+
+
+class ConversationSummary(models.Model):
+    """Сводка разговора: последнее сообщение и число сообщений.
+
+    Обновляется при записи сообщений (chat.summaries), чтобы списки чатов
+    не обращались к таблицам сообщений.
+    """
+    # Не внешний ключ: сообщение может уйти в архив, сводка остаётся
+    last_message_id = models.PositiveBigIntegerField(null=True, blank=True)
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def get_last_message(self):
+        """Последнее сообщение из сводки или None"""
+        if self.last_message_id is None:
+            return None
+        return LastMessage(self.last_message_id, self.last_message_sender, self.last_message_preview, self.last_message_at)
+
+class AvatarVariants(models.Model):
+    """Миниатюры аватарки фиксированных размеров (chat.avatars)"""
+    # {'source': имя оригинала, '64': {'webp': имя, 'png': имя}, ...}
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def get_avatar_url(self, size=None, fmt='webp'):
+        """URL миниатюры; пока она не готова — оригинал"""
+        if not self.avatar:
+            return None
+        size = size or getattr(settings, 'CHAT_AVATAR_SIZE', 64)
+        name = self.avatar_variants.get(str(size), {}).get(fmt)
+        if name and self.avatar_variants.get('source') == self.avatar.name:
+            return default_storage.url(name)
+        return self.avatar.url
+
+    @property
+    def avatar_large_url(self):
+        return self.get_avatar_url(128)
 
 class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Время ставит отправитель: то же значение уходит в кадр и кольцевой буфер комнаты
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # Лента общего чата и keyset-пагинация истории
+            models.Index(fields=['timestamp', 'id'], name='chat_msg_ts_id_idx'),
+            # Последние сообщения пользователя в профиле
+            models.Index(fields=['user', '-timestamp'], name='chat_msg_user_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}: {self.content[:20]}"
@@ -16,30 +80,54 @@ class OnlineUser(models.Model):
     def __str__(self):
         return f"{self.user.username} — онлайн"
 
-class UserProfile(models.Model):
+class UserProfile(AvatarVariants):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
     bio = models.TextField(max_length=500, blank=True)
+    # Счётчики обновляются через F() в транзакции записи (chat.counters),
+    # расхождения исправляет команда reconcile_counters
+    likes_received = models.PositiveIntegerField(default=0)
+    likes_given = models.PositiveIntegerField(default=0)
+    messages_sent = models.PositiveIntegerField(default=0)   # сообщения в общем чате
     
     def __str__(self):
         return f"Профиль {self.user.username}"
     
-    def get_avatar_url(self):
-        if self.avatar:
-            return self.avatar.url
-        return None
-    
     def get_likes_count(self):
         """Получить количество лайков пользователя"""
-        return self.user.received_likes.count()
+        return self.likes_received
     
     def get_given_likes_count(self):
         """Получить количество лайков, которые пользователь поставил"""
-        return self.user.given_likes.count()
+        return self.likes_given
 
-class PrivateChat(models.Model):
+class PrivateChat(ConversationSummary):
     participants = models.ManyToManyField(User, related_name='private_chats')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Канонический ключ пары участников (меньший id, больший id): поиск чата
+    # двух пользователей — одна строка по уникальному индексу (PrivateChat.between)
+    user_low = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='chat_private_pair_uniq'),
+        ]
+    
+    @classmethod
+    def between(cls, first_id, second_id):
+        """Чат двух пользователей: (чат, создан ли). Безопасно при одновременных вызовах.
+
+        Повторная вставка той же пары упирается в уникальный индекс, и
+        get_or_create возвращает уже созданный чат. Участники добавляются в
+        той же транзакции, поэтому найденный чат всегда с участниками.
+        """
+        low, high = sorted((first_id, second_id))
+        with transaction.atomic():
+            chat, created = cls.objects.get_or_create(user_low_id=low, user_high_id=high)
+            if created:
+                chat.participants.add(low, high)
+        return chat, created
     
     def __str__(self):
         users = list(self.participants.all())
@@ -51,20 +139,40 @@ class PrivateChat(models.Model):
         """Получить собеседника для текущего пользователя"""
         return self.participants.exclude(id=current_user.id).first()
 
+class PrivateChatMembership(models.Model):
+    """Состояние личного чата для одного участника"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='private_chat_memberships')
+    chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name='memberships')
+    unread_count = models.PositiveIntegerField(default=0)
+    # Водяная метка прочтения: id последнего прочитанного сообщения (chat.receipts)
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['user', 'chat']
+
+    def __str__(self):
+        return f"{self.user.username} в чате {self.chat_id}"
+
 class PrivateMessage(models.Model):
     chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    is_read = models.BooleanField(default=False)  # Устарело: прочтение — метка в PrivateChatMembership
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['chat', 'timestamp', 'id'], name='chat_pmsg_chat_ts_idx'),
+            # Сообщения новее метки прочтения
+            models.Index(fields=['chat', 'id'], name='chat_pmsg_chat_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:30]}"
 
-class Group(models.Model):
+class Group(ConversationSummary, AvatarVariants):
     name = models.CharField(max_length=100)
     description = models.TextField(max_length=500, blank=True)
     creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_groups')
@@ -72,14 +180,10 @@ class Group(models.Model):
     avatar = models.ImageField(upload_to='group_avatars/', blank=True, null=True)
     is_private = models.BooleanField(default=False)  # Приватная группа требует приглашения
     created_at = models.DateTimeField(auto_now_add=True)
+    member_count = models.PositiveIntegerField(default=0)
     
     def __str__(self):
         return self.name
-    
-    def get_avatar_url(self):
-        if self.avatar:
-            return self.avatar.url
-        return None
 
 class GroupMembership(models.Model):
     ROLE_CHOICES = [
@@ -92,6 +196,8 @@ class GroupMembership(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='member')
     joined_at = models.DateTimeField(auto_now_add=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
     
     class Meta:
         unique_together = ['user', 'group']
@@ -103,10 +209,14 @@ class GroupMessage(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['group', 'timestamp', 'id'], name='chat_gmsg_group_ts_idx'),
+            models.Index(fields=['group', 'id'], name='chat_gmsg_group_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username} в {self.group.name}: {self.content[:30]}"
@@ -121,4 +231,30 @@ class UserLike(models.Model):
         unique_together = ['from_user', 'to_user']
     
     def __str__(self):
-        return f"{self.from_user.username} лайкнул {self.to_user.username}"
\ No newline at end of file
+        return f"{self.from_user.username} лайкнул {self.to_user.username}"
+
+class ArchivedBlock(models.Model):
+    """Блок сообщений одного разговора в сжатом месячном сегменте архива (chat.archive).
+
+    Разреженный индекс: одна строка на блок, а не на сообщение.
+    """
+    kind = models.CharField(max_length=10)  # 'general' | 'private' | 'group'
+    conversation_id = models.PositiveBigIntegerField(default=0)  # 0 — общий чат
+    segment = models.CharField(max_length=100)  # имя сегмента в хранилище архива
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveIntegerField()
+    message_count = models.PositiveIntegerField()
+    first_timestamp = models.DateTimeField()
+    first_id = models.PositiveBigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Блоки разговора от новых к старым — для дочитывания истории
+            models.Index(fields=['kind', 'conversation_id', '-last_timestamp', '-last_id'], name='chat_archive_conv_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.segment}@{self.offset}: {self.kind} {self.conversation_id} ({self.message_count})"
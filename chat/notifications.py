@@ -0,0 +1,104 @@
+# chat/notifications.py
+"""Уведомления о новых сообщениях в личных чатах и группах пользователя.
+
+У каждого пользователя своя группа channel layer ``user_<id>``. После
+записи пачки сообщений (chat.persistence) для каждого разговора собираются
+участники и их счётчики непрочитанного — это те же строки, которые только
+что обновила запись сводок. Уведомления копятся коротким окном
+(``CHAT_NOTIFY_WINDOW``): на разговор остаётся последнее состояние, и
+пользователь получает одним кадром ``notifications`` все изменившиеся
+разговоры. Сокет общего чата и мультиплексный сокет подписаны на группу
+своего пользователя, поэтому значки живут без отдельного сокета и опроса.
+"""
+import asyncio
+import logging
+from collections import Counter, defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .history import HISTORY_GROUP, HISTORY_PRIVATE
+from .models import GroupMembership, GroupMessage, PrivateChatMembership, PrivateMessage
+from .summaries import preview
+from .wire import encode_frame
+
+logger = logging.getLogger(__name__)
+
+# Модель сообщения -> (тип разговора, поле разговора, модель участия)
+NOTIFIED = {
+    PrivateMessage: (HISTORY_PRIVATE, 'chat_id', PrivateChatMembership),
+    GroupMessage: (HISTORY_GROUP, 'group_id', GroupMembership),
+}
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def collect_notifications(model, messages):
+    """Уведомления для сохранённых сообщений: список (id пользователя, элемент кадра)"""
+    if model not in NOTIFIED:
+        return []
+    kind, key, membership_model = NOTIFIED[model]
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[getattr(message, key)].append(message)
+
+    notifications = []
+    for conversation_id, batch in by_conversation.items():
+        last = max(batch, key=lambda m: (m.timestamp, m.id))
+        # Автору всех сообщений пачки уведомлять не о чем
+        own = [sender_id for sender_id, sent in Counter(m.sender_id for m in batch).items() if sent == len(batch)]
+        members = (
+            membership_model.objects.filter(**{key: conversation_id}).exclude(user_id__in=own)
+            .values_list('user_id', 'unread_count')
+        )
+        item = {
+            'kind': kind,
+            'id': conversation_id,
+            'preview': preview(last.content),
+            'sender_id': last.sender_id,
+            'timestamp': last.timestamp.isoformat(),
+        }
+        notifications += [(user_id, dict(item, unread=unread)) for user_id, unread in members]
+    return notifications
+
+
+class Notifier:
+    """Окно накопления уведомлений и рассылка по группам пользователей"""
+
+    def __init__(self, window=None):
+        self.window = window or getattr(settings, 'CHAT_NOTIFY_WINDOW', 0.5)
+        self._loop = None
+        self._pending = {}   # user_id -> {(тип, id разговора): элемент}
+        self._flush_task = None
+
+    def publish(self, notifications):
+        if not notifications:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pending = {}
+            self._flush_task = None
+        for user_id, item in notifications:
+            # Более позднее состояние разговора заменяет раннее
+            self._pending.setdefault(user_id, {})[(item['kind'], item['id'])] = item
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, {}
+        layer = get_channel_layer()
+        for user_id, items in pending.items():
+            try:
+                await layer.group_send(user_group(user_id), {
+                    'type': 'notify',
+                    'text': encode_frame({'type': 'notifications', 'items': list(items.values())}),
+                })
+            except Exception:
+                logger.exception("Ошибка отправки уведомлений пользователю %s", user_id)
+
+
+notifier = Notifier()
@@ -0,0 +1,171 @@
+# chat/outbound.py
+"""Ограниченная очередь исходящих кадров на каждый сокет.
+
+Обработчики событий группы (``chat_message`` и т. п.) только кладут кадр
+в очередь сокета и сразу возвращаются, поэтому медленный клиент не
+задерживает разбор очереди канала и не забивает его ёмкость. Отдельная
+задача сокета пишет кадры по одному.
+
+``send()`` daphne не ждёт клиента: кадр сразу уходит в буфер записи
+транспорта. Поэтому задача сокета смотрит на сам буфер: сервер
+chat_site.server кладёт в scope расширение ``WRITE_FLOW_EXTENSION``, и
+пока в буфере больше ``CHAT_OUTBOUND_BUFFER_BYTES``, кадры остаются в
+очереди. Под другим сервером расширения нет, очередь не копится и
+политика не срабатывает.
+
+Когда в очереди больше ``CHAT_OUTBOUND_HIGH_WATER`` кадров, применяется
+политика ``CHAT_OUTBOUND_POLICY``:
+    ``drop_oldest`` — выбросить самые старые кадры;
+    ``coalesce`` — заменить весь хвост одним кадром ``resync``: клиент
+        перечитывает историю вместо пропущенных сообщений;
+    ``disconnect`` — закрыть сокет с кодом ``CLOSE_RESYNC``.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import ws_send
+from .wire import encode_frame
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE = 'coalesce'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+CLOSE_RESYNC = 4009
+
+# Ключ scope['extensions'] с состоянием буфера записи транспорта (chat_site.server.WriteFlow)
+WRITE_FLOW_EXTENSION = 'chat.write_flow'
+
+
+class OutboundMetrics:
+    """Отставание клиентов этого процесса"""
+
+    def __init__(self):
+        self._consumers = weakref.WeakSet()
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def register(self, consumer):
+        self._consumers.add(consumer)
+
+    def unregister(self, consumer):
+        self._consumers.discard(consumer)
+
+    def snapshot(self):
+        lag_frames = getattr(settings, 'CHAT_OUTBOUND_LAG_FRAMES', 50)
+        now = time.monotonic()
+        depths = []
+        ages = []
+        buffered = 0
+        for consumer in list(self._consumers):
+            depth = len(consumer.outbound_queue)
+            depths.append(depth)
+            ages.append(now - consumer.outbound_queue[0][0] if depth else 0.0)
+            flow = consumer.write_flow()
+            if flow is not None:
+                buffered += flow.buffered()
+        return {
+            'connections': len(depths),
+            'lagging': sum(1 for depth in depths if depth >= lag_frames),
+            'queued_frames': sum(depths),
+            'max_depth': max(depths, default=0),
+            'max_lag_seconds': round(max(ages, default=0.0), 3),
+            'write_buffer_bytes': buffered,
+            'dropped_total': self.dropped,
+            'coalesced_total': self.coalesced,
+            'disconnected_total': self.disconnected,
+        }
+
+
+outbound_metrics = OutboundMetrics()
+
+
+class OutboundQueueMixin:
+    """Примесь к AsyncWebsocketConsumer: send() ставит кадр в очередь сокета"""
+
+    outbound_queue = ()
+    outbound_closed = False
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.outbound_closed:
+            # Сокет уже закрывается: события комнаты, пришедшие следом, не нужны
+            return
+        if close:
+            await self._stop_outbound()
+            return await super().send(text_data, bytes_data, close=close)
+        if not isinstance(self.outbound_queue, deque):
+            self._start_outbound()
+        self.outbound_queue.append((time.monotonic(), text_data, bytes_data))
+        if len(self.outbound_queue) > self.outbound_high_water:
+            await self._shed()
+        self._outbound_ready.set()
+
+    async def websocket_disconnect(self, message):
+        await self._stop_outbound()
+        await super().websocket_disconnect(message)
+
+    def write_flow(self):
+        """Буфер записи транспорта или None, если сервер его не передал"""
+        return self.scope.get('extensions', {}).get(WRITE_FLOW_EXTENSION)
+
+    def _start_outbound(self):
+        self.outbound_queue = deque()
+        self.outbound_high_water = getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER', 500)
+        self.outbound_policy = getattr(settings, 'CHAT_OUTBOUND_POLICY', POLICY_COALESCE)
+        self._outbound_ready = asyncio.Event()
+        self._outbound_task = asyncio.get_running_loop().create_task(self._write_outbound())
+        outbound_metrics.register(self)
+
+    async def _stop_outbound(self):
+        self.outbound_closed = True
+        task = getattr(self, '_outbound_task', None)
+        if task is not None:
+            task.cancel()
+            self._outbound_task = None
+        outbound_metrics.unregister(self)
+
+    async def _write_outbound(self):
+        flow = self.write_flow()
+        while True:
+            if not self.outbound_queue:
+                self._outbound_ready.clear()
+                await self._outbound_ready.wait()
+                continue
+            if flow is not None and not flow.writable.is_set():
+                # Клиент не успевает читать: кадры копятся в очереди, где действует политика
+                await flow.writable.wait()
+                continue
+            queued_at, text_data, bytes_data = self.outbound_queue.popleft()
+            try:
+                await super().send(text_data, bytes_data)
+            except Exception:
+                logger.exception("Ошибка отправки кадра клиенту")
+            ws_send.observe(time.monotonic() - queued_at)
+
+    async def _shed(self):
+        queue = self.outbound_queue
+        if self.outbound_policy == POLICY_DROP_OLDEST:
+            while len(queue) > self.outbound_high_water:
+                queue.popleft()
+                outbound_metrics.dropped += 1
+        elif self.outbound_policy == POLICY_DISCONNECT:
+            logger.warning("Клиент отстал на %s кадров, отключаем для пересинхронизации", len(queue))
+            outbound_metrics.dropped += len(queue)
+            outbound_metrics.disconnected += 1
+            queue.clear()
+            await self._stop_outbound()
+            await self.close(code=CLOSE_RESYNC)
+        else:
+            dropped = len(queue)
+            queue.clear()
+            queue.append((time.monotonic(), encode_frame({'type': 'resync', 'dropped': dropped}), None))
+            outbound_metrics.dropped += dropped
+            outbound_metrics.coalesced += 1
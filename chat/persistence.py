@@ -0,0 +1,154 @@
+# chat/persistence.py
+"""Отложенная (write-behind) пакетная запись сообщений чата.
+
+Консьюмеры не ждут записи в БД перед рассылкой: сообщение кладётся в
+ограниченную очередь, а фоновая задача сбрасывает её через ``bulk_create``
+пачками — по размеру пачки или по истечении временного окна. После записи
+участники разговоров получают уведомления (chat.notifications).
+
+Очередь дописывается при закрытии сокета, при остановке сервера
+(chat_site/server.py) и при отмене фоновой задачи вместе с циклом событий.
+"""
+import asyncio
+import logging
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from .db import db_sync_to_async
+from .notifications import collect_notifications, notifier
+from .search import index_messages
+from .summaries import apply_message_summaries
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_SYNC = 'sync'
+PERSISTENCE_BATCHED = 'batched'
+
+# Сообщение, ожидающее записи: модель и значения полей (FK — через *_id)
+PendingMessage = namedtuple('PendingMessage', ['model', 'fields'])
+
+
+class MessageWriter:
+    """Очередь записи сообщений с фоновым сбросом пачками"""
+
+    def __init__(self, mode=None, batch_size=None, flush_interval=None, queue_size=None):
+        self.mode = mode or getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', PERSISTENCE_BATCHED)
+        self.batch_size = batch_size or getattr(settings, 'CHAT_PERSISTENCE_BATCH_SIZE', 100)
+        self.flush_interval = flush_interval or getattr(settings, 'CHAT_PERSISTENCE_FLUSH_INTERVAL', 0.2)
+        self.queue_size = queue_size or getattr(settings, 'CHAT_PERSISTENCE_QUEUE_SIZE', 5000)
+        self._loop = None
+        self._queue = None
+        self._task = None
+        self._lock = None
+        self._arrived = None
+        self._pending = []
+
+    async def save(self, model, **fields):
+        """Сохранить сообщение.
+
+        В режиме ``sync`` запись выполняется сразу, в режиме ``batched``
+        сообщение ставится в очередь. Если очередь заполнена, вызов ждёт
+        освобождения места (backpressure).
+        """
+        item = PendingMessage(model, fields)
+        if self.mode == PERSISTENCE_SYNC:
+            notifier.publish(await db_sync_to_async(self._write_batch)([item]))
+            return
+        self._ensure_started()
+        await self._queue.put(item)
+        self._arrived.set()
+
+    async def flush(self):
+        """Немедленно записать всё, что накопилось в очереди"""
+        if self._queue is None or self._loop is not asyncio.get_running_loop():
+            return
+        while not self._queue.empty():
+            self._pending.append(self._queue.get_nowait())
+        await self._write_pending()
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый цикл событий (например, перезапуск сервера) — начинаем заново
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._lock = asyncio.Lock()
+            self._arrived = asyncio.Event()
+            self._pending = []
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # Ждём отдельно: flush() может подменить self._pending, пока мы спим
+                item = await self._queue.get()
+                self._pending.append(item)
+                deadline = loop.time() + self.flush_interval
+                while len(self._pending) < self.batch_size:
+                    try:
+                        self._pending.append(self._queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        pass
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    # По таймауту отменяется только ожидание события, а не get(): элемент не теряется
+                    self._arrived.clear()
+                    try:
+                        await asyncio.wait_for(self._arrived.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                await self._write_pending()
+        except asyncio.CancelledError:
+            # Цикл событий останавливается: записать то, что уже разослано
+            await self.flush()
+            raise
+
+    async def _write_pending(self):
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            while batch:
+                chunk, batch = batch[:self.batch_size], batch[self.batch_size:]
+                try:
+                    notifier.publish(await db_sync_to_async(self._write_batch)(chunk))
+                except Exception:
+                    logger.exception("Ошибка пакетной записи %s сообщений", len(chunk))
+
+    def _write_batch(self, batch):
+        """Записать пачку сообщений: по одному bulk_create на модель; вернуть уведомления"""
+        by_model = defaultdict(list)
+        for item in batch:
+            by_model[item.model].append(item.model(**item.fields))
+
+        notifications = []
+        for model, objs in by_model.items():
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(objs)
+                    # bulk_create не шлёт post_save — сводки и поиск обновляем сами, в той же транзакции
+                    apply_message_summaries(model, objs)
+                    index_messages(model, objs)
+                    notifications += collect_notifications(model, objs)
+            except DatabaseError:
+                # Одна битая строка не должна терять всю пачку — пишем по одной
+                logger.warning("Пакетная запись %s не удалась, сохраняем по одному", model.__name__)
+                for obj in objs:
+                    # id мог быть присвоен до отката транзакции
+                    obj.pk = None
+                    obj._state.adding = True
+                    try:
+                        with transaction.atomic():
+                            obj.save()
+                            notifications += collect_notifications(model, [obj])
+                    except DatabaseError:
+                        logger.error("Ошибка сохранения сообщения %s: %s", model.__name__, obj.__dict__)
+        return notifications
+
+
+message_writer = MessageWriter()
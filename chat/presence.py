@@ -0,0 +1,197 @@
+# chat/presence.py
+"""Присутствие пользователей в общем чате.
+
+Процесс держит в памяти счётчик подключений каждого пользователя, а общий
+для всех процессов счётчик — в брокере (расширение ``presence`` channel
+layer). Вход — первый сокет пользователя во всех процессах, выход —
+последний. Вход и выход копятся в течение короткого окна и рассылаются
+одной дельтой ``presence_delta`` (взаимно гасящиеся вход+выход не
+рассылаются вовсе). Полный список отправляется только подключившемуся сокету;
+он строится по тем же общим счётчикам брокера, а имена пользователей других
+процессов дочитываются из БД.
+
+Таблица OnlineUser обновляется лениво, пачками по сердцебиению: она нужна
+для страницы чата. Строка удаляется, когда пользователь вышел из всех
+процессов; строки, которые давно не обновлялись (процесс упал), считаются
+офлайн и удаляются.
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .db import db_sync_to_async
+from .models import OnlineUser
+from .wire import encode_frame
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = 'chat_general'
+PRESENCE_EXTENSION = 'presence'
+
+
+def online_cutoff():
+    """Момент, раньше которого запись OnlineUser считается устаревшей"""
+    return timezone.now() - timedelta(seconds=presence_ttl())
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 90)
+
+
+def presence_layer():
+    """Channel layer с общими счётчиками или None, если слой их не поддерживает"""
+    layer = get_channel_layer()
+    if layer is None or PRESENCE_EXTENSION not in getattr(layer, 'extensions', ()):
+        return None
+    return layer
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PresenceTracker:
+    """Счётчики подключений, дельты и ленивое сохранение в OnlineUser"""
+
+    def __init__(self, group=PRESENCE_GROUP, window=None, heartbeat=None):
+        self.group = group
+        self.window = window or getattr(settings, 'CHAT_PRESENCE_WINDOW', 0.5)
+        self.heartbeat = heartbeat or getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 30)
+        self._loop = None
+        self._connections = {}   # user_id -> [username, число сокетов]
+        self._pending = {}       # username -> 'join' | 'leave'
+        self._departed = {}      # user_id -> username, ушедшие с прошлого сердцебиения
+        self._left = set()       # имена ушедших из всех процессов после снимка
+        self._flush_task = None
+        self._heartbeat_task = None
+        self._snapshot = None
+        self._snapshot_at = 0.0
+
+    async def join(self, user):
+        self._ensure_started()
+        entry = self._connections.get(user.id)
+        if entry is not None:
+            entry[1] += 1
+        else:
+            self._connections[user.id] = [user.username, 1]
+            self._departed.pop(user.id, None)
+            self._left.discard(user.username)
+        if await self._count(user.id, 1) == 1:
+            self._record(user.username, 'join')
+
+    async def leave(self, user):
+        entry = self._connections.get(user.id)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._connections[user.id]
+        # Пока пользователь подключён к другому процессу, он не вышел
+        if await self._count(user.id, -1) > 0 or user.id in self._connections:
+            return
+        self._departed[user.id] = user.username
+        self._left.add(user.username)
+        self._record(user.username, 'leave')
+
+    async def _count(self, user_id, delta):
+        """Число сокетов пользователя во всех процессах после изменения на delta"""
+        layer = presence_layer()
+        if layer is None:
+            entry = self._connections.get(user_id)
+            return entry[1] if entry is not None else 0
+        return await layer.presence_change(self.group, user_id, delta, presence_ttl())
+
+    async def snapshot(self):
+        """Полный список онлайн: свои пользователи плюс подключённые к другим процессам"""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._snapshot_at > self.window:
+            self._left = set()
+            self._snapshot = await self._load_snapshot()
+            self._snapshot_at = now
+        local = {username for username, _ in self._connections.values()}
+        # Снимок живёт окно: ушедшие после него уже не в сети
+        return sorted((self._snapshot | local) - (self._left - local))
+
+    async def _load_snapshot(self):
+        """Имена пользователей с сокетами в живых процессах — по счётчикам брокера"""
+        layer = presence_layer()
+        if layer is None:
+            # Без общих счётчиков процесс один, и свои сокеты — весь список
+            return set()
+        user_ids = {int(member) for member in await layer.presence_members(self.group, presence_ttl())}
+        names = {username for user_id, (username, _) in self._connections.items() if user_id in user_ids}
+        remote = user_ids - set(self._connections)
+        if remote:
+            names |= await db_sync_to_async(self._load_usernames)(remote)
+        return names
+
+    def _record(self, username, op):
+        opposite = 'leave' if op == 'join' else 'join'
+        if self._pending.get(username) == opposite:
+            # Вход и выход в одном окне гасят друг друга
+            del self._pending[username]
+        else:
+            self._pending[username] = op
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = self._loop.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        joined = sorted(u for u, op in pending.items() if op == 'join')
+        left = sorted(u for u, op in pending.items() if op == 'leave')
+        await get_channel_layer().group_send(self.group, {
+            'type': 'presence_delta',
+            'room': self.group,
+            'text': encode_frame({'type': 'presence_delta', 'joined': joined, 'left': left}),
+        })
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._flush_task = None
+            self._heartbeat_task = None
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = loop.create_task(self._run_heartbeat())
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            departed, self._departed = self._departed, {}
+            try:
+                layer = presence_layer()
+                if layer is not None:
+                    await layer.presence_refresh(self.group, presence_ttl())
+                await db_sync_to_async(self._persist)(list(self._connections), list(departed))
+            except Exception:
+                logger.exception("Ошибка сохранения присутствия")
+
+    def _persist(self, online_ids, departed_ids):
+        now = timezone.now()
+        for chunk in _chunks(online_ids):
+            OnlineUser.objects.bulk_create([OnlineUser(user_id=i) for i in chunk], ignore_conflicts=True)
+            OnlineUser.objects.filter(user_id__in=chunk).update(last_seen=now)
+        for chunk in _chunks(departed_ids):
+            # Ушедшие из всех процессов: общий счётчик дошёл до нуля
+            OnlineUser.objects.filter(user_id__in=chunk).delete()
+        OnlineUser.objects.filter(last_seen__lt=online_cutoff()).delete()
+
+    def _load_usernames(self, user_ids):
+        names = set()
+        for chunk in _chunks(user_ids):
+            names.update(User.objects.filter(id__in=chunk).values_list('username', flat=True))
+        return names
+
+
+presence = PresenceTracker()
@@ -0,0 +1,57 @@
+# chat/receipts.py
+"""Отметки о прочтении: водяная метка последнего прочитанного сообщения.
+
+Прочтение — это сдвиг ``last_read_message_id`` в строке участия, один
+UPDATE вместо пометки каждого сообщения. Метка только растёт. Счётчик
+непрочитанного пересчитывается в том же UPDATE по сообщениям новее метки
+(индекс ``(разговор, id)``); при прочтении до конца их нет вовсе.
+"""
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .db import db_sync_to_async
+from .history import HISTORY_GROUP, HISTORY_PRIVATE
+from .models import Group, GroupMembership, GroupMessage, PrivateChat, PrivateChatMembership, PrivateMessage
+from .wire import encode_frame
+
+# Тип разговора -> (модель разговора, поле разговора, модель участия, модель сообщения)
+READ_TARGETS = {
+    HISTORY_PRIVATE: (PrivateChat, 'chat_id', PrivateChatMembership, PrivateMessage),
+    HISTORY_GROUP: (Group, 'group_id', GroupMembership, GroupMessage),
+}
+
+
+def mark_read(kind, conversation_id, user_id, message_id=None):
+    """Сдвинуть метку прочтения; вернуть новую метку или None, если она не изменилась.
+
+    Без ``message_id`` разговор читается до последнего записанного сообщения.
+    """
+    conversation_model, key, membership_model, message_model = READ_TARGETS[kind]
+    latest = conversation_model.objects.filter(id=conversation_id).values_list('last_message_id', flat=True).first()
+    if not latest:
+        return None
+    target = latest if message_id is None else min(message_id, latest)
+
+    unread = (
+        message_model.objects.filter(**{key: OuterRef(key)}, id__gt=target)
+        .exclude(sender_id=user_id).order_by().values(key).annotate(n=Count('id')).values('n')
+    )
+    updated = membership_model.objects.filter(
+        **{key: conversation_id}, user_id=user_id, last_read_message_id__lt=target,
+    ).update(last_read_message_id=target, unread_count=Coalesce(Subquery(unread), Value(0)))
+    return target if updated else None
+
+
+async def read_event(kind, conversation_id, user, message_id=None):
+    """Событие группы ``read_receipt`` для комнаты или None, если метка не сдвинулась"""
+    try:
+        message_id = int(message_id) if message_id is not None else None
+    except (TypeError, ValueError):
+        return None
+    watermark = await db_sync_to_async(mark_read)(kind, conversation_id, user.id, message_id)
+    if watermark is None:
+        return None
+    return {
+        'type': 'read_receipt',
+        'text': encode_frame({'type': 'read', 'username': user.username, 'message_id': watermark}),
+    }
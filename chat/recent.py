@@ -0,0 +1,121 @@
+# chat/recent.py
+"""Кольцевой буфер последних сообщений комнаты.
+
+Сообщение, разосланное в комнату, дописывается в буфер её группы (расширение
+``recent`` channel layer, общее для всех процессов) и получает seq — номер,
+монотонный в пределах комнаты. Клиенты получают кадр с этим номером.
+
+Буфер нужен для двух вещей:
+    страница комнаты (room_page) строится из буфера без запроса к БД, если
+    в нём набралась полная страница, иначе — из БД (history_page);
+    переподключившийся клиент присылает ``{"type": "resume", "seq": N}`` и
+    получает пропущенные кадры из буфера (replay). Если разрыв старше
+    буфера, клиенту уходит ``resync`` — он перечитывает страницу из БД.
+
+Страница из буфера продолжается историей по курсору ``(timestamp, id)``
+самого раннего её сообщения. timestamp у кадра и строки в БД один и тот же
+(его ставит отправитель), а id при пакетной записи в кадре ещё нет — его
+находит один запрос по индексу разговора (buffer_cursor).
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from .access import room_group
+from .history import HISTORY_GENERAL, encode_position, history_page, history_queryset, page_size, serialize_message
+from .wire import decode_json, encode_frame
+
+RECENT_EXTENSION = 'recent'
+
+# id больше любого: курсор берёт все строки с тем же временем
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+def recent_size():
+    return getattr(settings, 'CHAT_RECENT_SIZE', 200)
+
+
+def recent_layer():
+    """Channel layer с буфером или None, если слой его не поддерживает"""
+    layer = get_channel_layer()
+    if layer is None or RECENT_EXTENSION not in getattr(layer, 'extensions', ()):
+        return None
+    return layer
+
+
+def with_seq(text, seq):
+    """Вписать seq в начало готового кадра JSON"""
+    return f'{{"seq":{seq},' + text[1:]
+
+
+async def remember(group, payload):
+    """Дописать кадр в буфер комнаты и вернуть его текст с seq (без буфера — как есть)"""
+    text = encode_frame(payload)
+    layer = recent_layer()
+    if layer is None:
+        return text
+    return with_seq(text, await layer.append_recent(group, text, recent_size()))
+
+
+async def replay(group, seq):
+    """Кадры комнаты после seq или None, если буфер не покрывает разрыв"""
+    layer = recent_layer()
+    if layer is None:
+        return None
+    latest, entries = await layer.recent(group)
+    if seq > latest:
+        # Счётчик начался заново (перезапуск брокера): номерам клиента верить нельзя
+        return None
+    if seq == latest:
+        return []
+    if not entries or entries[0][0] > seq + 1:
+        return None
+    return [with_seq(text, number) for number, text in entries if number > seq]
+
+
+def buffered_message(text):
+    """Сообщение из кадра буфера в виде serialize_message"""
+    data = decode_json(text)
+    return {
+        'id': None,
+        'message': data['message'],
+        'user_id': data['user_id'],
+        'username': data['username'],
+        'avatar_url': data['avatar_url'],
+        'timestamp': parse_datetime(data['timestamp']),
+    }
+
+
+def buffer_cursor(kind, conversation_id, message):
+    """Курсор истории перед сообщением из буфера.
+
+    Сообщения с тем же временем различает id: строка ищется по времени,
+    отправителю и тексту. Если её ещё нет (ждёт в очереди записи), в БД с
+    тем же временем только более ранние сообщения — курсор берёт их все.
+    """
+    sender = 'user_id' if kind == HISTORY_GENERAL else 'sender_id'
+    message_id = history_queryset(kind, conversation_id).filter(**{
+        'timestamp': message['timestamp'],
+        sender: message['user_id'],
+        'content': message['message'],
+    }).order_by('id').values_list('id', flat=True).first()
+    return encode_position(message['timestamp'], MAX_MESSAGE_ID if message_id is None else message_id)
+
+
+def room_page(kind, conversation_id=None):
+    """Последняя страница комнаты для шаблона: (сообщения, курсор истории, последний seq).
+
+    Сообщения — словари serialize_message с timestamp-датой. seq читается до
+    запроса к БД: всё, что придёт позже, клиент получит повтором по resume.
+    """
+    limit = page_size()
+    seq = None
+    layer = recent_layer()
+    if layer is not None:
+        seq, entries = async_to_sync(layer.recent)(room_group(kind, conversation_id))
+        if len(entries) >= limit:
+            messages = [buffered_message(text) for _, text in entries[-limit:]]
+            return messages, buffer_cursor(kind, conversation_id, messages[0]), seq
+    rows, cursor = history_page(kind, conversation_id, limit=limit)
+    return [dict(serialize_message(message), timestamp=message.timestamp) for message in rows], cursor, seq
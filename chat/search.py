@@ -0,0 +1,242 @@
+# chat/search.py
+"""Полнотекстовый поиск по сообщениям всех чатов.
+
+Все три таблицы сообщений индексируются в одну таблицу ``chat_search``:
+на SQLite — виртуальная таблица FTS5, на PostgreSQL — обычная таблица
+с колонкой ``tsvector`` и GIN-индексом (создаются миграцией 0010).
+
+Ключ строки индекса — ``id сообщения * 4 + код типа разговора``: удаление
+из индекса идёт по первичному ключу, а тип разговора не хранится отдельно.
+Индекс пополняется в той же транзакции, что и запись сообщений
+(persistence._write_batch и сигнал post_save), и чистится сигналом post_delete.
+
+Поиск ограничен разговорами пользователя: общий чат, его личные чаты
+и группы. Ранжируются (bm25 / ts_rank) только ``CHAT_SEARCH_RANK_WINDOW``
+самых свежих совпадений, поэтому запрос с частым словом стоит столько же,
+сколько с редким; страницы — по смещению внутри этого окна.
+"""
+import re
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.html import escape
+
+from .history import HISTORY_GENERAL, HISTORY_GROUP, HISTORY_PRIVATE, serialize_message
+from .models import GroupMembership, GroupMessage, Message, PrivateChatMembership, PrivateMessage
+
+SEARCH_TABLE = 'chat_search'
+# Конфигурация to_tsvector на PostgreSQL: та же, что в колонке document (миграция 0010)
+SEARCH_CONFIG = 'simple'
+
+KIND_CODES = {HISTORY_GENERAL: 0, HISTORY_PRIVATE: 1, HISTORY_GROUP: 2}
+KINDS = {code: kind for kind, code in KIND_CODES.items()}
+
+# Модель сообщения -> (тип разговора, поле разговора)
+INDEXED = {
+    Message: (HISTORY_GENERAL, None),
+    PrivateMessage: (HISTORY_PRIVATE, 'chat_id'),
+    GroupMessage: (HISTORY_GROUP, 'group_id'),
+}
+MODELS = {kind: model for model, (kind, _) in INDEXED.items()}
+
+# Границы подсветки: непечатные символы, чтобы экранировать текст уже после snippet()
+MARK_START = '\x02'
+MARK_END = '\x03'
+MAX_TERMS = 8
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchUnavailable(Exception):
+    """СУБД без полнотекстового индекса"""
+
+
+def page_size():
+    return getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+
+
+def rank_window():
+    return getattr(settings, 'CHAT_SEARCH_RANK_WINDOW', 2000)
+
+
+def search_key(kind, message_id):
+    return message_id * 4 + KIND_CODES[kind]
+
+
+def query_terms(text):
+    """Слова запроса и признак префикса: синтаксис FTS5/tsquery пользователю не доступен.
+
+    Все слова обязательны. ``*`` в конце запроса делает последнее слово префиксом.
+    """
+    terms = [word.lower() for word in WORD_RE.findall(text)][:MAX_TERMS]
+    return terms, text.rstrip().endswith('*')
+
+
+def highlight(snippet):
+    """Экранировать фрагмент и превратить границы совпадений в <mark>"""
+    return escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+class SqliteBackend:
+    def match_expression(self, terms, prefix):
+        phrases = [f'"{term}"' for term in terms]
+        if prefix:
+            phrases[-1] += '*'
+        return ' '.join(phrases)
+
+    def insert(self, cursor, rows):
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, body, conversation_id) VALUES (%s, %s, %s)', rows,
+        )
+
+    def delete(self, cursor, keys):
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(key,) for key in keys])
+
+    def search(self, cursor, expression, scope_sql, scope_params, window, limit, offset):
+        # bm25 считается только для окна свежих совпадений: FTS5 отдаёт их
+        # по убыванию rowid без сортировки, а ранжирование всех совпадений
+        # частого слова стоило бы сотни миллисекунд
+        cursor.execute(
+            f'WITH recent AS ('
+            f'SELECT rowid AS key, rank AS score FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s AND ({scope_sql.format(key="rowid")}) '
+            f'ORDER BY rowid DESC LIMIT %s'
+            f'), top AS (SELECT key, score FROM recent ORDER BY score LIMIT %s OFFSET %s) '
+            f'SELECT {SEARCH_TABLE}.rowid, conversation_id, snippet({SEARCH_TABLE}, 0, %s, %s, %s, 16) '
+            f'FROM top JOIN {SEARCH_TABLE} ON {SEARCH_TABLE}.rowid = top.key '
+            f'WHERE {SEARCH_TABLE} MATCH %s ORDER BY top.score',
+            [expression, *scope_params, window, limit, offset, MARK_START, MARK_END, '…', expression],
+        )
+        return cursor.fetchall()
+
+
+class PostgresBackend:
+    def match_expression(self, terms, prefix):
+        terms = [f"'{term}'" for term in terms]
+        if prefix:
+            terms[-1] += ':*'
+        return ' & '.join(terms)
+
+    def insert(self, cursor, rows):
+        cursor.executemany(
+            f'INSERT INTO {SEARCH_TABLE} (id, body, conversation_id) VALUES (%s, %s, %s) '
+            f'ON CONFLICT (id) DO UPDATE SET body = EXCLUDED.body', rows,
+        )
+
+    def delete(self, cursor, keys):
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE id = ANY(%s)', [list(keys)])
+
+    def search(self, cursor, expression, scope_sql, scope_params, window, limit, offset):
+        # Как и на SQLite, ts_rank — только по окну свежих совпадений
+        options = f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=24, MinWords=8, MaxFragments=1'
+        cursor.execute(
+            f'SELECT id, conversation_id, ts_headline(%s, body, query, %s) FROM ('
+            f'SELECT id, conversation_id, body, document FROM {SEARCH_TABLE} '
+            f'WHERE document @@ to_tsquery(%s, %s) AND ({scope_sql.format(key="id")}) '
+            f'ORDER BY id DESC LIMIT %s'
+            f') recent, to_tsquery(%s, %s) query '
+            f'ORDER BY ts_rank(document, query) DESC, id DESC LIMIT %s OFFSET %s',
+            [SEARCH_CONFIG, options, SEARCH_CONFIG, expression, *scope_params, window,
+             SEARCH_CONFIG, expression, limit, offset],
+        )
+        return cursor.fetchall()
+
+
+BACKENDS = {
+    'sqlite': SqliteBackend(),
+    'postgresql': PostgresBackend(),
+}
+
+
+def get_backend(using=DEFAULT_DB_ALIAS):
+    return BACKENDS.get(connections[using].vendor)
+
+
+def index_rows(model, messages):
+    kind, field = INDEXED[model]
+    return [
+        (search_key(kind, message.id), message.content, getattr(message, field) if field else None)
+        for message in messages
+    ]
+
+
+def index_messages(model, messages, using=DEFAULT_DB_ALIAS):
+    """Добавить сохранённые сообщения в индекс (в текущей транзакции)"""
+    backend = get_backend(using)
+    if backend is None or model not in INDEXED or not messages:
+        return
+    with connections[using].cursor() as cursor:
+        backend.insert(cursor, index_rows(model, messages))
+
+
+def unindex_messages(model, message_ids, using=DEFAULT_DB_ALIAS):
+    """Убрать сообщения из индекса"""
+    backend = get_backend(using)
+    if backend is None or model not in INDEXED or not message_ids:
+        return
+    kind = INDEXED[model][0]
+    with connections[using].cursor() as cursor:
+        backend.delete(cursor, [search_key(kind, message_id) for message_id in message_ids])
+
+
+def scope_condition(user_id, kind=None, conversation_id=None):
+    """Условие на строки индекса: только разговоры, доступные пользователю.
+
+    Возвращает SQL с местом ``{key}`` под имя ключевой колонки и параметры.
+    Доступ к конкретному разговору (kind + conversation_id) проверяет вызывающий.
+    """
+    if kind is not None:
+        if kind == HISTORY_GENERAL:
+            return '{key} %% 4 = 0', []
+        return f'{{key}} %% 4 = {KIND_CODES[kind]} AND conversation_id = %s', [int(conversation_id)]
+    private = PrivateChatMembership._meta.db_table
+    groups = GroupMembership._meta.db_table
+    return (
+        '{key} %% 4 = 0'
+        f' OR ({{key}} %% 4 = 1 AND conversation_id IN (SELECT chat_id FROM {private} WHERE user_id = %s))'
+        f' OR ({{key}} %% 4 = 2 AND conversation_id IN (SELECT group_id FROM {groups} WHERE user_id = %s))'
+    ), [user_id, user_id]
+
+
+def search_messages(user_id, text, kind=None, conversation_id=None, offset=0, limit=None, using=DEFAULT_DB_ALIAS):
+    """Страница результатов поиска: сообщения с подсвеченным фрагментом"""
+    backend = get_backend(using)
+    if backend is None:
+        raise SearchUnavailable(connections[using].vendor)
+    limit = limit or page_size()
+    offset = max(offset, 0)
+    terms, prefix = query_terms(text)
+    if not terms:
+        return {'results': [], 'next_offset': None}
+
+    scope_sql, scope_params = scope_condition(user_id, kind, conversation_id)
+    with connections[using].cursor() as cursor:
+        hits = backend.search(
+            cursor, backend.match_expression(terms, prefix), scope_sql, scope_params, rank_window(), limit + 1, offset,
+        )
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    # Сами сообщения — по одному запросу на тип разговора
+    ids_by_kind = {}
+    for key, _, _ in hits:
+        ids_by_kind.setdefault(KINDS[key % 4], []).append(key // 4)
+    messages = {}
+    for hit_kind, ids in ids_by_kind.items():
+        model = MODELS[hit_kind]
+        sender = 'user' if model is Message else 'sender'
+        queryset = model.objects.using(using).filter(id__in=ids).select_related(sender, f'{sender}__userprofile')
+        messages.update({(hit_kind, message.id): message for message in queryset})
+
+    results = []
+    for key, hit_conversation_id, snippet in hits:
+        message = messages.get((KINDS[key % 4], key // 4))
+        if message is None:
+            continue
+        results.append(dict(
+            serialize_message(message),
+            kind=KINDS[key % 4],
+            conversation_id=hit_conversation_id,
+            snippet=highlight(snippet),
+        ))
+    return {'results': results, 'next_offset': offset + limit if has_more else None}
@@ -0,0 +1,183 @@
+# chat/signals.py
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .access import access_changed
+from .avatars import schedule_variants
+from .counters import bump
+from .history import HISTORY_GROUP, HISTORY_PRIVATE
+from .identity import identity_cache
+from .models import (
+    ArchivedBlock, Group, GroupMembership, GroupMessage, Message, PrivateChat, PrivateChatMembership, PrivateMessage,
+    UserLike, UserProfile,
+)
+from .search import index_messages, unindex_messages
+from .summaries import apply_message_summaries
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_profile_identity(sender, instance, **kwargs):
+    """Сбросить кэш при смене аватарки или удалении профиля"""
+    identity_cache.invalidate(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_identity(sender, instance, **kwargs):
+    """Сбросить кэш при смене имени пользователя"""
+    identity_cache.invalidate(instance.id)
+
+
+@receiver(post_save, sender=User)
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
+    """Профиль со счётчиками есть у каждого пользователя с момента создания"""
+    if created and not raw:
+        UserProfile.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=PrivateMessage)
+@receiver(post_save, sender=GroupMessage)
+def update_conversation_summary(sender, instance, created, **kwargs):
+    """Сообщения, сохранённые в обход пакетной записи, тоже попадают в сводку"""
+    if created:
+        apply_message_summaries(sender, [instance])
+
+
+@receiver(post_delete, sender=Message)
+def uncount_message(sender, instance, **kwargs):
+    # Счётчик — сообщения, лежащие в общем чате; архивация уменьшает его сама, одним запросом
+    bump(instance.user_id, 'messages_sent', -1)
+
+
+@receiver(post_save, sender=UserLike)
+def count_like(sender, instance, created, **kwargs):
+    if created:
+        bump(instance.to_user_id, 'likes_received', 1)
+        bump(instance.from_user_id, 'likes_given', 1)
+
+
+@receiver(post_delete, sender=UserLike)
+def uncount_like(sender, instance, **kwargs):
+    bump(instance.to_user_id, 'likes_received', -1)
+    bump(instance.from_user_id, 'likes_given', -1)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=PrivateMessage)
+@receiver(post_save, sender=GroupMessage)
+def index_message(sender, instance, **kwargs):
+    """Сообщения, сохранённые в обход пакетной записи (и изменённые), — в поисковый индекс"""
+    index_messages(sender, [instance])
+
+
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=PrivateMessage)
+@receiver(post_delete, sender=GroupMessage)
+def unindex_message(sender, instance, **kwargs):
+    unindex_messages(sender, [instance.id])
+
+
+@receiver(post_delete, sender=PrivateChat)
+@receiver(post_delete, sender=Group)
+def drop_archived_blocks(sender, instance, **kwargs):
+    """Удалённый разговор исчезает и из индекса архива (байты сегмента остаются)"""
+    kind = HISTORY_PRIVATE if sender is PrivateChat else HISTORY_GROUP
+    ArchivedBlock.objects.filter(kind=kind, conversation_id=instance.pk).delete()
+
+
+@receiver(m2m_changed, sender=PrivateChat.participants.through)
+def sync_private_chat_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """Держать PrivateChatMembership в соответствии с участниками чата"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # user.private_chats.add(...): instance — пользователь, pk_set — чаты
+        pairs = [(instance.pk, chat_id) for chat_id in pk_set or ()]
+        lookup = {'user': instance, 'chat_id__in': pk_set}
+    else:
+        pairs = [(user_id, instance.pk) for user_id in pk_set or ()]
+        lookup = {'chat': instance, 'user_id__in': pk_set}
+    if action == 'post_add':
+        PrivateChatMembership.objects.bulk_create(
+            [PrivateChatMembership(user_id=user_id, chat_id=chat_id) for user_id, chat_id in pairs],
+            ignore_conflicts=True,
+        )
+    elif action == 'post_remove':
+        PrivateChatMembership.objects.filter(**lookup).delete()
+    else:
+        lookup.pop('chat_id__in' if reverse else 'user_id__in')
+        PrivateChatMembership.objects.filter(**lookup).delete()
+
+
+@receiver(post_save, sender=GroupMembership)
+def increment_member_count(sender, instance, created, **kwargs):
+    if created:
+        Group.objects.filter(id=instance.group_id).update(member_count=F('member_count') + 1)
+
+
+@receiver(post_delete, sender=GroupMembership)
+def decrement_member_count(sender, instance, **kwargs):
+    Group.objects.filter(id=instance.group_id, member_count__gt=0).update(member_count=F('member_count') - 1)
+
+
+@receiver(m2m_changed, sender=PrivateChat.participants.through)
+def private_chat_access_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Сбросить индекс доступа; удалённых участников отключить от комнаты"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if action == 'pre_clear':
+        links = sender.objects.filter(**{'user_id' if reverse else 'privatechat_id': instance.pk})
+        pairs = list(links.values_list('privatechat_id', 'user_id'))
+    elif reverse:
+        pairs = [(chat_id, instance.pk) for chat_id in pk_set]
+    else:
+        pairs = [(instance.pk, user_id) for user_id in pk_set]
+    by_chat = defaultdict(list)
+    for chat_id, user_id in pairs:
+        by_chat[chat_id].append(user_id)
+    for chat_id, user_ids in by_chat.items():
+        # Добавление только сбрасывает индекс, удаление ещё и отключает
+        access_changed(HISTORY_PRIVATE, chat_id, () if action == 'post_add' else user_ids)
+
+
+@receiver(pre_delete, sender=PrivateChat)
+def private_chat_deleted(sender, instance, **kwargs):
+    # Связи участников удаляются каскадом, без m2m_changed
+    user_ids = list(instance.participants.values_list('id', flat=True))
+    access_changed(HISTORY_PRIVATE, instance.pk, user_ids)
+
+
+@receiver(post_save, sender=GroupMembership)
+def group_access_granted(sender, instance, **kwargs):
+    """Новый участник или смена роли"""
+    access_changed(HISTORY_GROUP, instance.group_id)
+
+
+@receiver(post_delete, sender=GroupMembership)
+def group_access_revoked(sender, instance, **kwargs):
+    access_changed(HISTORY_GROUP, instance.group_id, [instance.user_id])
+
+
+def _refresh_avatar_variants(instance, on_saved=None):
+    if not instance.avatar:
+        if instance.avatar_variants:
+            type(instance).objects.filter(pk=instance.pk).update(avatar_variants={})
+        return
+    if instance.avatar_variants.get('source') != instance.avatar.name:
+        schedule_variants(instance, on_saved)
+
+
+@receiver(post_save, sender=UserProfile)
+def build_profile_avatar_variants(sender, instance, **kwargs):
+    """Новая аватарка — в пул на миниатюры; кэш отправителя сбросить, когда они готовы"""
+    user_id = instance.user_id
+    _refresh_avatar_variants(instance, lambda: identity_cache.invalidate(user_id))
+
+
+@receiver(post_save, sender=Group)
+def build_group_avatar_variants(sender, instance, **kwargs):
+    _refresh_avatar_variants(instance)
@@ -0,0 +1,64 @@
+# chat/summaries.py
+"""Денормализованные сводки разговоров и счётчики непрочитанного.
+
+Вызывается в той же транзакции, что и запись сообщений: пачка сообщений
+группируется по разговору, и на каждый разговор выполняется по одному
+UPDATE сводки и счётчиков участников (через F(), без гонок). Сообщения
+общего чата сводки не имеют — для них обновляется счётчик автора.
+"""
+from collections import Counter, defaultdict
+
+from django.db.models import F, Q
+
+from .counters import count_messages_sent
+from .models import (
+    PREVIEW_LENGTH, Group, GroupMembership, GroupMessage, Message,
+    PrivateChat, PrivateChatMembership, PrivateMessage,
+)
+
+# Модель сообщения -> (модель разговора, поле разговора, модель участия)
+CONVERSATIONS = {
+    PrivateMessage: (PrivateChat, 'chat_id', PrivateChatMembership),
+    GroupMessage: (Group, 'group_id', GroupMembership),
+}
+
+
+def preview(content):
+    content = ' '.join(content.split())
+    if len(content) <= PREVIEW_LENGTH:
+        return content
+    return content[:PREVIEW_LENGTH - 1] + '…'
+
+
+def apply_message_summaries(model, messages):
+    """Обновить сводки и непрочитанное для уже сохранённых сообщений"""
+    if model is Message:
+        count_messages_sent(messages)
+        return
+    if model not in CONVERSATIONS:
+        return
+    conversation_model, key, membership_model = CONVERSATIONS[model]
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[getattr(message, key)].append(message)
+
+    for conversation_id, batch in by_conversation.items():
+        last = max(batch, key=lambda m: (m.timestamp, m.id))
+        conversation_model.objects.filter(id=conversation_id).update(message_count=F('message_count') + len(batch))
+        # Сводку не откатываем назад, если параллельно записано более новое сообщение
+        conversation_model.objects.filter(
+            Q(last_message_id__isnull=True) | Q(last_message_id__lt=last.id), id=conversation_id,
+        ).update(
+            last_message_id=last.id,
+            last_message_sender_id=last.sender_id,
+            last_message_preview=preview(last.content),
+            last_message_at=last.timestamp,
+        )
+
+        # Собственные сообщения участнику в непрочитанные не идут
+        senders = Counter(m.sender_id for m in batch)
+        memberships = membership_model.objects.filter(**{key: conversation_id})
+        memberships.exclude(user_id__in=senders).update(unread_count=F('unread_count') + len(batch))
+        for sender_id, sent in senders.items():
+            if sent < len(batch):
+                memberships.filter(user_id=sender_id).update(unread_count=F('unread_count') + len(batch) - sent)
@@ -0,0 +1,71 @@
+# chat/tests/test_archive.py
+"""Холодный архив (chat/archive.py) в хранилище Django"""
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat import archive
+from chat.history import HISTORY_GENERAL, history_page
+from chat.models import ArchivedBlock, Message, UserProfile
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'chat_archive': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+}
+
+
+@override_settings(STORAGES=STORAGES, CHAT_ARCHIVE_STORAGE='chat_archive')
+class ArchiveChunkTest(TestCase):
+
+    def setUp(self):
+        archive.read_block.cache_clear()
+        self.authors = [User.objects.create(username=f'author{i}') for i in range(3)]
+        self.old = timezone.now() - timedelta(days=400)
+        for i in range(9):
+            Message.objects.create(user=self.authors[i % 3], content=f'старое {i}', timestamp=self.old + timedelta(days=i * 10))
+        self.hot = Message.objects.create(user=self.authors[0], content='свежее')
+        self.cutoff = timezone.now() - timedelta(days=30)
+
+    def test_messages_move_to_storage_and_history_reads_through(self):
+        self.assertEqual(archive.archive_chunk(HISTORY_GENERAL, self.cutoff, 100), 9)
+
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.hot.id])
+        blocks = ArchivedBlock.objects.all()
+        storage = archive.archive_storage()
+        self.assertTrue(all(storage.exists(block.segment) for block in blocks))
+        # Сегмент — блоки порции за один месяц
+        months = {block.first_timestamp.strftime('%Y-%m') for block in blocks}
+        self.assertEqual(len({block.segment for block in blocks}), len(months))
+
+        rows, cursor = history_page(HISTORY_GENERAL, limit=20)
+        self.assertIsNone(cursor)
+        self.assertEqual([row.content for row in rows], [f'старое {i}' for i in range(9)] + ['свежее'])
+
+    def test_counters_are_decremented_in_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            archive.archive_chunk(HISTORY_GENERAL, self.cutoff, 100)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "chat_userprofile"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            dict(UserProfile.objects.filter(user__in=self.authors).values_list('user__username', 'messages_sent')),
+            {'author0': 1, 'author1': 0, 'author2': 0},
+        )
+
+    def test_chunk_archived_by_another_run_is_rolled_back(self):
+        with mock.patch('django.db.models.query.QuerySet._raw_delete', return_value=0):
+            with self.assertRaises(archive.ArchiveConflict):
+                archive.archive_chunk(HISTORY_GENERAL, self.cutoff, 100)
+        self.assertFalse(ArchivedBlock.objects.exists())
+        self.assertEqual(Message.objects.count(), 10)
+
+    @override_settings(STORAGES={'default': STORAGES['default']})
+    def test_archive_requires_configured_storage(self):
+        with self.assertRaises(ImproperlyConfigured):
+            archive.archive_chunk(HISTORY_GENERAL, self.cutoff, 100)
+        self.assertEqual(Message.objects.count(), 10)
@@ -0,0 +1,148 @@
+# chat/tests/test_layers.py
+"""PubSubChannelLayer: два экземпляра слоя на общем брокере local ведут себя как два процесса"""
+import asyncio
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, override_settings
+
+from chat.layers import LocalBroker, PubSubChannelLayer
+
+LAYERS = {
+    alias: {
+        'BACKEND': 'chat.layers.PubSubChannelLayer',
+        'CONFIG': {'broker': 'local', 'prefix': 'test'},
+    }
+    for alias in ('default', 'second')
+}
+
+
+class RelayConsumer(AsyncJsonWebsocketConsumer):
+    """Сокет в группе room: пересылает кадры клиента в группу или в канал"""
+
+    groups = ['room']
+
+    async def connect(self):
+        await self.accept()
+        await self.send_json({'channel': self.channel_name})
+
+    async def receive_json(self, content):
+        event = {'type': 'relay', 'text': content['text']}
+        if 'channel' in content:
+            await self.channel_layer.send(content['channel'], event)
+        else:
+            await self.channel_layer.group_send('room', event)
+
+    async def relay(self, event):
+        await self.send_json({'text': event['text']})
+
+
+class SecondRelayConsumer(RelayConsumer):
+    """Тот же сокет во «втором процессе»"""
+
+    channel_layer_alias = 'second'
+
+
+@override_settings(CHANNEL_LAYERS=LAYERS)
+class PubSubChannelLayerTest(SimpleTestCase):
+
+    async def connect(self, consumer):
+        communicator = WebsocketCommunicator(consumer.as_asgi(), '/ws/test/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        channel = (await communicator.receive_json_from())['channel']
+        return communicator, channel
+
+    async def close_layers(self):
+        for alias in LAYERS:
+            await get_channel_layer(alias).close()
+
+    async def test_group_send_reaches_other_instance(self):
+        first, _ = await self.connect(RelayConsumer)
+        second, _ = await self.connect(SecondRelayConsumer)
+        try:
+            await first.send_json_to({'text': 'привет'})
+            self.assertEqual(await first.receive_json_from(), {'text': 'привет'})
+            self.assertEqual(await second.receive_json_from(), {'text': 'привет'})
+            # Каждый процесс получает публикацию один раз, а не по разу на сокет
+            self.assertTrue(await second.receive_nothing())
+        finally:
+            await first.disconnect()
+            await second.disconnect()
+            await self.close_layers()
+
+    async def test_send_to_channel_of_other_instance(self):
+        first, _ = await self.connect(RelayConsumer)
+        second, channel = await self.connect(SecondRelayConsumer)
+        try:
+            await first.send_json_to({'text': 'лично', 'channel': channel})
+            self.assertEqual(await second.receive_json_from(), {'text': 'лично'})
+            self.assertTrue(await first.receive_nothing())
+        finally:
+            await first.disconnect()
+            await second.disconnect()
+            await self.close_layers()
+
+    async def test_group_discard_unsubscribes(self):
+        first, _ = await self.connect(RelayConsumer)
+        second, _ = await self.connect(SecondRelayConsumer)
+        layer = get_channel_layer('second')
+        topic = layer._group_topic('room')
+        try:
+            self.assertIn(topic, layer._subscriptions)
+            await second.disconnect()
+            self.assertNotIn('room', layer.groups)
+            self.assertNotIn(topic, layer._subscriptions)
+            # Остался только подписчик первого экземпляра
+            self.assertEqual(len(LocalBroker._subscribers[topic]), 1)
+
+            await first.send_json_to({'text': 'после выхода'})
+            self.assertEqual(await first.receive_json_from(), {'text': 'после выхода'})
+        finally:
+            await first.disconnect()
+            await self.close_layers()
+        self.assertNotIn(topic, LocalBroker._subscribers)
+
+
+class ChannelExpiryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = PubSubChannelLayer(prefix='expiry', expiry=0.05, group_expiry=3600)
+        self.layer.clean_interval = 0
+
+    def tearDown(self):
+        asyncio.run(self.layer.close())
+
+    async def test_send_does_not_open_unknown_channel(self):
+        channel = f'specific..{self.layer.client_prefix}!never'
+        for _ in range(self.layer.capacity + 1):
+            await self.layer.send(channel, {'type': 'relay'})
+        self.assertNotIn(channel, self.layer.channels)
+
+    async def test_unread_channel_leaves_its_groups(self):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add('room', channel)
+        await self.layer.group_send('room', {'type': 'relay'})
+        self.assertEqual(self.layer.channels[channel].qsize(), 1)
+
+        await asyncio.sleep(0.1)
+        await self.layer.group_send('room', {'type': 'relay'})
+        self.assertNotIn(channel, self.layer.channels)
+        self.assertNotIn('room', self.layer.groups)
+        self.assertNotIn(self.layer._group_topic('room'), self.layer._subscriptions)
+
+    async def test_channel_stays_open_while_read(self):
+        channel = await self.layer.new_channel()
+        receive = asyncio.ensure_future(self.layer.receive(channel))
+        await asyncio.sleep(0.1)
+        await self.layer.send(channel, {'type': 'relay'})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {'type': 'relay'})
+
+    async def test_group_membership_expires(self):
+        self.layer.group_expiry = 0
+        channel = await self.layer.new_channel()
+        await self.layer.group_add('room', channel)
+        await asyncio.sleep(0.01)
+        await self.layer.group_send('other', {'type': 'relay'})
+        self.assertNotIn('room', self.layer.groups)
@@ -0,0 +1,158 @@
+# chat/tests/test_migrations.py
+"""Миграции данных: состояние до миграции строится историческими моделями"""
+from datetime import timedelta
+
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Откатить схему к migrate_from, заполнить её и применить migrate_to"""
+
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate([self.migrate_from])
+        self.seed(executor.loader.project_state([self.migrate_from]).apps)
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([self.migrate_to])
+        self.apps = executor.loader.project_state([self.migrate_to]).apps
+
+    def tearDown(self):
+        # Остальные тесты работают с последней схемой
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def seed(self, apps):
+        pass
+
+
+class PrivateChatPairKeyMigrationTest(MigrationTestCase):
+    """0014: ключ пары участников и слияние дублей личных чатов"""
+
+    migrate_from = ('chat', '0013_profile_counters')
+    migrate_to = ('chat', '0014_private_chat_pair_key')
+
+    def seed(self, apps):
+        User = apps.get_model('auth', 'User')
+        PrivateChat = apps.get_model('chat', 'PrivateChat')
+        PrivateChatMembership = apps.get_model('chat', 'PrivateChatMembership')
+        PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+        ArchivedBlock = apps.get_model('chat', 'ArchivedBlock')
+
+        self.anna, self.boris, self.vera = (
+            User.objects.create(username=name, password='!') for name in ('anna', 'boris', 'vera')
+        )
+        started = timezone.now() - timedelta(hours=1)
+
+        def chat(*users, message_count=0):
+            created = PrivateChat.objects.create(message_count=message_count)
+            created.participants.add(*users)
+            return created
+
+        def message(chat, sender, content, minutes):
+            return PrivateMessage.objects.create(
+                chat=chat, sender=sender, content=content, timestamp=started + timedelta(minutes=minutes),
+            )
+
+        # Две копии чата anna–boris (вторая — с сообщением в архиве) и чат anna–vera без дублей
+        self.first = chat(self.boris, self.anna, message_count=2)
+        self.second = chat(self.anna, self.boris, message_count=3)
+        self.single = chat(self.anna, self.vera, message_count=1)
+
+        self.messages = [
+            message(self.first, self.anna, 'первое', 0),
+            message(self.first, self.boris, 'второе', 1),
+            message(self.second, self.anna, 'третье', 2),
+            message(self.second, self.boris, 'последнее\n  сообщение', 3),
+        ]
+        message(self.single, self.vera, 'отдельный чат', 4)
+
+        memberships = [
+            (self.anna, self.first, self.messages[1].id),
+            (self.boris, self.first, 0),
+            (self.anna, self.second, self.messages[2].id),
+            (self.boris, self.second, self.messages[3].id),
+        ]
+        for user, chat_, last_read in memberships:
+            PrivateChatMembership.objects.create(user=user, chat=chat_, last_read_message_id=last_read, unread_count=9)
+
+        self.block = ArchivedBlock.objects.create(
+            kind='private', conversation_id=self.second.id, segment='private/2026-01.seg', offset=0, length=10,
+            message_count=1, first_timestamp=started, first_id=1, last_timestamp=started, last_id=1,
+        )
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO chat_search (rowid, body, conversation_id) VALUES (%s, %s, %s)',
+                    [(item.id * 4 + 1, item.content, item.chat_id) for item in self.messages],
+                )
+
+    def test_duplicates_are_merged_into_oldest_chat(self):
+        PrivateChat = self.apps.get_model('chat', 'PrivateChat')
+        PrivateMessage = self.apps.get_model('chat', 'PrivateMessage')
+        ArchivedBlock = self.apps.get_model('chat', 'ArchivedBlock')
+
+        pair = PrivateChat.objects.filter(participants=self.anna.id).filter(participants=self.boris.id)
+        self.assertEqual(list(pair.values_list('id', flat=True)), [self.first.id])
+        self.assertFalse(PrivateChat.objects.filter(id=self.second.id).exists())
+        self.assertEqual(
+            list(PrivateMessage.objects.filter(chat_id=self.first.id).order_by('id').values_list('id', flat=True)),
+            [item.id for item in self.messages],
+        )
+        self.assertEqual(ArchivedBlock.objects.get(id=self.block.id).conversation_id, self.first.id)
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT DISTINCT conversation_id FROM chat_search')
+                self.assertEqual(cursor.fetchall(), [(self.first.id,)])
+
+    def test_watermarks_take_the_earliest_and_unread_is_recounted(self):
+        PrivateChatMembership = self.apps.get_model('chat', 'PrivateChatMembership')
+
+        memberships = PrivateChatMembership.objects.filter(chat_id=self.first.id)
+        self.assertEqual(
+            {row.user_id: (row.last_read_message_id, row.unread_count) for row in memberships},
+            {
+                # anna прочитала «второе» в первом чате и «третье» во втором: остаётся меньшая метка
+                self.anna.id: (self.messages[1].id, 1),
+                self.boris.id: (0, 2),
+            },
+        )
+        self.assertEqual(PrivateChatMembership.objects.count(), 2)
+
+    def test_summary_is_recomputed(self):
+        PrivateChat = self.apps.get_model('chat', 'PrivateChat')
+
+        chat = PrivateChat.objects.get(id=self.first.id)
+        last = self.messages[-1]
+        self.assertEqual(chat.last_message_id, last.id)
+        self.assertEqual(chat.last_message_sender_id, self.boris.id)
+        self.assertEqual(chat.last_message_preview, 'последнее сообщение')
+        self.assertEqual(chat.last_message_at, last.timestamp)
+        # Сообщение в архиве учтено из счётчика дубля
+        self.assertEqual(chat.message_count, 5)
+
+    def test_pair_key_is_set_and_unique(self):
+        PrivateChat = self.apps.get_model('chat', 'PrivateChat')
+
+        low, high = sorted((self.anna.id, self.boris.id))
+        self.assertEqual(
+            PrivateChat.objects.filter(id=self.first.id).values_list('user_low_id', 'user_high_id').get(),
+            (low, high),
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PrivateChat.objects.create(user_low_id=low, user_high_id=high)
+
+        low, high = sorted((self.anna.id, self.vera.id))
+        self.assertEqual(
+            PrivateChat.objects.filter(id=self.single.id).values_list('user_low_id', 'user_high_id').get(),
+            (low, high),
+        )
@@ -0,0 +1,131 @@
+# chat/tests/test_persistence.py
+"""Пакетная запись сообщений (chat/persistence.py).
+
+Запись идёт в пуле потоков БД, поэтому TransactionTestCase: строки должны
+быть видны из других соединений.
+"""
+import asyncio
+import threading
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+
+from chat.models import Message
+from chat.persistence import PERSISTENCE_BATCHED, PERSISTENCE_SYNC, MessageWriter
+
+
+class MessageWriterTest(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', password='testpass123')
+
+    def writer(self, **options):
+        options = {'mode': PERSISTENCE_BATCHED, 'batch_size': 100, 'flush_interval': 60, 'queue_size': 100, **options}
+        writer = MessageWriter(**options)
+        # Размеры записанных пачек; ждём по ним, а не опросом БД: SQLite в памяти
+        # запрещает чтение таблицы, пока другое соединение в неё пишет
+        writer.batches = []
+        write_batch = writer._write_batch
+
+        def record(batch):
+            notifications = write_batch(batch)
+            writer.batches.append(len(batch))
+            return notifications
+
+        writer._write_batch = record
+        return writer
+
+    async def count(self):
+        return await sync_to_async(Message.objects.filter(user=self.user).count)()
+
+    async def wait_written(self, writer, expected, timeout=2):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while sum(writer.batches) < expected and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        return sum(writer.batches)
+
+    async def stop(self, writer):
+        writer._task.cancel()
+        await asyncio.gather(writer._task, return_exceptions=True)
+
+    async def test_full_batch_is_written_without_waiting_for_interval(self):
+        writer = self.writer(batch_size=3)
+        for i in range(3):
+            await writer.save(Message, user_id=self.user.id, content=f'пачка {i}')
+        self.assertEqual(await self.wait_written(writer, 3), 3)
+        self.assertEqual(writer.batches, [3])
+        self.assertEqual(await self.count(), 3)
+        await self.stop(writer)
+
+    async def test_partial_batch_is_written_after_interval(self):
+        writer = self.writer(flush_interval=0.5)
+        await writer.save(Message, user_id=self.user.id, content='одно')
+        await asyncio.sleep(0.1)
+        self.assertEqual(writer.batches, [])
+        self.assertEqual(await self.wait_written(writer, 1), 1)
+        self.assertEqual(await self.count(), 1)
+        await self.stop(writer)
+
+    async def test_items_arriving_during_interval_join_the_batch(self):
+        writer = self.writer(flush_interval=0.3)
+        for i in range(5):
+            await writer.save(Message, user_id=self.user.id, content=f'окно {i}')
+            await asyncio.sleep(0.02)
+        self.assertEqual(await self.wait_written(writer, 5), 5)
+        self.assertEqual(writer.batches, [5])
+        await self.stop(writer)
+
+    async def test_full_queue_makes_sender_wait(self):
+        writer = self.writer(batch_size=1, queue_size=2)
+        release = threading.Event()
+        write_batch = writer._write_batch
+
+        def blocked(batch):
+            release.wait(5)
+            return write_batch(batch)
+
+        writer._write_batch = blocked
+        # Первое сообщение забирает фоновая задача, следующие два заполняют очередь
+        for i in range(3):
+            await writer.save(Message, user_id=self.user.id, content=f'очередь {i}')
+        await asyncio.sleep(0.05)
+        waiting = asyncio.ensure_future(writer.save(Message, user_id=self.user.id, content='ждёт'))
+        await asyncio.sleep(0.2)
+        self.assertFalse(waiting.done())
+
+        release.set()
+        await asyncio.wait_for(waiting, 2)
+        self.assertEqual(await self.wait_written(writer, 4), 4)
+        self.assertEqual(await self.count(), 4)
+        await self.stop(writer)
+
+    async def test_broken_row_does_not_lose_batch(self):
+        writer = self.writer()
+        with self.assertLogs('chat.persistence', 'WARNING') as logs:
+            await writer.save(Message, user_id=self.user.id, content='первое')
+            await writer.save(Message, user_id=self.user.id + 1000, content='нет такого пользователя')
+            await writer.save(Message, user_id=self.user.id, content='второе')
+            # flush ждёт и пачку, которую уже пишет фоновая задача
+            await writer.flush()
+        self.assertEqual(await self.count(), 2)
+        self.assertEqual(await sync_to_async(Message.objects.count)(), 2)
+        self.assertTrue(any('по одному' in line for line in logs.output))
+        await self.stop(writer)
+
+    async def test_sync_mode_writes_before_returning(self):
+        writer = self.writer(mode=PERSISTENCE_SYNC)
+        await writer.save(Message, user_id=self.user.id, content='сразу')
+        self.assertEqual(await self.count(), 1)
+        self.assertIsNone(writer._task)
+
+    async def test_cancelled_writer_flushes_queue(self):
+        writer = self.writer()
+        for i in range(3):
+            await writer.save(Message, user_id=self.user.id, content=f'остановка {i}')
+        await asyncio.sleep(0.05)
+        self.assertEqual(writer.batches, [])
+        # Так фоновую задачу отменяет остановка цикла событий
+        await self.stop(writer)
+        self.assertEqual(await self.count(), 3)
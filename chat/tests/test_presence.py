@@ -0,0 +1,83 @@
+# chat/tests/test_presence.py
+"""Снимок присутствия (chat/presence.py) по общим счётчикам брокера.
+
+Второй экземпляр слоя на том же брокере local играет роль другого процесса.
+Имена его пользователей читаются в пуле потоков БД, поэтому TransactionTestCase.
+"""
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from chat.layers import LocalBroker
+from chat.models import OnlineUser
+from chat.presence import PresenceTracker
+
+LAYERS = {
+    alias: {
+        'BACKEND': 'chat.layers.PubSubChannelLayer',
+        'CONFIG': {'broker': 'local', 'prefix': 'presence'},
+    }
+    for alias in ('default', 'second')
+}
+
+
+@override_settings(CHANNEL_LAYERS=LAYERS)
+class PresenceSnapshotTest(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='testpass123')
+        self.bob = User.objects.create_user(username='bob', password='testpass123')
+        self.tracker = PresenceTracker(group='presence_test', window=0.01, heartbeat=3600)
+
+    def tearDown(self):
+        LocalBroker._presence.clear()
+
+    async def stop(self):
+        for task in (self.tracker._flush_task, self.tracker._heartbeat_task):
+            if task is not None:
+                task.cancel()
+        for alias in LAYERS:
+            await get_channel_layer(alias).close()
+
+    async def refresh(self):
+        # Снимок кэшируется на окно
+        await asyncio.sleep(self.tracker.window * 2)
+        return await self.tracker.snapshot()
+
+    async def test_snapshot_includes_users_of_other_processes(self):
+        second = get_channel_layer('second')
+        try:
+            await self.tracker.join(self.alice)
+            await second.presence_change('presence_test', self.bob.id, 1, 90)
+            self.assertEqual(await self.tracker.snapshot(), ['alice', 'bob'])
+            # Снимок не зависит от OnlineUser, который пишется по сердцебиению
+            self.assertFalse(await OnlineUser.objects.aexists())
+
+            await second.presence_change('presence_test', self.bob.id, -1, 90)
+            self.assertEqual(await self.refresh(), ['alice'])
+        finally:
+            await self.stop()
+
+    async def test_user_connected_elsewhere_stays_online(self):
+        second = get_channel_layer('second')
+        try:
+            await self.tracker.join(self.alice)
+            await second.presence_change('presence_test', self.alice.id, 1, 90)
+            await self.tracker.leave(self.alice)
+            self.assertEqual(await self.refresh(), ['alice'])
+
+            await second.presence_change('presence_test', self.alice.id, -1, 90)
+            self.assertEqual(await self.refresh(), [])
+        finally:
+            await self.stop()
+
+    async def test_leave_hides_user_from_cached_snapshot(self):
+        try:
+            await self.tracker.join(self.alice)
+            self.assertEqual(await self.tracker.snapshot(), ['alice'])
+            await self.tracker.leave(self.alice)
+            self.assertEqual(await self.tracker.snapshot(), [])
+        finally:
+            await self.stop()
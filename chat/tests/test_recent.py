@@ -0,0 +1,82 @@
+# chat/tests/test_recent.py
+"""Кольцевой буфер комнаты (chat/recent.py) и его хранение в брокере"""
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from chat.access import room_group
+from chat.history import HISTORY_GENERAL, history_page
+from chat.layers import LocalBroker
+from chat.models import Message
+from chat.recent import remember, room_page
+
+
+class LocalBrokerRecentTest(TestCase):
+
+    def setUp(self):
+        LocalBroker._recent.clear()
+
+    def tearDown(self):
+        LocalBroker._recent.clear()
+
+    def test_least_recently_used_buffers_are_evicted(self):
+        broker = LocalBroker(recent_rooms=2)
+        async_to_sync(broker.append_recent)('first', 'a', 10)
+        async_to_sync(broker.append_recent)('second', 'b', 10)
+        async_to_sync(broker.recent)('first')
+        async_to_sync(broker.append_recent)('third', 'c', 10)
+
+        self.assertEqual(list(LocalBroker._recent), ['first', 'third'])
+        self.assertEqual(async_to_sync(broker.recent)('second'), (0, []))
+        self.assertEqual(async_to_sync(broker.recent)('first'), (1, [(1, 'a')]))
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=1)
+class RoomPageTest(TestCase):
+
+    def setUp(self):
+        LocalBroker._recent.clear()
+        self.user = User.objects.create_user(username='reader', password='testpass123')
+
+    def tearDown(self):
+        LocalBroker._recent.clear()
+
+    def post(self, content, timestamp):
+        message = Message.objects.create(user=self.user, content=content, timestamp=timestamp)
+        async_to_sync(remember)(room_group(HISTORY_GENERAL, None), {
+            'type': 'message',
+            'message': content,
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'avatar_url': None,
+            'timestamp': timestamp.isoformat(),
+        })
+        return message
+
+    def test_history_continues_with_message_of_the_same_timestamp(self):
+        now = timezone.now()
+        older = self.post('раньше', now - timedelta(seconds=1))
+        same_time = self.post('в ту же микросекунду', now)
+        self.post('последнее', now)
+
+        messages, cursor, seq = room_page(HISTORY_GENERAL)
+        self.assertEqual([message['message'] for message in messages], ['последнее'])
+        self.assertEqual(seq, 3)
+
+        rows, cursor = history_page(HISTORY_GENERAL, cursor=cursor)
+        self.assertEqual([row.id for row in rows], [same_time.id])
+        rows, _ = history_page(HISTORY_GENERAL, cursor=cursor)
+        self.assertEqual([row.id for row in rows], [older.id])
+
+    def test_history_takes_all_rows_of_the_timestamp_while_message_is_queued(self):
+        now = timezone.now()
+        same_time = self.post('уже в БД', now)
+        self.post('ещё в очереди записи', now)
+        Message.objects.filter(content='ещё в очереди записи').delete()
+
+        _, cursor, _ = room_page(HISTORY_GENERAL)
+        rows, _ = history_page(HISTORY_GENERAL, cursor=cursor)
+        self.assertEqual([row.id for row in rows], [same_time.id])
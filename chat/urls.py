@@ -28,5 +28,10 @@ urlpatterns = [
     path('groups/<int:group_id>/leave/', views.leave_group, name='leave_group'),
     path('user/<int:user_id>/', views.user_profile_view, name='user_profile'),
     path('like/<int:user_id>/', views.toggle_like, name='toggle_like'),
+    path('history/', views.message_history, name='message_history'),
+    path('history/<str:kind>/<int:conversation_id>/', views.message_history, name='conversation_history'),
+    path('search/', views.search_messages, name='search_messages'),
+    path('users/search/', views.search_users, name='search_users'),
+    path('stats/outbound/', views.outbound_stats, name='outbound_stats'),
     path('test/', test_websocket, name='test_websocket'),
 ]
\ No newline at end of file
@@ -1,35 +1,50 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.forms import ModelForm
-from .models import Message, OnlineUser, UserProfile
+from .access import has_access, member_role
+from .history import HISTORY_GENERAL, HISTORY_GROUP, HISTORY_PRIVATE, get_history
+from .models import GroupMembership, Message, OnlineUser, PrivateChatMembership, UserProfile
+from .presence import online_cutoff
+from .receipts import mark_read
+from .recent import room_page
 
 @login_required
 def room(request):
     # Получить или создать профиль для текущего пользователя
     user_profile, created = UserProfile.objects.get_or_create(user=request.user)
     
-    # Получить сообщения с попыткой загрузить профили пользователей
-    messages = Message.objects.select_related('user').prefetch_related('user__userprofile').order_by('timestamp')[:100]
-    online_users = OnlineUser.objects.select_related('user').values_list('user__username', flat=True)
+    # Только последняя страница сообщений (из буфера комнаты); более ранние подгружаются через history
+    messages, history_cursor, last_seq = room_page(HISTORY_GENERAL)
+    online_users = OnlineUser.objects.filter(last_seen__gte=online_cutoff()).values_list('user__username', flat=True)
     
-    # Создать профили для пользователей, у которых их нет
-    users_without_profiles = []
+    # Лайки авторов — из счётчиков профилей, одним запросом на страницу
+    likes = dict(
+        UserProfile.objects.filter(user_id__in={msg['user_id'] for msg in messages})
+        .values_list('user_id', 'likes_received')
+    )
     for msg in messages:
-        if not hasattr(msg.user, 'userprofile'):
-            users_without_profiles.append(msg.user)
-    
-    if users_without_profiles:
-        for user in users_without_profiles:
-            UserProfile.objects.get_or_create(user=user)
+        msg['likes'] = likes.get(msg['user_id'], 0)
+    
+    # Непрочитанное по разговорам для значков; дальше их обновляют уведомления сокета
+    unread = {
+        **{f'{HISTORY_PRIVATE}:{chat_id}': n for chat_id, n in PrivateChatMembership.objects.filter(
+            user=request.user, unread_count__gt=0).values_list('chat_id', 'unread_count')},
+        **{f'{HISTORY_GROUP}:{group_id}': n for group_id, n in GroupMembership.objects.filter(
+            user=request.user, unread_count__gt=0).values_list('group_id', 'unread_count')},
+    }
     
     return render(request, 'chat/room.html', {
         'messages': messages,
         'online_users': list(online_users),
         'user_profile': user_profile,
+        'history_cursor': history_cursor,
+        'last_seq': last_seq,
+        'unread': unread,
     })
 
 def register(request):
@@ -66,7 +81,7 @@ def profile(request):
     profile, created = UserProfile.objects.get_or_create(user=request.user)
     
     user_messages = Message.objects.filter(user=request.user).order_by('-timestamp')[:50]
-    total_messages = Message.objects.filter(user=request.user).count()
+    total_messages = profile.messages_sent
     
     if request.method == 'POST':
         form = ProfileForm(request.POST, request.FILES, instance=profile)
@@ -89,56 +104,63 @@ def profile(request):
 @login_required
 def private_chats(request):
     """Список всех приватных чатов пользователя"""
-    from .models import PrivateChat, PrivateMessage
-    
-    # Получить все чаты пользователя
-    chats = PrivateChat.objects.filter(participants=request.user).prefetch_related('participants', 'messages')
+    from django.db.models import F, Prefetch
+    from .models import PrivateChatMembership
+    
+    # Сводки чатов, счётчики непрочитанного и лайков — без запросов к сообщениям и лайкам
+    participants = User.objects.select_related('userprofile').annotate(likes_count=F('userprofile__likes_received'))
+    memberships = (
+        PrivateChatMembership.objects.filter(user=request.user)
+        .select_related('chat', 'chat__last_message_sender')
+        .prefetch_related(Prefetch('chat__participants', queryset=participants))
+        .order_by(F('chat__last_message_at').desc(nulls_last=True), '-chat__created_at')
+    )
     
     # Подготовить данные для отображения
     chat_data = []
-    for chat in chats:
-        other_user = chat.get_other_user(request.user)
-        last_message = chat.messages.last()
-        unread_count = chat.messages.filter(is_read=False).exclude(sender=request.user).count()
+    for membership in memberships:
+        chat = membership.chat
+        other_user = next((u for u in chat.participants.all() if u.id != request.user.id), None)
         
         chat_data.append({
             'chat': chat,
             'other_user': other_user,
-            'last_message': last_message,
-            'unread_count': unread_count,
+            'last_message': chat.get_last_message(),
+            'unread_count': membership.unread_count,
         })
     
-    # Получить всех пользователей для начала нового чата
-    all_users = User.objects.exclude(id=request.user.id).select_related('userprofile')
-    
+    # Пользователи для нового чата подгружаются страницами через search_users
     context = {
         'chat_data': chat_data,
-        'all_users': all_users,
     }
     return render(request, 'chat/private_chats.html', context)
 
 @login_required
 def private_chat_room(request, chat_id):
     """Комната для приватного чата"""
-    from .models import PrivateChat, PrivateMessage
+    from .models import PrivateChat
     
-    try:
-        chat = PrivateChat.objects.get(id=chat_id, participants=request.user)
-    except PrivateChat.DoesNotExist:
+    # Доступ — одним запросом по участникам чата (HTTP не пользуется индексом сокетов)
+    chat = None
+    if has_access(HISTORY_PRIVATE, chat_id, request.user.id):
+        chat = PrivateChat.objects.filter(id=chat_id).first()
+    if chat is None:
         messages.error(request, 'Чат не найден или у вас нет доступа к нему.')
         return redirect('private_chats')
     
-    # Отметить сообщения как прочитанные
-    chat.messages.filter(is_read=False).exclude(sender=request.user).update(is_read=True)
+    # Отметить чат прочитанным: сдвиг метки вместо UPDATE по сообщениям
+    mark_read(HISTORY_PRIVATE, chat.id, request.user.id)
     
-    # Получить сообщения
-    chat_messages = chat.messages.select_related('sender', 'sender__userprofile').all()
+    # Последняя страница сообщений — из буфера комнаты, если он её покрывает
+    chat_messages, history_cursor, last_seq = room_page(HISTORY_PRIVATE, chat.id)
     other_user = chat.get_other_user(request.user)
     
     context = {
         'chat': chat,
         'messages': chat_messages,
         'other_user': other_user,
+        'history_cursor': history_cursor,
+        'last_seq': last_seq,
     }
     return render(request, 'chat/private_chat_room.html', context)
 
@@ -157,45 +179,40 @@ def start_private_chat(request, user_id):
         messages.error(request, 'Нельзя создать чат с самим собой.')
         return redirect('private_chats')
     
-    # Проверить, существует ли уже чат между этими пользователями
-    existing_chat = PrivateChat.objects.filter(
-        participants=request.user
-    ).filter(
-        participants=other_user
-    ).first()
-    
-    if existing_chat:
-        return redirect('private_chat_room', chat_id=existing_chat.id)
+    # Существующий чат находится по ключу пары; одновременные клики не создают дубликат
+    chat, created = PrivateChat.between(request.user.id, other_user.id)
     
-    # Создать новый чат
-    chat = PrivateChat.objects.create()
-    chat.participants.add(request.user, other_user)
-    
-    messages.success(request, f'Чат с {other_user.username} создан!')
+    if created:
+        messages.success(request, f'Чат с {other_user.username} создан!')
     return redirect('private_chat_room', chat_id=chat.id)
 
 @login_required
 def groups_list(request):
     """Список всех групп пользователя"""
+    from django.db.models import F
     from .models import Group, GroupMembership
     
-    # Группы пользователя
-    user_groups = Group.objects.filter(members=request.user).prefetch_related('members', 'messages')
+    # Членства пользователя вместе с группами и их сводками
+    memberships = (
+        GroupMembership.objects.filter(user=request.user)
+        .select_related('group', 'group__last_message_sender')
+        .order_by(F('group__last_message_at').desc(nulls_last=True), '-group__created_at')
+    )
     
     # Публичные группы (не приватные)
     public_groups = Group.objects.filter(is_private=False).exclude(members=request.user)[:10]
     
     # Подготовить данные для групп пользователя
     group_data = []
-    for group in user_groups:
-        last_message = group.messages.last()
-        membership = GroupMembership.objects.get(user=request.user, group=group)
+    for membership in memberships:
+        group = membership.group
         
         group_data.append({
             'group': group,
-            'last_message': last_message,
+            'last_message': group.get_last_message(),
             'membership': membership,
-            'member_count': group.members.count(),
+            'member_count': group.member_count,
+            'unread_count': membership.unread_count,
         })
     
     context = {
@@ -247,28 +264,32 @@ def create_group(request):
 @login_required
 def group_room(request, group_id):
     """Комната группового чата"""
-    from .models import Group, GroupMessage, GroupMembership
+    from .models import Group, GroupMembership
     
-    try:
-        group = Group.objects.get(id=group_id, members=request.user)
-    except Group.DoesNotExist:
+    group = Group.objects.filter(id=group_id).first()
+    
+    # Участники группы; доступ и роль текущего пользователя — по этому же списку
+    memberships = []
+    if group is not None:
+        memberships = list(GroupMembership.objects.filter(group=group).select_related('user', 'user__userprofile'))
+    user_membership = next((m for m in memberships if m.user_id == request.user.id), None)
+    if user_membership is None:
         messages.error(request, 'Группа не найдена или у вас нет доступа к ней.')
         return redirect('groups_list')
     
-    # Получить сообщения
-    group_messages = group.messages.select_related('sender', 'sender__userprofile').all()
-    
-    # Получить участников
-    memberships = GroupMembership.objects.filter(group=group).select_related('user', 'user__userprofile')
+    # Последняя страница сообщений — из буфера комнаты, если он её покрывает
+    group_messages, history_cursor, last_seq = room_page(HISTORY_GROUP, group.id)
     
-    # Роль текущего пользователя
-    user_membership = GroupMembership.objects.get(user=request.user, group=group)
+    # Группа открыта — прочитано всё до последнего сообщения
+    mark_read(HISTORY_GROUP, group.id, request.user.id)
     
     context = {
         'group': group,
         'messages': group_messages,
         'memberships': memberships,
         'user_membership': user_membership,
+        'history_cursor': history_cursor,
+        'last_seq': last_seq,
     }
     return render(request, 'chat/group_room.html', context)
 
@@ -287,7 +308,7 @@ def join_group(request, group_id):
         messages.error(request, 'Это приватная группа. Нужно приглашение.')
         return redirect('groups_list')
     
-    if GroupMembership.objects.filter(user=request.user, group=group).exists():
+    if has_access(HISTORY_GROUP, group.id, request.user.id):
         messages.info(request, 'Вы уже участник этой группы.')
         return redirect('group_room', group_id=group.id)
     
@@ -306,21 +327,20 @@ def leave_group(request, group_id):
     """Покинуть группу"""
     from .models import Group, GroupMembership
     
-    try:
-        group = Group.objects.get(id=group_id, members=request.user)
-        membership = GroupMembership.objects.get(user=request.user, group=group)
-    except (Group.DoesNotExist, GroupMembership.DoesNotExist):
+    role = member_role(HISTORY_GROUP, group_id, request.user.id)
+    group = Group.objects.filter(id=group_id).first() if role is not None else None
+    if group is None:
         messages.error(request, 'Группа не найдена.')
         return redirect('groups_list')
     
-    if membership.role == 'admin' and group.members.count() > 1:
+    if role == 'admin' and group.member_count > 1:
         # Проверить, есть ли другие администраторы
         other_admins = GroupMembership.objects.filter(group=group, role='admin').exclude(user=request.user)
         if not other_admins.exists():
             messages.error(request, 'Нельзя покинуть группу. Назначьте другого администратора.')
             return redirect('group_room', group_id=group.id)
     
-    membership.delete()
+    GroupMembership.objects.filter(user=request.user, group=group).delete()
     
     # Если это был последний участник, удалить группу
     if group.members.count() == 0:
@@ -335,6 +355,7 @@ def leave_group(request, group_id):
 def toggle_like(request, user_id):
     """Поставить или убрать лайк пользователю"""
     from .models import UserLike
+    from django.db import transaction
     from django.http import JsonResponse
     
     if request.method != 'POST':
@@ -348,22 +369,24 @@ def toggle_like(request, user_id):
     if target_user == request.user:
         return JsonResponse({'error': 'Нельзя лайкнуть самого себя'}, status=400)
     
-    # Проверить, есть ли уже лайк
-    like, created = UserLike.objects.get_or_create(
-        from_user=request.user,
-        to_user=target_user
-    )
-    
-    if not created:
-        # Лайк уже есть, убираем его
-        like.delete()
-        liked = False
-    else:
-        # Новый лайк
-        liked = True
-    
-    # Получить новое количество лайков
-    likes_count = target_user.received_likes.count()
+    # Лайк и счётчики профилей (сигналы UserLike) меняются в одной транзакции
+    with transaction.atomic():
+        # Проверить, есть ли уже лайк
+        like, created = UserLike.objects.get_or_create(
+            from_user=request.user,
+            to_user=target_user
+        )
+        
+        if not created:
+            # Лайк уже есть, убираем его
+            like.delete()
+            liked = False
+        else:
+            # Новый лайк
+            liked = True
+        
+        # Новое количество лайков — из счётчика профиля
+        likes_count = UserProfile.objects.filter(user=target_user).values_list('likes_received', flat=True).first() or 0
     
     return JsonResponse({
         'liked': liked,
@@ -389,7 +412,7 @@ def user_profile_view(request, user_id):
     
     # Статистика пользователя
     user_messages = Message.objects.filter(user=target_user).order_by('-timestamp')[:20]
-    total_messages = Message.objects.filter(user=target_user).count()
+    total_messages = profile.messages_sent
     
     # Группы пользователя (только публичные)
     from .models import Group
@@ -405,4 +428,111 @@ def user_profile_view(request, user_id):
         'user_groups': user_groups,
         'join_date': target_user.date_joined,
     }
-    return render(request, 'chat/user_profile.html', context)
\ No newline at end of file
+    return render(request, 'chat/user_profile.html', context)
+
+@login_required
+def message_history(request, kind=HISTORY_GENERAL, conversation_id=None):
+    """История сообщений в JSON: последняя страница или страница до курсора ?before="""
+    from django.http import JsonResponse
+    
+    if kind in (HISTORY_PRIVATE, HISTORY_GROUP):
+        allowed = has_access(kind, conversation_id, request.user.id)
+    elif kind == HISTORY_GENERAL:
+        allowed = True
+    else:
+        return JsonResponse({'error': 'Неизвестный тип чата'}, status=404)
+    
+    if not allowed:
+        return JsonResponse({'error': 'Чат не найден или у вас нет доступа к нему'}, status=404)
+    
+    try:
+        limit = int(request.GET.get('limit') or 0)
+        history = get_history(kind, conversation_id, request.GET.get('before'), min(limit, 200) if limit > 0 else None)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+    
+    return JsonResponse(history)
+
+@login_required
+def search_messages(request):
+    """Поиск по сообщениям доступных пользователю чатов: ?q= (``слово*`` — префикс), ?kind=&conversation=, ?offset="""
+    from django.http import JsonResponse
+    from . import search
+    
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'Пустой поисковый запрос'}, status=400)
+    
+    kind = request.GET.get('kind') or None
+    conversation_id = request.GET.get('conversation') or None
+    try:
+        offset = int(request.GET.get('offset') or 0)
+        limit = int(request.GET.get('limit') or 0)
+        if conversation_id is not None:
+            conversation_id = int(conversation_id)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+    
+    if kind in (HISTORY_PRIVATE, HISTORY_GROUP):
+        if conversation_id is None or not has_access(kind, conversation_id, request.user.id):
+            return JsonResponse({'error': 'Чат не найден или у вас нет доступа к нему'}, status=404)
+    elif kind not in (None, HISTORY_GENERAL):
+        return JsonResponse({'error': 'Неизвестный тип чата'}, status=404)
+    
+    try:
+        result = search.search_messages(
+            request.user.id, query, kind, conversation_id, offset, min(limit, 100) if limit > 0 else None,
+        )
+    except search.SearchUnavailable:
+        return JsonResponse({'error': 'Поиск недоступен на этой базе данных'}, status=503)
+    return JsonResponse(result)
+
+@login_required
+def search_users(request):
+    """Пользователи для нового чата: ?q= — начало имени, ?after= — имя, после которого продолжить"""
+    from django.http import JsonResponse
+    from .directory import search_users as find_users
+    
+    try:
+        limit = int(request.GET.get('limit') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+    
+    result = find_users(
+        request.GET.get('q', '').strip(), request.user.id, request.GET.get('after') or None,
+        min(limit, 100) if limit > 0 else None,
+    )
+    return JsonResponse(result)
+
+@staff_member_required
+def outbound_stats(request):
+    """Отставание клиентов WebSocket этого процесса: глубина очередей и сброшенные кадры"""
+    from django.http import JsonResponse
+    from .outbound import outbound_metrics
+    
+    return JsonResponse(outbound_metrics.snapshot())
+
+def metrics(request):
+    """Метрики процесса для Prometheus: по токену CHAT_METRICS_TOKEN, без него — только персоналу"""
+    from django.conf import settings
+    from django.http import HttpResponse
+    from django.utils.crypto import constant_time_compare
+    from .metrics import registry
+    
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+    if token:
+        if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return HttpResponse(status=403)
+    elif not (request.user.is_active and request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def avatar_variant(request, name):
+    """Миниатюра аватарки: имя — хэш содержимого, поэтому кэшируется навсегда"""
+    from django.conf import settings
+    from django.views.static import serve
+    from .avatars import VARIANTS_DIR
+    
+    response = serve(request, f'{VARIANTS_DIR}/{name}', document_root=settings.MEDIA_ROOT)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
@@ -0,0 +1,110 @@
+# chat/wire.py
+"""Кодирование кадров WebSocket.
+
+Отправитель кодирует событие один раз и кладёт готовый кадр в сообщение
+channel layer, а обработчики получателей только пересылают его в сокет.
+
+Канонический кадр — текст JSON. Клиент может запросить двоичный формат
+подпротоколом WebSocket (``chat.msgpack`` или ``chat.cbor``, в порядке
+своего предпочтения); без подпротокола остаётся JSON. Двоичный кадр
+строится из JSON лениво, при отправке, и запоминается (binary_frame):
+событие комнаты перекодируется один раз на процесс и формат, а не на
+каждого получателя.
+"""
+import json
+from functools import lru_cache
+
+try:
+    import ujson
+except ImportError:  # ujson необязателен: без него работает стандартный json
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+PROTOCOL_JSON = 'chat.json'
+PROTOCOL_MSGPACK = 'chat.msgpack'
+PROTOCOL_CBOR = 'chat.cbor'
+
+# Сколько последних двоичных кадров помнить на процесс
+FRAME_MEMO_SIZE = 1024
+
+
+def encode_frame(payload):
+    """Закодировать данные в текстовый кадр JSON"""
+    if ujson is not None:
+        return ujson.dumps(payload, ensure_ascii=False)
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def decode_json(text):
+    if ujson is not None:
+        return ujson.loads(text)
+    return json.loads(text)
+
+
+# Подпротокол -> (кодировать, декодировать) для двоичных форматов
+BINARY_CODECS = {}
+if msgpack is not None:
+    BINARY_CODECS[PROTOCOL_MSGPACK] = (
+        lambda payload: msgpack.packb(payload, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+if cbor2 is not None:
+    BINARY_CODECS[PROTOCOL_CBOR] = (cbor2.dumps, cbor2.loads)
+
+PROTOCOLS = (PROTOCOL_JSON, *BINARY_CODECS)
+
+
+def negotiate(subprotocols):
+    """Первый из предложенных клиентом подпротоколов, который мы знаем, иначе None (JSON)"""
+    for protocol in subprotocols or ():
+        if protocol in PROTOCOLS:
+            return protocol
+    return None
+
+
+@lru_cache(maxsize=FRAME_MEMO_SIZE)
+def binary_frame(text, protocol):
+    """Двоичный кадр из канонического JSON (запоминается)"""
+    return BINARY_CODECS[protocol][0](decode_json(text))
+
+
+def decode_frame(text_data, bytes_data, protocol):
+    """Данные входящего кадра: двоичный — в формате подпротокола, текст — JSON"""
+    if bytes_data is not None:
+        if protocol not in BINARY_CODECS:
+            raise ValueError('Двоичный кадр без двоичного подпротокола')
+        return BINARY_CODECS[protocol][1](bytes_data)
+    return decode_json(text_data)
+
+
+class WireProtocolMixin:
+    """Примесь к AsyncWebsocketConsumer: выбор подпротокола и перекодирование кадров.
+
+    Стоит в MRO прямо перед AsyncWebsocketConsumer (после OutboundQueueMixin),
+    чтобы кадры, сброшенные очередью, не кодировались вовсе.
+    """
+
+    wire_protocol = None
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = negotiate(self.scope.get('subprotocols'))
+        self.wire_protocol = subprotocol
+        await super().accept(subprotocol, headers)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None and self.wire_protocol in BINARY_CODECS:
+            text_data, bytes_data = None, binary_frame(text_data, self.wire_protocol)
+        await super().send(text_data, bytes_data, close)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return decode_frame(text_data, bytes_data, self.wire_protocol)
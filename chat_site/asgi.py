@@ -1,15 +1,19 @@
-# chat_site/asgi.py
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import chat.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_site.settings')
 
+# Настроить Django до импорта консьюмеров: они импортируют модели
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+from chat.admission import AdmissionStack
+import chat.routing
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    # Допуск подключений (chat/admission.py) — до проверки сессии и консьюмера
+    "websocket": AdmissionStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
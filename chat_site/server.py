@@ -0,0 +1,110 @@
+"""Запуск daphne с поддержкой permessage-deflate для WebSocket.
+
+daphne не включает сжатие сам, но autobahn под ним его умеет: сервер
+принимает предложение клиента (заголовок Sec-WebSocket-Extensions), если
+CHAT_WS_DEFLATE включён. Кроме того, сокет получает в scope состояние
+буфера записи транспорта (chat/outbound.py), а при остановке сервер
+дописывает очередь пакетной записи сообщений (chat/persistence.py).
+Аргументы те же, что у daphne:
+
+    python -m chat_site.server chat_site.asgi:application --port 8000 --bind 0.0.0.0
+"""
+import asyncio
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from twisted.internet import defer
+
+
+def accept_deflate(offers):
+    """Принять первое предложение permessage-deflate; без него — без сжатия"""
+    from django.conf import settings
+
+    if not getattr(settings, 'CHAT_WS_DEFLATE', True):
+        return None
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer,
+                window_bits=getattr(settings, 'CHAT_WS_DEFLATE_WINDOW_BITS', 12),
+                mem_level=getattr(settings, 'CHAT_WS_DEFLATE_MEM_LEVEL', 5),
+            )
+    return None
+
+
+class WriteFlow:
+    """Потоковый producer twisted: transport ставит его на паузу, когда буфер записи полон"""
+
+    def __init__(self, transport, limit):
+        self.transport = transport
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # Producer транспорта остаётся от HTTPChannel, через который прошло рукопожатие:
+        # встаём на его место и передаём ему паузы дальше
+        self.previous = getattr(transport, 'producer', None)
+        if self.previous is not None:
+            transport.unregisterProducer()
+        transport.bufferSize = limit
+        transport.registerProducer(self, True)
+
+    def buffered(self):
+        """Байты, ещё не отданные ядру"""
+        transport = self.transport
+        data = getattr(transport, 'dataBuffer', b'')
+        return len(data) - getattr(transport, 'offset', 0) + getattr(transport, '_tempDataLen', 0)
+
+    def pauseProducing(self):
+        # twisted вызывает паузу на каждой записи в полный буфер
+        if not self.writable.is_set():
+            return
+        self.writable.clear()
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.resumeProducing()
+
+    def stopProducing(self):
+        # Соединение закрыто: ждать больше нечего
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.stopProducing()
+
+
+class DeflateServer(Server):
+    def listen_success(self, port):
+        # Фабрика уже создана в run(), а соединения ещё не принимаются
+        self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+        super().listen_success(port)
+
+    def create_application(self, protocol, scope):
+        if scope.get('type') == 'websocket':
+            from django.conf import settings
+
+            from chat.outbound import WRITE_FLOW_EXTENSION
+
+            limit = getattr(settings, 'CHAT_OUTBOUND_BUFFER_BYTES', 64 * 1024)
+            flow = WriteFlow(protocol.transport, limit)
+            scope.setdefault('extensions', {})[WRITE_FLOW_EXTENSION] = flow
+        return super().create_application(protocol, scope)
+
+    def kill_all_applications(self):
+        # Отменённые консьюмеры не доходят до disconnect: очередь записи дописываем здесь,
+        # иначе сообщения, уже разосланные клиентам, пропадут при SIGTERM
+        from chat.persistence import message_writer
+
+        def flush(result):
+            return defer.Deferred.fromFuture(asyncio.ensure_future(message_writer.flush()))
+
+        return super().kill_all_applications().addBoth(flush)
+
+
+class DeflateCommandLineInterface(CommandLineInterface):
+    server_class = DeflateServer
+
+
+if __name__ == '__main__':
+    DeflateCommandLineInterface.entrypoint()
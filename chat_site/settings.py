@@ -32,6 +32,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.metrics.ViewMetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'chat_site.urls'
@@ -58,12 +59,108 @@ ASGI_APPLICATION = 'chat_site.asgi.application'
 LOGIN_REDIRECT_URL = '/chat/'
 LOGOUT_REDIRECT_URL = '/accounts/login/'
 
+# Channel layer: одна подписка на комнату в процессе + локальная раздача сокетам.
+# С REDIS_URL процессы daphne связываются через Redis pub/sub (можно запускать несколько),
+# без него используется брокер внутри процесса (один процесс, разработка и тесты).
+REDIS_URL = os.environ.get('REDIS_URL')
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+        "BACKEND": "chat.layers.PubSubChannelLayer",
+        "CONFIG": {
+            "broker": "redis" if REDIS_URL else "local",
+            "url": REDIS_URL,
+            # Кольцевые буферы комнат (chat/recent.py): в памяти процесса — не больше
+            # recent_rooms, в Redis ключи молчащей комнаты истекают через recent_ttl секунд
+            "recent_rooms": 10000,
+            "recent_ttl": 24 * 60 * 60,
+        },
     }
 }
 
+# Сохранение сообщений чата:
+# 'batched' — сообщение рассылается сразу, а в БД пишется пачками (write-behind);
+# 'sync' — запись в БД до рассылки, как раньше (ничего не теряется при падении процесса)
+CHAT_MESSAGE_PERSISTENCE = os.environ.get('CHAT_MESSAGE_PERSISTENCE', 'batched')
+CHAT_PERSISTENCE_BATCH_SIZE = 100        # максимум сообщений в одном bulk_create
+CHAT_PERSISTENCE_FLUSH_INTERVAL = 0.2    # секунды ожидания добора пачки
+CHAT_PERSISTENCE_QUEUE_SIZE = 5000       # при переполнении очереди отправитель ждёт
+
+# Пул потоков для запросов к БД из консьюмеров (chat/db.py): столько запросов
+# процесса идут параллельно, столько же соединений с БД может быть открыто
+CHAT_DB_WORKERS = 8
+
+# Кэш имени/аватарки отправителя в консьюмерах (на процесс)
+CHAT_IDENTITY_CACHE_SIZE = 10000
+CHAT_IDENTITY_CACHE_TTL = 300            # секунды; ограничивает устаревание между процессами
+
+# Индекс участников личных чатов и групп для проверки доступа (на процесс)
+CHAT_ACCESS_CACHE_SIZE = 10000
+CHAT_ACCESS_CACHE_TTL = 300              # секунды; изменения участников сбрасывают индекс сразу
+
+# Миниатюры аватарок: строятся в пуле процессов, в сообщениях — размер CHAT_AVATAR_SIZE
+CHAT_AVATAR_SIZE = 64                    # пикселей; пузырь 32px на экранах 2x
+CHAT_AVATAR_WORKERS = 2
+
+# Исходящая очередь каждого сокета (chat/outbound.py): медленный клиент не тормозит комнату
+CHAT_OUTBOUND_HIGH_WATER = 500           # кадров в очереди, после которых включается политика
+CHAT_OUTBOUND_BUFFER_BYTES = 64 * 1024   # буфер записи транспорта, сверх которого кадры ждут в очереди (chat_site.server)
+CHAT_OUTBOUND_POLICY = 'coalesce'        # 'drop_oldest' | 'coalesce' (кадр resync) | 'disconnect' (код 4009)
+CHAT_OUTBOUND_LAG_FRAMES = 50            # с такой очереди клиент считается отстающим в метриках
+
+# Метрики Prometheus на /metrics (chat/metrics.py): без токена доступны только персоналу
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN')
+
+# Сжатие WebSocket (permessage-deflate) при запуске через python -m chat_site.server.
+# Состояние сжатия живёт всё соединение: окно и memLevel ограничивают память на сокет
+CHAT_WS_DEFLATE = True
+CHAT_WS_DEFLATE_WINDOW_BITS = 12         # окно 4 КБ вместо 32 КБ
+CHAT_WS_DEFLATE_MEM_LEVEL = 5
+
+# Допуск WebSocket-подключений (chat/admission.py): защита от лавины переподключений.
+# Все лимиты — на процесс; отказ закрывает сокет с предложенной задержкой повтора
+CHAT_WS_MAX_CONNECTIONS = 10000          # сокетов на процесс, дальше — код 4013
+CHAT_WS_CONNECT_RATE = 200               # подключений в секунду (ведро токенов)
+CHAT_WS_CONNECT_BURST = 100              # запас ведра для всплеска
+CHAT_WS_CONNECT_QUEUE_WAIT = 5.0         # секунды ожидания токена, дальше — код 4029
+CHAT_WS_MAX_PER_USER = 20                # сокетов одного пользователя, дальше — код 4008
+CHAT_WS_OVERLOAD_RETRY = 5.0             # секунды до повтора при заполненном процессе (с разбросом до 2x)
+CHAT_WS_RETRY_MIN = 1.0                  # минимальная предложенная задержка повтора
+
+# Мультиплексный сокет ws/streams/: один сокет на пользователя для многих разговоров
+CHAT_MUX_MAX_STREAMS = 200               # потоков на сокет
+
+# Присутствие в общем чате: входы/выходы рассылаются дельтами раз в окно,
+# OnlineUser обновляется по сердцебиению и устаревает без него
+CHAT_PRESENCE_WINDOW = 0.5               # секунды накопления дельты
+CHAT_PRESENCE_HEARTBEAT = 30             # секунды между записями в OnlineUser
+CHAT_PRESENCE_TTL = 90                   # запись без обновления дольше — офлайн
+
+# Уведомления о личных чатах и группах в группу user_<id> (chat/notifications.py)
+CHAT_NOTIFY_WINDOW = 0.5                 # секунды; на разговор за окно — одно состояние
+
+# История сообщений: комнаты показывают последнюю страницу, остальное — по курсору
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# Кольцевой буфер комнаты в channel layer (chat/recent.py): страницы комнат без БД и повтор пропущенного
+CHAT_RECENT_SIZE = 200                   # сообщений на комнату; не меньше CHAT_HISTORY_PAGE_SIZE
+
+# Холодный архив (chat/archive.py, команда archive_messages): старые сообщения
+# уходят из горячих таблиц в сжатые месячные сегменты, история дочитывает их сама.
+# Сообщения из БД удаляются, поэтому сегменты пишутся в хранилище STORAGES[CHAT_ARCHIVE_STORAGE] —
+# долговременное и общее для всех узлов, например S3 через django-storages:
+#   STORAGES['chat_archive'] = {'BACKEND': 'storages.backends.s3.S3Storage', 'OPTIONS': {'bucket_name': '...'}}
+# Без него archive_messages не запускается; локальный диск — только с --local-storage
+CHAT_ARCHIVE_STORAGE = 'chat_archive'
+CHAT_ARCHIVE_AFTER_DAYS = 180
+
+# Полнотекстовый поиск (chat/search.py): FTS5 на SQLite, tsvector + GIN на PostgreSQL
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_RANK_WINDOW = 2000           # ранжируются только столько самых свежих совпадений
+
+# Поиск пользователей по началу имени (chat/directory.py)
+CHAT_USER_SEARCH_PAGE_SIZE = 20
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -71,6 +168,17 @@ DATABASES = {
     }
 }
 
+# Отдельная БД для команд bench_*: на default они не запускаются
+#   CHAT_BENCH_DB=/tmp/bench.sqlite3 python manage.py migrate --database bench
+if os.environ.get('CHAT_BENCH_DB'):
+    DATABASES['bench'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['CHAT_BENCH_DB'],
+    }
+    # Сервер под loadtest --driver socket работает на той же отдельной БД
+    if os.environ.get('CHAT_BENCH_SERVE'):
+        DATABASES['default'] = DATABASES['bench']
+
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / "static"]
 STATIC_ROOT = BASE_DIR / "staticfiles"
@@ -79,6 +187,12 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Хранилища файлов; сюда же добавляется хранилище архива (CHAT_ARCHIVE_STORAGE)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
 # Tailwind
 TAILWIND_APP_NAME = 'chat'
 
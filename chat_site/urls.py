@@ -4,12 +4,16 @@ from django.urls import path, include
 from django.views.generic import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
+from chat.views import avatar_variant, metrics
 
 urlpatterns = [
     path('', RedirectView.as_view(url='/chat/', permanent=False)),
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
     path('chat/', include('chat.urls')),
+    path('metrics', metrics, name='metrics'),
+    # Миниатюры аватарок отдаются всегда (и без DEBUG) с долгим кэшем
+    path(f'{settings.MEDIA_URL.lstrip("/")}variants/<path:name>', avatar_variant, name='avatar_variant'),
 ]
 
 if settings.DEBUG: